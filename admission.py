@@ -0,0 +1,132 @@
+import time
+import threading
+from metrics import METRICS
+
+
+# ====== Admission control ======
+# Shared by every listener of a Runner. Connections and tunnels above the limits are
+# refused (503, or a SOCKS failure reply) instead of piling up threads and descriptors;
+# a tunnel may first wait up to `wait` seconds for a slot. 0 means unlimited.
+# A "tunnel" is anything holding a tor stream: CONNECT, SOCKS, a plain HTTP exchange.
+class Limits:
+    def __init__(self, max_connections=0, max_tunnels=0, per_client=0, per_host=0, wait=0.0,
+                 connect_timeout=None, handshake_timeout=None, idle_timeout=None):
+        self.max_connections = max_connections
+        self.max_tunnels = max_tunnels
+        self.per_client = per_client
+        self.per_host = per_host
+        self.wait = wait
+        # seconds, None for no timeout
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.connections = 0
+        self.tunnels = 0
+        self.clients = {}
+        self.hosts = {}
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    # constructor arguments, to rebuild the same limits in a worker process
+    def settings(self):
+        return {"max_connections": self.max_connections, "max_tunnels": self.max_tunnels,
+                "per_client": self.per_client, "per_host": self.per_host, "wait": self.wait,
+                "connect_timeout": self.connect_timeout, "handshake_timeout": self.handshake_timeout,
+                "idle_timeout": self.idle_timeout}
+
+    # a settings change on a running proxy; counts and waiting tunnels carry over
+    def update(self, **settings):
+        with self._cond:
+            for name, value in settings.items():
+                setattr(self, name, value)
+            self._cond.notify_all()
+
+    def open_connection(self):
+        with self._cond:
+            if self.max_connections and self.connections >= self.max_connections:
+                shed("max_connections")
+                return False
+            self.connections += 1
+            return True
+
+    def close_connection(self):
+        with self._cond:
+            self.connections -= 1
+
+    def _refusal(self, client, host):
+        if self.max_tunnels and self.tunnels >= self.max_tunnels:
+            return "max_tunnels"
+        if self.per_client and self.clients.get(client, 0) >= self.per_client:
+            return "per_client"
+        if self.per_host and self.hosts.get(host, 0) >= self.per_host:
+            return "per_host"
+        return None
+
+    # takes a slot without waiting; returns None when admitted, else the limit that refused
+    def try_admit(self, client, host):
+        with self._cond:
+            reason = self._refusal(client, host)
+            if not reason:
+                self.tunnels += 1
+                self.clients[client] = self.clients.get(client, 0) + 1
+                self.hosts[host] = self.hosts.get(host, 0) + 1
+            return reason
+
+    # blocking version for the threaded engine, holds the caller up to `wait` seconds
+    def admit(self, client, host):
+        reason = self.try_admit(client, host)
+        if reason and self.wait > 0:
+            deadline = time.monotonic() + self.wait
+            with self._cond:
+                self.waiting += 1
+                try:
+                    while reason:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                        reason = self.try_admit(client, host)
+                finally:
+                    self.waiting -= 1
+        if reason:
+            shed(reason)
+        return reason
+
+    # for callers that wait on their own, like the event loop polling try_admit()
+    def add_waiting(self, count):
+        with self._cond:
+            self.waiting += count
+
+    def release(self, client, host):
+        with self._cond:
+            self.tunnels -= 1
+            for counts, key in ((self.clients, client), (self.hosts, host)):
+                if counts[key] > 1:
+                    counts[key] -= 1
+                else:
+                    del counts[key]
+            self._cond.notify_all()
+
+    def collect(self):
+        return {"torproxy_connections_active": self.connections, "torproxy_admission_waiting": self.waiting}
+
+
+def shed(reason):
+    METRICS.inc("torproxy_shed_total", labels=(("reason", reason),))
+
+
+# the config keys limits_from_config reads
+LIMIT_KEYS = ("max_connections", "max_tunnels", "max_tunnels_per_client", "max_tunnels_per_host", "admission_wait",
+              "connect_timeout", "handshake_timeout", "idle_timeout")
+
+
+def limits_from_config(config):
+    seconds = lambda v: v or None
+    return Limits(config["max_connections"], config["max_tunnels"], config["max_tunnels_per_client"],
+                  config["max_tunnels_per_host"], config["admission_wait"], seconds(config["connect_timeout"]),
+                  seconds(config["handshake_timeout"]), seconds(config["idle_timeout"]))
+
+
+# sent straight from the accept loop, before a handler exists
+OVERLOADED = (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nConnection: close\r\n"
+              b"Content-Length: 0\r\n\r\n")
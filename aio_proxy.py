@@ -0,0 +1,534 @@
+import asyncio
+import socket
+import struct
+import time
+import threading
+from html import escape
+from urllib.parse import urlsplit
+from http import HTTPStatus
+from proxy import is_blocked, tor_lease, _StaticLease
+from admission import Limits, OVERLOADED, shed
+from circuits import ConnectPolicy, RETRYABLE_REPLIES
+from routes import RouteTable, DIRECT, PAC_PATH, refused
+from shaping import Shaper, UPLOAD, DOWNLOAD
+from http_stream import HTTPStreamError, BadRequest, end_to_end, get_header, request_framing, without_length
+from metrics import METRICS, UP, DOWN, method_labels
+from logpipe import LOG
+from profiling import PROFILER
+
+HEADER_LIMIT = 64 * 1024
+RELAY_CHUNK = 64 * 1024
+
+SOCKS5_ERRORS = {
+    1: "general SOCKS server failure",
+    2: "connection not allowed by ruleset",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported",
+}
+
+
+# code is the SOCKS5 reply code, passed on to our own SOCKS clients
+class SocksError(Exception):
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        self.code = code
+
+
+# ====== SOCKS5 client ======
+# username: authenticate with it (RFC 1929), tor uses it to pick a circuit
+async def open_socks5(socks_host, socks_port, host, port, username=None):
+    reader, writer = await asyncio.open_connection(socks_host, socks_port)
+    try:
+        writer.write(b"\x05\x01\x02" if username else b"\x05\x01\x00")
+        ver, method = await reader.readexactly(2)
+        if ver != 5 or method != (2 if username else 0):
+            raise SocksError("SOCKS5 authentication rejected")
+        if username:
+            user = username.encode()
+            writer.write(b"\x01" + bytes([len(user)]) + user + b"\x01x")
+            _, status = await reader.readexactly(2)
+            if status != 0:
+                raise SocksError("SOCKS5 authentication rejected")
+        name = host.encode("idna")
+        writer.write(b"\x05\x01\x00\x03" + bytes([len(name)]) + name + struct.pack("!H", port))
+        ver, rep, _, atyp = await reader.readexactly(4)
+        if rep != 0:
+            raise SocksError(SOCKS5_ERRORS.get(rep, f"SOCKS5 error {rep}"), rep)
+        if atyp == 1:
+            await reader.readexactly(4 + 2)
+        elif atyp == 4:
+            await reader.readexactly(16 + 2)
+        else:
+            (n,) = await reader.readexactly(1)
+            await reader.readexactly(n + 2)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def open_tor(tor, host, port, connect_timeout=None, username=None):
+    lease = tor_lease(tor)
+    started = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(
+            open_socks5("127.0.0.1", lease.socks_port, host, port, username), connect_timeout)
+    except asyncio.CancelledError:
+        # the losing side of a hedge
+        lease.release()
+        raise
+    except BaseException as e:
+        METRICS.inc("torproxy_tor_connect_failures_total", labels=(("reason", connect_failure_reason(e)),))
+        lease.failed(isinstance(e, (OSError, asyncio.TimeoutError)))
+        lease.release()
+        raise
+    elapsed = time.monotonic() - started
+    METRICS.observe("torproxy_tor_connect_seconds", elapsed)
+    lease.connected(elapsed)
+    return reader, writer, lease
+
+
+# ====== Retries and hedging ======
+# same strategy as proxy.connect_tor: retry on a fresh circuit, hedge a slow connect
+async def connect_tor(tor, host, port, policy, connect_timeout=None):
+    async def attempt(username):
+        started = time.monotonic()
+        stream = await open_tor(tor, host, port, connect_timeout, username)
+        policy.record(time.monotonic() - started)
+        return stream
+    for n in range(policy.retries + 1):
+        try:
+            return await _race(attempt, policy.circuit(host) if n == 0 else policy.isolation(), policy)
+        except Exception as e:
+            retry = getattr(e, "code", None) in RETRYABLE_REPLIES or isinstance(e, asyncio.TimeoutError)
+            if n == policy.retries or not retry:
+                raise
+            METRICS.inc("torproxy_connect_retries_total")
+
+
+async def _race(attempt, username, policy):
+    delay = policy.hedge_delay()
+    if delay is None:
+        return await attempt(username)
+    first = asyncio.ensure_future(attempt(username))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    METRICS.inc("torproxy_connect_hedges_total")
+    hedge = asyncio.ensure_future(attempt(policy.isolation()))
+    pending = {first, hedge}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        winners = [t for t in done if t.exception() is None]
+        if winners:
+            for task in pending:
+                task.cancel()
+            for task in winners[1:]:
+                _, writer, lease = task.result()
+                writer.close(); lease.release()
+            if winners[0] is hedge:
+                METRICS.inc("torproxy_connect_hedge_wins_total")
+            return winners[0].result()
+        error = next(iter(done)).exception()
+    raise error
+
+
+# ====== Split tunneling ======
+# same as proxy.open_route_socket
+async def open_route(route, host, port, connect_timeout=None):
+    async def connect():
+        if route.scheme == DIRECT:
+            return await asyncio.open_connection(host.strip("[]"), port)
+        if route.scheme == "socks5":
+            return await open_socks5(route.host, route.port, host, port)
+        reader, writer = await asyncio.open_connection(route.host, route.port)
+        try:
+            if route.scheme == "socks4":
+                # SOCKS4a, the other proxy resolves the name
+                writer.write(struct.pack("!BBH", 4, 1, port) + b"\0\0\0\x01\0" + host.encode("idna") + b"\0")
+                _, status = (await reader.readexactly(8))[:2]
+                if status != 0x5a:
+                    raise SocksError(f"SOCKS4 request rejected ({status:#x})")
+            else:
+                writer.write(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode("latin-1"))
+                status = (await reader.readuntil(b"\r\n\r\n")).split(b" ", 2)[1]
+                if status != b"200":
+                    raise SocksError(f"upstream proxy answered {status.decode('latin-1')}")
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+    reader, writer = await asyncio.wait_for(connect(), connect_timeout)
+    METRICS.inc("torproxy_routed_total", labels=(("route", route.scheme),))
+    return reader, writer, _StaticLease(None)
+
+
+# same reasons as proxy.connect_failure_reason
+def connect_failure_reason(e):
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    if isinstance(e, OSError) and not isinstance(e, ConnectionResetError):
+        return "tor_unreachable"
+    if isinstance(e, (SocksError, asyncio.IncompleteReadError, ConnectionResetError)):
+        return "socks"
+    return "other"
+
+
+# Limits.admit for the event loop: polls for a free slot instead of blocking the loop
+async def admit(limits, client, host):
+    reason = limits.try_admit(client, host)
+    if reason and limits.wait > 0:
+        deadline = time.monotonic() + limits.wait
+        limits.add_waiting(1)
+        try:
+            while reason and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                reason = limits.try_admit(client, host)
+        finally:
+            limits.add_waiting(-1)
+    if reason:
+        shed(reason)
+    return reason
+
+
+def idle_timeout():
+    METRICS.inc("torproxy_timeouts_total", labels=(("phase", "idle"),))
+
+
+def handshake_timeout():
+    METRICS.inc("torproxy_timeouts_total", labels=(("phase", "handshake"),))
+
+
+# ====== Proxy Protocol ======
+class AsyncProxyHandler:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client = (writer.get_extra_info("peername") or ("-",))[0]
+        self.last_activity = time.monotonic()
+        self.phases = PROFILER.clock()
+
+    async def handle(self):
+        try:
+            head = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), self.server.limits.handshake_timeout)
+        except asyncio.TimeoutError:
+            handshake_timeout()
+            self.writer.close()
+            return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            self.writer.close()
+            return
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            self.command, self.path, self.version = lines[0].split(" ", 2)
+        except ValueError:
+            await self.send_error(400, "Bad request syntax")
+            return
+        METRICS.inc("torproxy_requests_total", labels=method_labels(self.command))
+        self.phases.lap("parse")
+        self.status = "-"
+        try:
+            await self._dispatch(lines)
+        finally:
+            LOG.write(f'{self.client} "{lines[0]}" {self.status}')
+
+    async def _dispatch(self, lines):
+        self.headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            k, _, v = line.partition(":")
+            self.headers.append((k.strip(), v.strip()))
+
+        if self.command == "CONNECT":
+            await self.do_CONNECT()
+        elif self.command in ("GET", "POST", "HEAD", "PUT", "PATCH", "DELETE", "OPTIONS"):
+            await self._handle_http()
+        else:
+            await self.send_error(501, f"Unsupported method ({self.command!r})")
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    async def do_CONNECT(self):
+        try:
+            host, port = self.path.rsplit(":", 1)
+            port = int(port)
+        except ValueError:
+            await self.send_error(400, "Bad CONNECT target")
+            return
+
+        if is_blocked(host):
+            await self.send_error(403, "Forbidden: Blocked")
+            return
+        if self.server.route_refused(self.client, host, port):
+            await self.send_error(403, "Forbidden: Local destination")
+            return
+        self.phases.lap("blocklist")
+        limits = self.server.limits
+        reason = await admit(limits, self.client, host)
+        if reason:
+            await self.send_error(503, f"Over capacity ({reason})")
+            return
+        self.phases.lap("admission")
+        try:
+            try:
+                r_reader, r_writer, lease = await self.server.open_upstream(host, port)
+            except Exception as e:
+                await self.send_error(502, f"CONNECT error: {e}")
+                return
+            self.phases.lap("handshake")
+            self.status = 200
+            await self._relay(b"HTTP/1.1 200 Connection Established\r\n\r\n", r_reader, r_writer, lease, port)
+        finally:
+            limits.release(self.client, host)
+
+    # sends the success reply, then relays between the client and tor until both sides close
+    async def _relay(self, reply, r_reader, r_writer, lease, port):
+        METRICS.inc("torproxy_tunnels_total"); METRICS.inc("torproxy_tunnels_active")
+        started = time.monotonic()
+        try:
+            self.writer.write(reply)
+            up, down = await self._tunnel(self.reader, self.writer, r_reader, r_writer,
+                                          self.server.shaper.open(self.client, port))
+            self.phases.lap("relay")
+            METRICS.inc("torproxy_relay_bytes_total", up, UP)
+            METRICS.inc("torproxy_relay_bytes_total", down, DOWN)
+        finally:
+            METRICS.dec("torproxy_tunnels_active")
+            METRICS.observe("torproxy_tunnel_duration_seconds", time.monotonic() - started)
+            lease.release()
+
+    async def _handle_http(self):
+        parsed = urlsplit(self.path)
+        host = parsed.hostname
+        port = parsed.port or 80
+        if not host and parsed.path == PAC_PATH and self.command in ("GET", "HEAD"):
+            await self._send_pac()
+            return
+        if not host:
+            await self.send_error(400, "Absolute URI required")
+            return
+        # the body is streamed as is, but a Content-Length the origin might read differently is refused
+        try:
+            request_framing(self.headers)
+        except BadRequest as e:
+            await self.send_error(400, str(e))
+            return
+        except HTTPStreamError:
+            pass
+
+        if is_blocked(host):
+            await self.send_error(403, "Forbidden: Blocked")
+            return
+        if self.server.route_refused(self.client, host, port):
+            await self.send_error(403, "Forbidden: Local destination")
+            return
+        self.phases.lap("blocklist")
+        limits = self.server.limits
+        reason = await admit(limits, self.client, host)
+        if reason:
+            await self.send_error(503, f"Over capacity ({reason})")
+            return
+        self.phases.lap("admission")
+        try:
+            try:
+                r_reader, r_writer, lease = await self.server.open_upstream(host, port)
+            except Exception as e:
+                await self.send_error(502, f"HTTP error: {e}")
+                return
+            self.phases.lap("handshake")
+            try:
+                await self._forward(parsed, r_reader, r_writer)
+            finally:
+                lease.release()
+        finally:
+            limits.release(self.client, host)
+
+    async def _send_pac(self):
+        self.status = 200
+        body = self.server.routes.pac(self.header("Host") or f"127.0.0.1:{self.server.server_address[1]}").encode()
+        self.writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: application/x-ns-proxy-autoconfig\r\nCache-Control: no-cache\r\n"
+            f"Connection: close\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1")
+            + (body if self.command != "HEAD" else b""))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+    async def _forward(self, parsed, r_reader, r_writer):
+        headers = end_to_end(self.headers)
+        te = get_header(self.headers, "Transfer-Encoding")
+        if te:
+            headers = without_length(headers)
+            headers.append(("Transfer-Encoding", te))
+        headers.append(("Connection", "close"))
+        req_line = f"{self.command} {parsed.path or '/'}{'?' + parsed.query if parsed.query else ''} HTTP/1.1\r\n"
+        hdrs = ''.join(f"{k}: {v}\r\n" for k, v in headers)
+        r_writer.write((req_line + hdrs + "\r\n").encode("latin-1"))
+        # upstream closes after one response, so whatever body the client sends streams through the tunnel
+        await self._tunnel(self.reader, self.writer, r_reader, r_writer)
+        self.phases.lap("relay")
+
+    # shaped: a shaping.Tunnel, charged for every read in `direction`
+    async def _pipe(self, reader, writer, shaped=None, direction=UPLOAD):
+        total = 0
+        first = direction == DOWNLOAD
+        chunk = min(RELAY_CHUNK, shaped.shaper.quantum) if shaped else RELAY_CHUNK
+        try:
+            while True:
+                data = await reader.read(chunk)
+                if not data:
+                    break
+                total += len(data)
+                writer.write(data)
+                await writer.drain()
+                self.last_activity = time.monotonic()
+                if first:
+                    self.phases.lap("first_byte")
+                    first = False
+                if shaped:
+                    delay = shaped.take(direction, len(data))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            pass
+        return total
+
+    # returns bytes copied (a->b, b->a), a being the client; shaped: a shaping.Tunnel
+    async def _tunnel(self, a_reader, a_writer, b_reader, b_writer, shaped=None):
+        idle = self.server.limits.idle_timeout
+        watchdog = asyncio.ensure_future(self._watchdog(idle, a_writer, b_writer)) if idle else None
+        try:
+            return await asyncio.gather(self._pipe(a_reader, b_writer, shaped, UPLOAD),
+                                        self._pipe(b_reader, a_writer, shaped, DOWNLOAD))
+        finally:
+            if watchdog: watchdog.cancel()
+            if shaped: shaped.close()
+            a_writer.close(); b_writer.close()
+
+    # one timer per tunnel rather than a timeout around every read: aborts both sides once
+    # nothing was relayed either way for `idle` seconds, including a peer that stopped reading
+    async def _watchdog(self, idle, *writers):
+        self.last_activity = time.monotonic()
+        while True:
+            left = self.last_activity + idle - time.monotonic()
+            if left <= 0:
+                idle_timeout()
+                for w in writers:
+                    sock = w.get_extra_info("socket")
+                    if sock is not None:
+                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                    w.transport.abort()
+                return
+            await asyncio.sleep(left)
+
+    async def send_error(self, code, message=None):
+        METRICS.inc("torproxy_errors_total", labels=(("code", code),))
+        self.status = code
+        try:
+            phrase = HTTPStatus(code).phrase
+        except ValueError:
+            phrase = ""
+        body = (f"<html><head><title>Error response</title></head><body>"
+                f"<h1>Error response</h1><p>Error code: {code}</p>"
+                f"<p>Message: {escape(message or phrase)}.</p></body></html>").encode("utf-8", "replace")
+        self.writer.write(
+            f"HTTP/1.1 {code} {phrase}\r\nContent-Type: text/html;charset=utf-8\r\n"
+            f"Connection: close\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+# ====== Server ======
+# Same interface as ThreadedHTTPServer, but every connection is a task on one event loop
+class AsyncProxyServer:
+    handler_class = AsyncProxyHandler
+    request_queue_size = 4096
+
+    def __init__(self, addr, tor_socks_port, limits=None, sock=None, connect_policy=None, routes=None, shaper=None):
+        self.tor_socks_port = tor_socks_port
+        self.limits = limits or Limits()
+        self.connect_policy = connect_policy or ConnectPolicy()
+        self.routes = routes or RouteTable()
+        self.shaper = shaper or Shaper()
+        self.socket = sock or socket.create_server(addr, backlog=self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.loop = asyncio.new_event_loop()
+        self._stop = asyncio.Event()
+        self._stopped = threading.Event()
+        self._tasks = set()
+        METRICS.add_collector(self.limits.collect)
+
+    async def _client(self, reader, writer):
+        if not self.limits.open_connection():
+            self.refuse(writer)
+            return
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        METRICS.inc("torproxy_client_connections_total")
+        try:
+            await self.handler_class(self, reader, writer).handle()
+        except (Exception, asyncio.CancelledError):
+            writer.close()
+        finally:
+            self._tasks.discard(task)
+            self.limits.close_connection()
+
+    # a direct route to the gateway itself, asked for by a client elsewhere; see routes.refused
+    def route_refused(self, client, host, port):
+        return refused(self.routes.lookup(host, port), client, host, port, (self.server_address[1],))
+
+    async def open_upstream(self, host, port):
+        route = self.routes.lookup(host, port)
+        if route:
+            return await open_route(route, host, port, self.limits.connect_timeout)
+        return await connect_tor(self.tor_socks_port, host, port, self.connect_policy, self.limits.connect_timeout)
+
+    def refuse(self, writer):
+        writer.write(OVERLOADED)
+        writer.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._client, sock=self.socket, limit=HEADER_LIMIT)
+        async with server:
+            await self._stop.wait()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        PROFILER.add_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            PROFILER.remove_loop(self.loop)
+            self.loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop.set)
+            self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        METRICS.remove_collector(self.limits.collect)
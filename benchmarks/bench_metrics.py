@@ -0,0 +1,95 @@
+# Cost of the metrics calls, and of the per-tunnel accounting in ProxyHandler._tunnel
+# relative to setting up and tearing down a tunnel.
+#   python benchmarks/bench_metrics.py [--ops 1000000] [--threads 8]
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import Metrics, METRICS, UP, DOWN
+from relay import relay
+
+
+def ns_per_op(fn, ops):
+    started = time.perf_counter()
+    for _ in range(ops):
+        fn()
+    return (time.perf_counter() - started) / ops * 1e9
+
+
+def threaded_ns_per_op(fn, ops, threads):
+    def work():
+        for _ in range(ops):
+            fn()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    return (time.perf_counter() - started) / (ops * threads) * 1e9
+
+
+def tunnel_accounting():
+    # exactly what ProxyHandler._tunnel adds around relay()
+    METRICS.inc("torproxy_tunnels_total"); METRICS.inc("torproxy_tunnels_active")
+    started = time.monotonic()
+    METRICS.dec("torproxy_tunnels_active")
+    METRICS.observe("torproxy_tunnel_duration_seconds", time.monotonic() - started)
+    METRICS.inc("torproxy_relay_bytes_total", 1000, UP)
+    METRICS.inc("torproxy_relay_bytes_total", 1000, DOWN)
+
+
+def tunnel_setup_us(rounds):
+    srv = socket.create_server(("127.0.0.1", 0))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        a = socket.create_connection(srv.getsockname()); b, _ = srv.accept()
+        c = socket.create_connection(srv.getsockname()); d, _ = srv.accept()
+        a.shutdown(socket.SHUT_WR); c.shutdown(socket.SHUT_WR)
+        relay(b, d)
+        a.close(); c.close()
+    srv.close()
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    m = Metrics()
+    m.counter("c", "c"); m.histogram("h", "h")
+    labels = (("code", 403),)
+    lock = threading.Lock()
+    locked = {"n": 0}
+    def locked_inc():
+        with lock:
+            locked["n"] += 1
+
+    accounting_ns = ns_per_op(tunnel_accounting, args.ops // 10)
+    setup_us = tunnel_setup_us(2000)
+    for i in range(1000):
+        m.inc("c", labels=(("i", i),))
+    started = time.perf_counter()
+    m.render()
+    render_ms = (time.perf_counter() - started) * 1000
+    results = {
+        "inc_ns": round(ns_per_op(lambda: m.inc("c"), args.ops), 1),
+        "inc_labels_ns": round(ns_per_op(lambda: m.inc("c", labels=labels), args.ops), 1),
+        "observe_ns": round(ns_per_op(lambda: m.observe("h", 0.042), args.ops), 1),
+        f"inc_{args.threads}_threads_ns": round(threaded_ns_per_op(lambda: m.inc("c"), args.ops // args.threads, args.threads), 1),
+        f"locked_dict_inc_{args.threads}_threads_ns": round(threaded_ns_per_op(locked_inc, args.ops // args.threads, args.threads), 1),
+        "tunnel_accounting_us": round(accounting_ns / 1000, 2),
+        "empty_tunnel_setup_us": round(setup_us, 1),
+        "accounting_share_of_empty_tunnel": f"{accounting_ns / 1000 / setup_us:.2%}",
+        "render_1000_series_ms": round(render_ms, 2),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# Data plane benchmark of every proxy engine against local stand-ins (benchmarks/standins.py)
+# for tor and the origin, fully offline. Stand-ins, proxy and load generator are separate
+# processes. Prints JSON; compare runs between commits with --out.
+#   python benchmarks/bench_proxy.py [--engines threaded,asyncio] [--levels 1,10,100,1000,10000] [--workers N]
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+from standins import raise_fd_limit
+
+ORIGIN_HOST = "origin.bench"
+
+
+# ====== Processes ======
+def serve(engine, socks_port, workers):
+    raise_fd_limit()
+    sys.path.insert(0, ROOT)
+    from tor import Runner
+    runner = Runner(0, socks_port, None, engine=engine, workers=workers)
+    runner.start()
+    print(json.dumps({"port": runner.server.server_address[1], "pid": os.getpid()}), flush=True)
+    sys.stdin.read()
+    runner.stop()
+
+
+def spawn(args):
+    proc = subprocess.Popen([sys.executable] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=ROOT)
+    return proc, json.loads(proc.stdout.readline())
+
+
+def stop(proc):
+    proc.stdin.close()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill(); proc.wait()
+
+
+# RSS in MB and thread count from /proc, summed over worker processes; None elsewhere
+def process_stats(pid):
+    rss = threads = 0
+    try:
+        pids = [pid]
+        # children are listed under the thread that started them
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+        for p in pids:
+            with open(f"/proc/{p}/status") as f:
+                fields = dict(line.split(":", 1) for line in f)
+            rss += int(fields["VmRSS"].split()[0])
+            threads += int(fields["Threads"])
+    except (OSError, KeyError):
+        return {"rss_mb": None, "threads": None}
+    return {"rss_mb": round(rss / 1024, 1), "threads": threads}
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    return {"p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": pick(1.0), "n": len(samples)}
+
+
+# ====== Client side ======
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    remaining = length
+    while remaining:
+        data = await reader.read(min(remaining, 1 << 20))
+        if not data:
+            raise ConnectionError("short body")
+        remaining -= len(data)
+    return head, length
+
+
+async def open_tunnel(proxy_port, origin_port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port, limit=1 << 20)
+    writer.write(f"CONNECT {ORIGIN_HOST}:{origin_port} HTTP/1.1\r\nHost: {ORIGIN_HOST}:{origin_port}\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    if b" 200 " not in head.split(b"\r\n")[0] + b" ":
+        writer.close()
+        raise ConnectionError(head.split(b"\r\n")[0].decode())
+    return reader, writer
+
+
+async def tunnel_throughput(proxy_port, origin_port, mb, streams):
+    async def one():
+        reader, writer = await open_tunnel(proxy_port, origin_port)
+        writer.write(f"GET /bytes/{mb << 20} HTTP/1.1\r\nHost: {ORIGIN_HOST}\r\n\r\n".encode())
+        await read_response(reader)
+        writer.close()
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(streams)))
+    return round(mb * streams / (time.perf_counter() - started), 1)
+
+
+async def http_latency(proxy_port, origin_port, requests, concurrency):
+    samples, errors = [], 0
+    request = f"GET http://{ORIGIN_HOST}:{origin_port}/small HTTP/1.1\r\nHost: {ORIGIN_HOST}:{origin_port}\r\n\r\n".encode()
+    async def worker(n):
+        nonlocal errors
+        conn = None
+        for _ in range(n):
+            started = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = await asyncio.open_connection("127.0.0.1", proxy_port)
+                conn[1].write(request)
+                head, _ = await read_response(conn[0])
+                samples.append(time.perf_counter() - started)
+                # engines without client keep-alive close after each response
+                if b"connection: close" in head.lower():
+                    conn[1].close(); conn = None
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                if conn: conn[1].close()
+                conn = None
+        if conn: conn[1].close()
+    await asyncio.gather(*(worker(requests // concurrency + (i < requests % concurrency)) for i in range(concurrency)))
+    return dict(percentiles(samples), errors=errors)
+
+
+async def connections_per_second(proxy_port, origin_port, seconds, concurrency):
+    done, errors = 0, 0
+    deadline = time.perf_counter() + seconds
+    async def worker():
+        nonlocal done, errors
+        while time.perf_counter() < deadline:
+            try:
+                reader, writer = await open_tunnel(proxy_port, origin_port)
+                writer.write(f"GET /small HTTP/1.1\r\nHost: {ORIGIN_HOST}\r\nConnection: close\r\n\r\n".encode())
+                await read_response(reader)
+                writer.close()
+                done += 1
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"per_second": round(done / (time.perf_counter() - started), 1), "errors": errors}
+
+
+# holds `level` tunnels open at once, each proven with one round trip; an open that
+# takes longer than `timeout` (SYN drops on a short listen backlog) counts as an error
+async def scaling(proxy_port, origin_port, pid, level, opening=200, timeout=10.0):
+    gate = asyncio.Semaphore(opening)
+    tunnels, errors = [], 0
+    async def open_one():
+        reader, writer = await open_tunnel(proxy_port, origin_port)
+        writer.write(f"GET /small HTTP/1.1\r\nHost: {ORIGIN_HOST}\r\n\r\n".encode())
+        await read_response(reader)
+        return writer
+    async def one():
+        nonlocal errors
+        async with gate:
+            try:
+                tunnels.append(await asyncio.wait_for(open_one(), timeout))
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                errors += 1
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(level)))
+    elapsed = time.perf_counter() - started
+    result = dict(process_stats(pid), open=len(tunnels), errors=errors, setup_s=round(elapsed, 3))
+    for writer in tunnels:
+        writer.close()
+    await asyncio.sleep(0.5)
+    return result
+
+
+# ====== Runner ======
+def bench_engine(engine, ports, args, fd_limit):
+    proxy, info = spawn([os.path.join(HERE, "bench_proxy.py"), "--serve", engine, str(ports["socks"]), "--workers", str(args.workers)])
+    # let the workers bind before measuring
+    time.sleep(2 if args.workers > 1 else 0)
+    port, pid, origin = info["port"], info["pid"], ports["origin"]
+    try:
+        out = {"idle": process_stats(pid)}
+        out["tunnel_mb_s"] = asyncio.run(tunnel_throughput(port, origin, args.mb, 1))
+        out["tunnel_mb_s_4_streams"] = asyncio.run(tunnel_throughput(port, origin, args.mb // 4, 4))
+        out["http_latency"] = asyncio.run(http_latency(port, origin, args.requests, 1))
+        out["http_latency_c16"] = asyncio.run(http_latency(port, origin, args.requests, 16))
+        out["connections"] = asyncio.run(connections_per_second(port, origin, args.seconds, 16))
+        out["scaling"] = {}
+        for level in args.levels:
+            # client, proxy and socks each need two descriptors per tunnel
+            ran = min(level, (fd_limit - 200) // 2) if fd_limit else level
+            key = str(level) if ran == level else f"{level} (ran {ran}, RLIMIT_NOFILE)"
+            out["scaling"][key] = asyncio.run(scaling(port, origin, pid, ran))
+        return out
+    finally:
+        stop(proxy)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", nargs=2, metavar=("ENGINE", "SOCKS_PORT"), help=argparse.SUPPRESS)
+    parser.add_argument("--engines", default=None, help="comma separated, default: all of tor.Runner.engines")
+    parser.add_argument("--levels", default="1,10,100,1000,10000")
+    parser.add_argument("--mb", type=int, default=256, help="payload of the tunnel throughput run")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes (Runner(workers=N))")
+    parser.add_argument("--out", help="also write the JSON here")
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve[0], int(args.serve[1]), args.workers)
+        return
+    args.levels = [int(x) for x in args.levels.split(",")]
+    if args.engines:
+        engines = args.engines.split(",")
+    else:
+        sys.path.insert(0, ROOT)
+        from tor import Runner
+        engines = list(Runner.engines)
+
+    fd_limit = raise_fd_limit()
+    standins, ports = spawn([os.path.join(HERE, "standins.py")])
+    try:
+        results = {
+            "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                     "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "args": vars(args)},
+            "engines": {engine: bench_engine(engine, ports, args, fd_limit) for engine in engines},
+        }
+    finally:
+        stop(standins)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Throughput of the tunnel relay against the old select/recv(4096)/sendall loop.
+#   python benchmarks/bench_relay.py [--mb 512]
+import os
+import sys
+import json
+import time
+import select
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from relay import relay, HAS_SPLICE
+
+
+def legacy_tunnel(src, dst):
+    socks_list = [src, dst]
+    try:
+        while True:
+            r, _, _ = select.select(socks_list, [], [])
+            for s in r:
+                data = s.recv(4096)
+                if not data:
+                    return
+                (dst if s is src else src).sendall(data)
+    except:
+        pass
+    finally:
+        src.close(); dst.close()
+
+
+def tcp_pair():
+    with socket.create_server(("127.0.0.1", 0)) as srv:
+        a = socket.create_connection(srv.getsockname())
+        b, _ = srv.accept()
+    return a, b
+
+
+def run(tunnel, total):
+    producer, relay_in = tcp_pair()
+    relay_out, consumer = tcp_pair()
+    t = threading.Thread(target=tunnel, args=(relay_in, relay_out), daemon=True)
+    t.start()
+
+    def produce():
+        chunk = b"x" * (1 << 20)
+        for _ in range(total >> 20):
+            producer.sendall(chunk)
+        producer.shutdown(socket.SHUT_WR)
+
+    start = time.perf_counter()
+    threading.Thread(target=produce, daemon=True).start()
+    received = 0
+    buf = bytearray(1 << 20)
+    while True:
+        n = consumer.recv_into(buf)
+        if not n:
+            break
+        received += n
+    elapsed = time.perf_counter() - start
+    producer.close(); consumer.close(); t.join()
+    return {"bytes": received, "seconds": round(elapsed, 4), "MB/s": round(received / elapsed / 1e6, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mb", type=int, default=256)
+    args = parser.parse_args()
+    total = args.mb << 20
+    results = {"legacy": run(legacy_tunnel, total), "relay_copy": run(lambda a, b: relay(a, b, use_splice=False), total)}
+    if HAS_SPLICE:
+        results["relay_splice"] = run(lambda a, b: relay(a, b, use_splice=True), total)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
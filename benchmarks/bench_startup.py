@@ -0,0 +1,83 @@
+# Cold start of the headless daemon: process spawn until the proxy port accepts connections,
+# plus the slowest imports from -X importtime. Tor is not started (--no-tor).
+# The threaded engine's handler subclasses http.server's, and a process importing nothing
+# but http.server (http.client, email, ssl) is most of the cold start on its own; that floor
+# is reported too. The target is listening within TARGET_OVER_FLOOR_MS of it: a flat
+# sub-100ms target does not hold on slower machines, whatever this code imports.
+#   python benchmarks/bench_startup.py [--runs 10]
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_OVER_FLOOR_MS = 50
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_listen(timeout=10):
+    port = free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "daemon.py"), "--no-tor", "-p", str(port)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.05).close()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.001)
+        raise TimeoutError("daemon did not start listening")
+    finally:
+        proc.terminate(); proc.wait()
+
+
+def baseline(code="pass"):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(limit=10):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import daemon, proxy, tor"],
+                         cwd=ROOT, capture_output=True, text=True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # nested imports are indented under the module that triggered them
+        if not name[1:].startswith(" "):
+            rows.append((int(cumulative_us), name.strip()))
+    return [{"module": n, "cumulative_ms": c / 1000} for c, n in sorted(rows, reverse=True)[:limit]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+    samples = sorted(time_to_listen() for _ in range(args.runs))
+    interpreter = min(baseline() for _ in range(3))
+    floor = sorted(baseline("import http.server") for _ in range(args.runs))[args.runs // 2]
+    print(json.dumps({
+        "runs": args.runs,
+        "listen_ms": {"min": round(samples[0] * 1000, 1), "median": round(samples[len(samples) // 2] * 1000, 1),
+                      "max": round(samples[-1] * 1000, 1)},
+        "bare_interpreter_ms": round(interpreter * 1000, 1),
+        "http_server_floor_ms": round(floor * 1000, 1),
+        "over_floor_ms": round((samples[len(samples) // 2] - floor) * 1000, 1),
+        "target_over_floor_ms": TARGET_OVER_FLOOR_MS,
+        "slowest_imports": slowest_imports(),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Local stand-ins for the network around the proxy, so benchmarks run offline:
+#  - a SOCKS5 server standing in for tor; every target host resolves to 127.0.0.1
+#  - an HTTP/1.1 keep-alive origin: /bytes/<n> returns n bytes, anything else "ok"
+# Run as a separate process so the stand-ins do not compete with the proxy for the GIL:
+#   python benchmarks/standins.py   -> prints {"socks": port, "origin": port} and serves
+import os
+import sys
+import json
+import struct
+import asyncio
+
+CHUNK = 256 * 1024
+PAYLOAD = b"x" * (1 << 20)
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(CHUNK)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+async def socks5(reader, writer):
+    try:
+        _, n = await reader.readexactly(2)
+        await reader.readexactly(n)
+        writer.write(b"\x05\x00")
+        _, cmd, _, atyp = await reader.readexactly(4)
+        if atyp == 1:
+            await reader.readexactly(4)
+        elif atyp == 3:
+            await reader.readexactly((await reader.readexactly(1))[0])
+        else:
+            await reader.readexactly(16)
+        (port,) = struct.unpack("!H", await reader.readexactly(2))
+        try:
+            r_reader, r_writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            writer.write(b"\x05\x05\x00\x01" + b"\0" * 6)
+            return
+        writer.write(b"\x05\x00\x00\x01" + b"\0" * 6)
+        await asyncio.gather(_pipe(reader, r_writer), _pipe(r_reader, writer))
+        r_writer.close()
+    except (asyncio.IncompleteReadError, ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def origin(reader, writer):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            path = head.split(b" ", 2)[1]
+            close = b"connection: close" in head.lower()
+            if path.startswith(b"/bytes/"):
+                body, size = None, int(path[len(b"/bytes/"):])
+            else:
+                body, size = b"ok", 2
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n"
+                         % (size, b"Connection: close\r\n" if close else b""))
+            if body:
+                writer.write(body); size = 0
+            while size > 0:
+                writer.write(PAYLOAD[:min(size, len(PAYLOAD))])
+                size -= len(PAYLOAD)
+                await writer.drain()
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+# returns the new soft limit, or None where there is no rlimit (Windows)
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def main():
+    raise_fd_limit()
+    socks_server = await asyncio.start_server(socks5, "127.0.0.1", 0, backlog=4096)
+    origin_server = await asyncio.start_server(origin, "127.0.0.1", 0, backlog=4096)
+    print(json.dumps({"socks": socks_server.sockets[0].getsockname()[1],
+                      "origin": origin_server.sockets[0].getsockname()[1]}), flush=True)
+    # exit when the parent closes our stdin, without tearing down open relays one by one
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
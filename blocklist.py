@@ -0,0 +1,91 @@
+# ====== Domain rules ======
+# "example.com"   blocks example.com and every subdomain of it
+# "*.example.com" blocks subdomains of example.com but not example.com itself
+# "*example.com"  is treated like "example.com" (matching is label aligned)
+# "*"             blocks everything
+SELF_AND_SUBS = 1
+SUBS_ONLY = 2
+_RULE = None
+_VALUE = 0  # labels are strings, so neither key can clash with one
+
+
+def normalize_host(host):
+    return host.strip().lower().rstrip(".")
+
+
+def parse_rule(rule):
+    rule = normalize_host(rule)
+    if rule == "*":
+        return (), SUBS_ONLY
+    if rule.startswith("*."):
+        return tuple(rule[2:].split(".")), SUBS_ONLY
+    rule = rule.lstrip("*")
+    if not rule:
+        return None, 0
+    return tuple(rule.split(".")), SELF_AND_SUBS
+
+
+# Reversed-label trie: "a.example.com" is stored as com -> example -> a
+class DomainMatcher:
+    def __init__(self, rules=()):
+        self.root = {}
+        self.size = 0
+        for rule in rules:
+            self.add(rule)
+
+    # value: returned by lookup() for hosts this rule matches
+    def add(self, rule, value=True):
+        labels, kind = parse_rule(rule)
+        if labels is None:
+            return
+        node = self.root
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        node[_RULE] = node.get(_RULE, 0) | kind
+        node[_VALUE] = value
+        self.size += 1
+
+    def match(self, host):
+        if not host:
+            return False
+        labels = normalize_host(host).split(".")
+        node = self.root
+        i = len(labels)
+        while True:
+            kind = node.get(_RULE)
+            if kind:
+                if kind & SELF_AND_SUBS and i < len(labels):
+                    return True
+                if kind & SUBS_ONLY and i > 0:
+                    return True
+            if i == 0:
+                return False
+            i -= 1
+            node = node.get(labels[i])
+            if node is None:
+                return False
+
+    # value of the most specific matching rule, None when nothing matches
+    def lookup(self, host):
+        if not host:
+            return None
+        labels = normalize_host(host).split(".")
+        node = self.root
+        i = len(labels)
+        found = None
+        while True:
+            kind = node.get(_RULE)
+            if kind and (kind & SELF_AND_SUBS and i < len(labels) or kind & SUBS_ONLY and i > 0):
+                found = node[_VALUE]
+            if i == 0:
+                return found
+            i -= 1
+            node = node.get(labels[i])
+            if node is None:
+                return found
+
+    def __contains__(self, host):
+        return self.match(host)
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,402 @@
+# Large blocklists: importers for hosts files and adblock lists, a compiled index that is
+# memory-mapped read-only (so worker processes share the page cache instead of each
+# holding a copy), and an append-only delta log for single edits.
+#   python blockstore.py import [--replace] [-o blocked_hosts.json] LIST...
+import os
+import sys
+import mmap
+import array
+import struct
+import zlib
+from blocklist import DomainMatcher, parse_rule, normalize_host, SELF_AND_SUBS, SUBS_ONLY
+
+MAGIC = b"TPBL"
+_HEADER = struct.Struct("=4sIIIII")  # magic, byte order marker, entries, rules, table slots, string blob size
+_ORDER = 0x01020304
+# names hosts files map to loopback for the machine itself
+_LOCAL_NAMES = {"localhost", "localhost.localdomain", "local", "broadcasthost", "ip6-localhost", "ip6-loopback",
+                "ip6-localnet", "ip6-mcastprefix", "ip6-allnodes", "ip6-allrouters", "ip6-allhosts", "0.0.0.0"}
+# delta entries before save() folds them into the index
+COMPACT_AFTER = 4096
+
+
+# a rule as (domain, kind): "example.com" -> ("example.com", SELF_AND_SUBS), "*" -> ("", SUBS_ONLY)
+def split_rule(rule):
+    labels, kind = parse_rule(rule)
+    if labels is None:
+        return None, 0
+    return ".".join(labels), kind
+
+
+def canonical(rule):
+    name, kind = split_rule(rule)
+    if not kind:
+        return None
+    return _rule(name, kind)
+
+
+def _rule(name, kind):
+    if kind == SELF_AND_SUBS:
+        return name
+    return "*." + name if name else "*"
+
+
+# ====== Importers ======
+# One line of a hosts file ("0.0.0.0 ads.example.com"), an adblock list ("||ads.example.com^",
+# options ignored; exceptions, element hiding and path rules skipped) or a plain domain list.
+def parse_line(line):
+    line = line.strip()
+    if not line or line[0] in "!#[" or "##" in line or "#@#" in line or "#?#" in line or line.startswith("@@"):
+        return []
+    if line.startswith("||"):
+        body = line[2:].split("$", 1)[0]
+        if body.endswith("^|"):
+            body = body[:-2]
+        elif body.endswith("^"):
+            body = body[:-1]
+        return [body] if _domain(body) else []
+    fields = line.split("#", 1)[0].split()
+    if len(fields) > 1 and (":" in fields[0] or fields[0].replace(".", "").isdigit()):
+        fields = fields[1:]
+    elif len(fields) != 1:
+        return []
+    return [f for f in fields if _domain(f)]
+
+
+def _domain(name):
+    name = name.lower()
+    if name in _LOCAL_NAMES or "." not in name.strip("."):
+        return False
+    return all(c.isalnum() or c in "-._" for c in name.lstrip("*").lstrip("."))
+
+
+def read_list(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            yield from parse_line(line)
+
+
+# ====== Compiled index ======
+# One entry per domain with the kinds of rule on it, found through an open addressing table
+# keyed by crc32, so a lookup is a probe or two into the mapped arrays plus a string compare
+# (the hash only narrows it down). Entries are sorted, so listing is alphabetical.
+# Layout: header, table slots (entry + 1, 0 = empty), hashes, count + 1 offsets, kinds, strings.
+def write_index(path, rules):
+    kinds = {}
+    for rule in rules:
+        name, kind = split_rule(rule)
+        if kind:
+            kinds[name] = kinds.get(name, 0) | kind
+    names = sorted(kinds)
+    slots = 2 * len(names) + 1
+    table = array.array("I", bytes(4 * slots))
+    hashes = array.array("I")
+    offsets = array.array("I", [0])
+    blob = bytearray()
+    for i, name in enumerate(names):
+        key = name.encode()
+        h = zlib.crc32(key)
+        slot = h % slots
+        while table[slot]:
+            slot = slot + 1 if slot + 1 < slots else 0
+        table[slot] = i + 1
+        hashes.append(h)
+        blob += key
+        offsets.append(len(blob))
+    rule_count = sum(bin(k).count("1") for k in kinds.values())
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, _ORDER, len(names), rule_count, slots, len(blob)))
+        for part in (table, hashes, offsets):
+            f.write(part.tobytes())
+        f.write(bytes(kinds[n] for n in names)); f.write(blob)
+        f.flush(); os.fsync(f.fileno())
+    # path is a new generation (see BlockStore), nothing has it mapped yet
+    os.replace(tmp, path)
+    return rule_count
+
+
+class Index:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, order, self.count, self.rules, self.slots, size = _HEADER.unpack_from(self.map)
+        if magic != MAGIC or order != _ORDER:
+            raise ValueError(f"{path} is not a blocklist index for this machine")
+        view = memoryview(self.map)
+        start = _HEADER.size
+        self.table = view[start:start + 4 * self.slots].cast("I")
+        start += 4 * self.slots
+        self.hashes = view[start:start + 4 * self.count].cast("I")
+        start += 4 * self.count
+        self.offsets = view[start:start + 4 * self.count + 4].cast("I")
+        start += 4 * self.count + 4
+        self.kinds = view[start:start + self.count]
+        self.blob = start + self.count
+
+    def _key(self, i):
+        return self.map[self.blob + self.offsets[i]:self.blob + self.offsets[i + 1]]
+
+    # the rule kinds on a domain, 0 for none
+    def kind(self, name):
+        key = name.encode()
+        h = zlib.crc32(key)
+        slot = h % self.slots
+        while True:
+            i = self.table[slot]
+            if not i:
+                return 0
+            i -= 1
+            if self.hashes[i] == h and self._key(i) == key:
+                return self.kinds[i]
+            slot = slot + 1 if slot + 1 < self.slots else 0
+
+    def __contains__(self, rule):
+        name, kind = split_rule(rule)
+        return bool(kind and self.kind(name) & kind)
+
+    def __iter__(self):
+        for i in range(self.count):
+            name = self._key(i).decode()
+            kind = self.kinds[i]
+            if kind & SELF_AND_SUBS:
+                yield name
+            if kind & SUBS_ONLY:
+                yield _rule(name, SUBS_ONLY)
+
+    def __len__(self):
+        return self.rules
+
+
+class _EmptyIndex:
+    count = 0
+    path = None
+    def kind(self, name): return 0
+    def __contains__(self, rule): return False
+    def __iter__(self): return iter(())
+    def __len__(self): return 0
+
+
+# ====== Block store ======
+# index + delta log, both derived from one base path: blocked_hosts.json keeps its rules in
+# blocked_hosts.idx and blocked_hosts.delta. A JSON list from before is imported once.
+# Readers (worker processes) call refresh() to pick up a new index or new delta lines.
+# An index is never replaced in place, Windows refuses to replace or delete a file that is
+# mapped, by this process or a worker: every rewrite is a new generation
+# (blocked_hosts.1.idx, .2.idx, ...), and older ones are removed once nothing maps them.
+class BlockStore:
+    def __init__(self, path):
+        base = os.path.splitext(path)[0]
+        self.json_path = path
+        self.directory, self.base = os.path.split(os.path.abspath(base))
+        self.delta_path = base + ".delta"
+        self.index = _EmptyIndex()
+        self._clear_delta()
+        self._delta_inode = None
+
+    # [(generation, path)] of the index files on disk, oldest first; blocked_hosts.idx is 0
+    def _generations(self):
+        found = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return found
+        prefix = self.base + "."
+        for name in names:
+            if name.startswith(prefix) and name.endswith(".idx"):
+                gen = name[len(prefix):-4]
+                if not gen or gen.isdigit():
+                    found.append((int(gen or 0), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    # the newest index file, None when there is none yet
+    @property
+    def index_path(self):
+        generations = self._generations()
+        return generations[-1][1] if generations else None
+
+    def _next_path(self):
+        generations = self._generations()
+        gen = generations[-1][0] + 1 if generations else 0
+        return os.path.join(self.directory, f"{self.base}.{gen}.idx" if gen else f"{self.base}.idx")
+
+    # older generations; one still mapped somewhere (on Windows) is left for a later call
+    def _remove_old(self):
+        for _, path in self._generations()[:-1]:
+            if path != self.index.path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # the delta applies to one index; a new index starts without one
+    def _clear_delta(self):
+        self.added, self.removed = {}, set()
+        self._added_matcher = DomainMatcher()
+        self._delta_pos = 0
+
+    def load(self):
+        if self.index_path is None and os.path.exists(self.json_path):
+            import json
+            with open(self.json_path) as f:
+                write_index(self._next_path(), json.load(f))
+        self.index = _EmptyIndex()
+        self._clear_delta()
+        self.refresh()
+        return self
+
+    def refresh(self):
+        path = self.index_path
+        if path and path != self.index.path:
+            # a new index includes every delta written before it, which was then truncated;
+            # the old mapping goes with the last reference to it
+            self.index = Index(path)
+            self._clear_delta()
+            self._remove_old()
+        delta = _stat(self.delta_path)
+        if delta is None or delta.st_ino != self._delta_inode or delta.st_size < self._delta_pos:
+            self._delta_pos = 0
+            self._delta_inode = delta and delta.st_ino
+        if delta and delta.st_size > self._delta_pos:
+            with open(self.delta_path, "rb") as f:
+                f.seek(self._delta_pos)
+                data = f.read()
+            # a line still being appended is picked up next time
+            data = data[:data.rfind(b"\n") + 1]
+            self._delta_pos += len(data)
+            for line in data.decode("utf-8", "replace").splitlines():
+                self._apply(line[:1], line[1:])
+            self._added_matcher = DomainMatcher(self.added)
+
+    def _apply(self, op, key):
+        if op == "+":
+            self.removed.discard(key)
+            if key not in self.index:
+                self.added[key] = True
+        elif op == "-":
+            self.added.pop(key, None)
+            if key in self.index:
+                self.removed.add(key)
+
+    def __contains__(self, rule):
+        key = canonical(rule)
+        if not key:
+            return False
+        if key in self.added:
+            return True
+        return key in self.index and key not in self.removed
+
+    def _log(self, op, key):
+        with open(self.delta_path, "a", encoding="utf-8") as f:
+            f.write(op + key + "\n")
+        self._delta_pos += len((op + key + "\n").encode())
+        self._delta_inode = _stat(self.delta_path).st_ino
+        self._apply(op, key)
+
+    def add(self, rule):
+        key = canonical(rule)
+        if not key or key in self:
+            return False
+        self._log("+", key)
+        self._added_matcher = DomainMatcher(self.added)
+        return True
+
+    def remove(self, rule):
+        key = canonical(rule)
+        if not key or key not in self:
+            return False
+        self._log("-", key)
+        self._added_matcher = DomainMatcher(self.added)
+        return True
+
+    def match(self, host):
+        if not host:
+            return False
+        if self._added_matcher.size and self._added_matcher.match(host):
+            return True
+        if not self.index.count:
+            return False
+        labels = normalize_host(host).split(".")
+        n = len(labels)
+        # the host itself, every parent domain and the root ("*"), same rules as the trie walk
+        for i in range(n + 1):
+            name = ".".join(labels[i:])
+            kind = self.index.kind(name)
+            if kind & SELF_AND_SUBS and i < n and (not self.removed or name not in self.removed):
+                return True
+            if kind & SUBS_ONLY and i > 0 and (not self.removed or _rule(name, SUBS_ONLY) not in self.removed):
+                return True
+        return False
+
+    def __iter__(self):
+        for key in self.index:
+            if key not in self.removed:
+                yield key
+        yield from self.added
+
+    def __len__(self):
+        return len(self.index) - len(self.removed) + len(self.added)
+
+    def pending(self):
+        return len(self.added) + len(self.removed)
+
+    # folds the delta into a new index; readers switch over on their next refresh()
+    def compact(self):
+        path = self._next_path()
+        write_index(path, list(self))
+        try:
+            os.remove(self.delta_path)
+        except FileNotFoundError:
+            pass
+        self.index = Index(path)
+        self._remove_old()
+        self._clear_delta()
+        self._delta_inode = None
+
+    def save(self):
+        if self.pending() >= COMPACT_AFTER:
+            self.compact()
+
+    # true when one of the lists changed after the index was compiled
+    def outdated(self, paths):
+        index = self.index_path and _stat(self.index_path)
+        return not index or any(os.stat(p).st_mtime_ns > index.st_mtime_ns for p in paths)
+
+    # merges (or with replace, swaps in) the rules of hosts, adblock or plain domain lists
+    def import_lists(self, paths, replace=False):
+        rules = [] if replace else list(self)
+        for path in paths:
+            rules.extend(read_list(path))
+        count = write_index(self._next_path(), rules)
+        try:
+            os.remove(self.delta_path)
+        except FileNotFoundError:
+            pass
+        self.load()
+        return count
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile blocklists into the proxy's blocklist index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="import hosts files, adblock lists or plain domain lists")
+    imp.add_argument("lists", nargs="+")
+    imp.add_argument("-o", "--output", default="blocked_hosts.json", help="blocklist path (blocked_file)")
+    imp.add_argument("--replace", action="store_true", help="drop the current rules instead of merging")
+    args = parser.parse_args(argv)
+    store = BlockStore(args.output).load()
+    count = store.import_lists(args.lists, args.replace)
+    print(f"{count} rules in {store.index_path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import threading
+
+PT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tor_bundle/tor/pluggable_transports/pt_config.json")
+
+
+# ====== Bridge lines ======
+def load_catalog(path=PT_CONFIG):
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [line for lines in config.get("bridges", {}).values() for line in lines]
+
+
+def bridge_lines(text):
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("Bridge "):
+            line = line[len("Bridge "):].strip()
+        if line and not line.startswith("#"):
+            lines.append(line)
+    return lines
+
+
+# a vanilla bridge line starts with its address, a pluggable transport line with the transport name
+def transport(line):
+    first = line.split()[0]
+    return "vanilla" if ":" in first else first
+
+
+def _split_addr(addr):
+    host, _, port = addr.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+# (host, port, tls server name or None). Domain fronted transports carry a placeholder
+# address; what has to be reachable is the front, over TLS.
+def probe_target(line):
+    fields = line.split()
+    options = dict(f.split("=", 1) for f in fields if "=" in f)
+    front = options.get("front") or options.get("fronts", "").split(",")[0]
+    if front:
+        return front, 443, front
+    if transport(line) == "webtunnel" and "url" in options:
+        host = options["url"].split("://", 1)[-1].split("/", 1)[0]
+        return host, 443, host
+    addr = fields[0] if transport(line) == "vanilla" else fields[1]
+    host, port = _split_addr(addr)
+    return host, port, None
+
+
+# ====== Prober ======
+# Connect latency of many bridges at once; results are cached on disk so a restart
+# inside the TTL needs no network round trips at all. asyncio and ssl are imported only for a probe,
+# tor imports this module for the bridge line helpers and the threaded engine never needs it.
+class BridgeProber:
+    def __init__(self, cache_file=None, catalog=None, per_transport=2, timeout=5.0, concurrency=32,
+                 ttl=6 * 3600, failure_ttl=600):
+        self.cache_file = cache_file
+        self.per_transport = per_transport
+        self.catalog = load_catalog() if catalog is None else catalog
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.results = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.cache_file: return
+        try:
+            with open(self.cache_file) as f:
+                self.results = json.load(f)
+        except (OSError, ValueError):
+            self.results = {}
+
+    def _save(self):
+        if not self.cache_file: return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        with open(self.cache_file + ".tmp", "w") as f:
+            json.dump(self.results, f)
+        os.replace(self.cache_file + ".tmp", self.cache_file)
+
+    def _expired(self, result, now):
+        ttl = self.ttl if result["latency"] is not None else self.failure_ttl
+        return now - result["time"] > ttl
+
+    # returns {line: latency in seconds or None when unreachable}
+    def probe(self, lines, force=False):
+        with self.lock:
+            now = time.time()
+            stale = [line for line in dict.fromkeys(lines)
+                     if force or line not in self.results or self._expired(self.results[line], now)]
+            if stale:
+                import asyncio
+                for line, latency in zip(stale, asyncio.run(self._probe_all(stale))):
+                    self.results[line] = {"latency": latency, "time": time.time()}
+                self._save()
+            return {line: self.results[line]["latency"] for line in lines}
+
+    async def _probe_all(self, lines):
+        import ssl
+        import asyncio
+        limit = asyncio.Semaphore(self.concurrency)
+        # loading the CA store blocks the loop for tens of ms, so it is done once and untimed
+        context = ssl.create_default_context()
+        async def one(line):
+            async with limit:
+                return await self._probe(line, context)
+        return await asyncio.gather(*(one(line) for line in lines))
+
+    async def _probe(self, line, context):
+        import ssl
+        import asyncio
+        try:
+            host, port, server_name = probe_target(line)
+        except (ValueError, IndexError):
+            return None
+        if not server_name:
+            context = None
+        started = time.monotonic()
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context, server_hostname=server_name), self.timeout)
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None
+        latency = time.monotonic() - started
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        return latency
+
+    # the catalog plus the given lines, reachable ones only, fastest per_transport of each transport
+    def fastest(self, lines=(), per_transport=None):
+        per_transport = per_transport or self.per_transport
+        candidates = list(dict.fromkeys(list(lines) + self.catalog))
+        latencies = self.probe(candidates)
+        ranked = sorted((latency, line) for line, latency in latencies.items() if latency is not None)
+        chosen, counts = [], {}
+        for latency, line in ranked:
+            kind = transport(line)
+            if counts.get(kind, 0) < per_transport:
+                counts[kind] = counts.get(kind, 0) + 1
+                chosen.append(line)
+        return chosen
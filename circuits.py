@@ -0,0 +1,70 @@
+import os
+import time
+import itertools
+from collections import deque
+
+# SOCKS5 replies worth another circuit: general failure (circuit or exit trouble), host
+# unreachable (exit could not resolve or reach it), TTL expired (tor gave up waiting).
+# Refused (5) and not allowed (2) are the destination's or exit policy's answer.
+RETRYABLE_REPLIES = (1, 4, 6)
+
+
+# ====== Connect policy ======
+# How the engines open streams through tor. A failed connect is retried on a fresh circuit:
+# tor isolates streams by SOCKS username (IsolateSOCKSAuth is on by default), so a new
+# username forces a new circuit. With hedging, a connect still pending after the
+# `quantile` of recent connect times races a second one on another circuit.
+# per_destination: seconds; each destination gets its own circuit, replaced that often
+class ConnectPolicy:
+    def __init__(self, retries=1, hedge=False, quantile=0.9, hedge_min=0.5, hedge_max=10.0, window=256, per_destination=None):
+        self.retries = retries
+        self.per_destination = per_destination
+        self.hedge = hedge
+        self.quantile = quantile
+        self.hedge_min = hedge_min
+        self.hedge_max = hedge_max
+        self.min_samples = 20
+        self.samples = deque(maxlen=window)
+        self._ids = itertools.count(1)
+        self._delay = hedge_max
+        self._stale = 0
+
+    # unique across worker processes too
+    def isolation(self):
+        return f"torproxy-{os.getpid()}-{next(self._ids)}"
+
+    # username for the first attempt: None shares tor's usual circuit
+    def circuit(self, host):
+        if not self.per_destination:
+            return None
+        # the same in every worker process, so a destination stays on one circuit
+        return f"torproxy-{host}-{int(time.time() // self.per_destination)}"
+
+    # constructor arguments, to rebuild the same policy in a worker process
+    def settings(self):
+        return {"retries": self.retries, "hedge": self.hedge, "quantile": self.quantile,
+                "hedge_min": self.hedge_min, "hedge_max": self.hedge_max, "window": self.samples.maxlen,
+                "per_destination": self.per_destination}
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self._stale += 1
+
+    # seconds to wait before hedging, None when hedging is off
+    def hedge_delay(self):
+        if not self.hedge:
+            return None
+        # re-sorting a few hundred floats per connect is cheap, but there is no need to
+        if self._stale >= 16 and len(self.samples) >= self.min_samples:
+            # deque.copy() runs without releasing the GIL, so recording threads cannot break it
+            ordered = sorted(self.samples.copy())
+            self._stale = 0
+            value = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+            self._delay = min(self.hedge_max, max(self.hedge_min, value))
+        return self._delay
+
+
+def policy_from_config(config):
+    per_destination = config["rotation_interval"] if config["rotation"] == "destination" else None
+    return ConnectPolicy(config["connect_retries"], config["hedge_connects"], config["hedge_quantile"],
+                         per_destination=per_destination)
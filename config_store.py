@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import tempfile
+import threading
+
+_MISSING = object()
+
+
+def atomic_write(path, text):
+    # a crash leaves either the old file or the new one, never a half written one
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".config-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# ====== Config store ======
+# Settings live in memory; set() only updates the dict, tells subscribers what changed and
+# (re)arms a timer. The file is written from the timer thread once edits stop for `delay`
+# seconds, or at the latest `max_delay` seconds after the first unsaved one, so typing into
+# a settings field costs no disk I/O on the UI thread. flush() writes immediately.
+class ConfigStore:
+    def __init__(self, path, defaults=None, delay=0.5, max_delay=5.0):
+        self.path = path
+        self.defaults = defaults or {}
+        self.delay = delay
+        self.max_delay = max_delay
+        self.data = {}
+        self.writes = 0
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._timer = None
+        self._dirty_since = None
+        self._due = 0.0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except (OSError, ValueError) as e:
+            print(f"config: cannot read {self.path}: {e}", flush=True)
+            data = {}
+        with self._lock:
+            self.data = data if isinstance(data, dict) else {}
+            return self.data
+
+    def get(self, name, default=None):
+        value = self.data.get(name, _MISSING)
+        if value is _MISSING:
+            return self.defaults.get(name, default)
+        return value
+
+    def set(self, name, value):
+        return self.update({name: value})
+
+    # returns the keys that actually changed, with their new values
+    def update(self, changes):
+        with self._lock:
+            changed = {k: v for k, v in changes.items() if self.data.get(k, _MISSING) != v}
+            if not changed:
+                return changed
+            self.data.update(changed)
+            self._schedule()
+            subscribers = list(self._subscribers)
+        for callback, keys in subscribers:
+            delta = changed if keys is None else {k: v for k, v in changed.items() if k in keys}
+            if delta:
+                callback(delta)
+        return changed
+
+    # callback(changes) runs on the thread that made the change; keys limits it to those settings
+    def subscribe(self, callback, keys=None):
+        with self._lock:
+            self._subscribers.append((callback, frozenset(keys) if keys is not None else None))
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[0] is not callback]
+
+    # one timer per burst: an edit only moves the deadline, the timer re-arms itself if it
+    # fires before it, instead of a new thread per keystroke
+    def _schedule(self):
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        self._due = min(now + self.delay, self._dirty_since + self.max_delay)
+        if self._timer is None:
+            self._arm(self._due - now)
+
+    def _arm(self, delay):
+        self._timer = threading.Timer(delay, self._fire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            left = self._due - time.monotonic()
+            if left > 0 and self._timer is not None:
+                self._arm(left)
+                return
+        self.flush()
+
+    def flush(self):
+        # snapshots are taken and written in order, so an older one never replaces a newer one
+        with self._write_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                if self._dirty_since is None:
+                    return False
+                self._dirty_since = None
+                text = json.dumps(self.data, indent=2)
+            try:
+                atomic_write(self.path, text)
+            except OSError as e:
+                print(f"config: cannot write {self.path}: {e}", flush=True)
+                with self._lock:
+                    if self._dirty_since is None:
+                        self._dirty_since = time.monotonic()
+                return False
+            self.writes += 1
+            return True
@@ -0,0 +1,125 @@
+import time
+import threading
+from metrics import METRICS
+
+# circuits built this soon after a NEWNYM are counted as caused by the rotation
+ROTATION_WINDOW = 30.0
+
+
+# ====== Rotation policy ======
+# interval: NEWNYM every `interval` seconds
+# idle: the same, but held back while tor has streams open, so nothing in use is torn down
+# destination: no NEWNYM; every destination gets its own circuit (circuits.ConnectPolicy),
+#   replaced every `interval` seconds
+# manual: only on demand (the change identity button, new_identity())
+class RotationPolicy:
+    modes = ("interval", "idle", "destination", "manual")
+
+    def __init__(self, mode="idle", interval=300.0):
+        if mode not in self.modes:
+            raise ValueError(f"unknown rotation mode: {mode}")
+        self.mode = mode
+        self.interval = interval
+
+    def due(self, since_last):
+        return self.mode in ("interval", "idle") and since_last >= self.interval
+
+
+def rotation_from_config(config):
+    return RotationPolicy(config["rotation"], config["rotation_interval"])
+
+
+# ====== Control session ======
+# One control-port connection per TorRunner, kept open and reopened when tor restarts,
+# instead of a new connection and authentication for every command. A background thread
+# applies the rotation policy and counts the circuits tor builds.
+class ControlSession:
+    def __init__(self, runner, rotation=None):
+        self.runner = runner
+        self.rotation = rotation or RotationPolicy()
+        self.controller = None
+        self.port = None
+        self.last_rotation = time.monotonic()
+        self.rotations = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread: self._thread.join(); self._thread = None
+        self._disconnect()
+
+    # the live controller, connecting first if needed; None while tor is not reachable.
+    # port: connect there even before the runner counts as running (reattaching to a tor)
+    def connect(self, port=None):
+        with self._lock:
+            if self.controller is not None and self.controller.is_alive() and port in (None, self.port):
+                return self.controller
+            self._disconnect()
+            if port is None and not self.runner.running():
+                return None
+            port = port or self.runner.contorl_port
+            from stem.control import EventType
+            try:
+                controller = self.runner._controller(port)
+                controller.add_event_listener(self._circuit_event, EventType.CIRC)
+            except Exception:
+                return None
+            self.controller = controller
+            self.port = port
+            return controller
+
+    def disconnect(self):
+        with self._lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self.controller is not None:
+            try:
+                self.controller.close()
+            except Exception:
+                pass
+            self.controller = None
+
+    # NEWNYM: new streams go on fresh circuits; tor rate limits it to one every 10 seconds
+    def new_identity(self, reason="manual"):
+        from stem import Signal as TorSignal
+        controller = self.connect()
+        if controller is None:
+            return False
+        try:
+            controller.signal(TorSignal.NEWNYM)
+        except Exception:
+            return False
+        self.last_rotation = time.monotonic()
+        self.rotations += 1
+        METRICS.inc("torproxy_identity_rotations_total", labels=(("reason", reason),))
+        return True
+
+    def idle(self):
+        controller = self.connect()
+        try:
+            return controller is not None and not controller.get_info("stream-status", "").strip()
+        except Exception:
+            return False
+
+    def _circuit_event(self, event):
+        if event.status != "BUILT" or event.purpose != "GENERAL":
+            return
+        cause = "rotation" if time.monotonic() - self.last_rotation < ROTATION_WINDOW and self.rotations else "other"
+        METRICS.inc("torproxy_circuit_builds_total", labels=(("cause", cause),))
+
+    def _loop(self):
+        while not self._stop.wait(1):
+            if self.connect() is None or not self.runner.ready():
+                continue
+            if self.rotation.due(time.monotonic() - self.last_rotation) and (self.rotation.mode != "idle" or self.idle()):
+                self.new_identity(self.rotation.mode)
@@ -0,0 +1,153 @@
+# Headless entry point: runs the proxy (and optionally tor and the DNS cache) from a
+# config file without importing Qt.
+#   python daemon.py -c torproxy.json
+import os
+import json
+import signal
+import argparse
+import threading
+from defaults import DEFAULTS
+
+
+def load_config(path):
+    config = dict(DEFAULTS)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+class Daemon:
+    def __init__(self, config):
+        self.config = config
+        self.tor = None; self.proxy = None; self.dns = None; self.metrics = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        import proxy
+        from tor import TorRunner, TorPool, Runner
+        from logpipe import LOG
+        config = self.config
+        LOG.path = config["log_file"]
+        if not config["quiet"]:
+            LOG.add_sink(lambda lines: print("\n".join(lines), flush=True))
+        LOG.start()
+        if config["blocked_file"]:
+            proxy.BLOCKED_FILE = config["blocked_file"]
+        proxy.load_blocked()
+        if config["blocklists"] and proxy.blocked.outdated(config["blocklists"]):
+            count = proxy.blocked.import_lists(config["blocklists"])
+            print(f"{count} blocked rules compiled from {len(config['blocklists'])} lists", flush=True)
+
+        data_dir = os.path.join("tor_data", config["tor_profile"])
+        if not config["tor"]:
+            # an externally managed tor, e.g. the system service
+            tor_route = config["tor_socks_port"] or 9050
+        elif config["tor_instances"] > 1:
+            self.tor = TorPool(config["tor_instances"], base_dir=data_dir, strategy=config["tor_strategy"])
+            tor_route = self.tor
+        else:
+            get_port = proxy.get_free_port
+            self.tor = TorRunner(config["tor_socks_port"] or get_port(), get_port(), get_port(), data_dir=data_dir)
+            self.tor.on_progress = lambda runner: print(f"tor bootstrapped {runner.progress}%", flush=True)
+            tor_route = self.tor
+        if self.tor:
+            self.tor.bridge = config["bridge"]
+            self.tor.bridges = config["bridges"]
+            self.tor.keep_alive = config["keep_tor_warm"]
+            from control import rotation_from_config
+            self.tor.rotation = rotation_from_config(config)
+            if config["bridge_auto"]:
+                from bridges import BridgeProber
+                self.tor.bridge_prober = BridgeProber(os.path.join("tor_data", "bridge_probes.json"),
+                                                      per_transport=config["bridges_per_transport"])
+
+        http_cache = None
+        if config["http_cache_mb"]:
+            from http_cache import HTTPCache
+            http_cache = HTTPCache(max_bytes=config["http_cache_mb"] << 20)
+
+        from admission import limits_from_config
+        from circuits import policy_from_config
+        from routes import routes_from_config
+        from shaping import shaper_from_config
+        from profiling import profiling_from_config
+        profiling_from_config(config)
+        shaper = shaper_from_config(config)
+        if self.tor:
+            self.tor.bandwidth_rate = shaper.tor_rate()
+        self.proxy = Runner(config["listen_port"], tor_route, None, engine=config["engine"], http_cache=http_cache,
+                            socks_port=config["socks_listen_port"] or None, limits=limits_from_config(config),
+                            workers=config["workers"], connect_policy=policy_from_config(config),
+                            routes=routes_from_config(config), shaper=shaper)
+        # workers are handed tor's SOCKS port when they start, and a reattached tor keeps its old ports
+        if self.tor and config["workers"] > 1:
+            self.tor.start()
+        self.proxy.start()
+        workers = f", {config['workers']} workers" if config["workers"] > 1 else ""
+        print(f"proxy listening on port {self.proxy.server.server_address[1]} ({config['engine']}{workers})", flush=True)
+        if self.proxy.socks_server:
+            print(f"socks listening on port {self.proxy.socks_server.server_address[1]}", flush=True)
+        if self.tor:
+            self.tor.start()
+        if config["metrics_port"]:
+            from metrics import MetricsServer
+            self.metrics = MetricsServer(config["metrics_port"])
+            self.metrics.start()
+            print(f"metrics on http://127.0.0.1:{self.metrics.port}/metrics", flush=True)
+        if config["dns_port"] and self.tor:
+            from dns_cache import DNSProxy
+            # read after start: a reattached tor keeps the ports it was started with
+            tor_dns_port = self.tor.runners[0].dns_port if isinstance(self.tor, TorPool) else self.tor.dns_port
+            self.dns = DNSProxy(config["dns_port"], tor_dns_port, host="0.0.0.0")
+            self.dns.start()
+
+    def stop(self):
+        if self.metrics: self.metrics.stop()
+        if self.dns: self.dns.stop()
+        if self.proxy: self.proxy.stop()
+        if self.tor:
+            if self.config["keep_tor_warm"]: self.tor.detach()
+            else: self.tor.stop()
+        from logpipe import LOG
+        LOG.close()
+        self.stopped.set()
+
+    # passes SIGUSR1 on to the worker processes, which profile themselves
+    def forward_signal(self, signum):
+        pids = getattr(self.proxy and self.proxy.server, "pids", None)
+        for pid in pids() if pids else ():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def wait(self):
+        while not self.stopped.wait(1):
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TorProxy without the GUI")
+    parser.add_argument("-c", "--config", help="JSON config file")
+    parser.add_argument("-p", "--port", type=int, help="override listen_port")
+    parser.add_argument("--no-tor", action="store_true", help="use an already running tor on tor_socks_port")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    if args.port is not None:
+        config["listen_port"] = args.port
+    if args.no_tor:
+        config["tor"] = False
+
+    daemon = Daemon(config)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: threading.Thread(target=daemon.stop).start())
+    from profiling import install_signal
+    install_signal(lambda: daemon.forward_signal(signal.SIGUSR1))
+    daemon.start()
+    daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Setting defaults shared by the daemon, the UI and the modules that use them. Kept free of
+# imports so reading the config costs nothing at startup.
+# The JSON config of the headless daemon takes the keys of DEFAULTS; the UI adds its own.
+
+# tunnels to these ports are always interactive for bandwidth shaping (ssh, telnet, dns, rdp, xmpp, vnc, irc)
+DEFAULT_INTERACTIVE_PORTS = (22, 23, 53, 3389, 5222, 5900, 6667, 6697)
+
+DEFAULTS = {
+    "listen_port": 8080,
+    "socks_listen_port": 0,
+    "engine": "threaded",
+    "tor": True,
+    "tor_socks_port": 0,
+    "tor_instances": 1,
+    "tor_strategy": "least-active",
+    "bridge": False,
+    "bridges": "",
+    "dns_port": 0,
+    "http_cache_mb": 0,
+    "blocked_file": None,
+    "blocklists": [],
+    "tor_profile": "default",
+    "keep_tor_warm": False,
+    "bridge_auto": False,
+    "bridges_per_transport": 2,
+    "metrics_port": 0,
+    "log_file": None,
+    "quiet": False,
+    "max_connections": 2000,
+    "max_tunnels": 0,
+    "max_tunnels_per_client": 0,
+    "max_tunnels_per_host": 0,
+    "admission_wait": 0.0,
+    "connect_timeout": 60,
+    "handshake_timeout": 30,
+    "idle_timeout": 600,
+    "workers": 1,
+    "connect_retries": 1,
+    "hedge_connects": False,
+    "hedge_quantile": 0.9,
+    "rotation": "idle",
+    "rotation_interval": 300,
+    # nothing bypasses tor unless configured; see routes.RouteTable
+    "routes": [],
+    "bandwidth_up": 0,
+    "bandwidth_down": 0,
+    "bandwidth_per_client": 0,
+    "bandwidth_per_tunnel": 0,
+    "interactive_ports": list(DEFAULT_INTERACTIVE_PORTS),
+    "interactive_weight": 4,
+    "profile_dir": "profiles",
+    "phase_timing": False,
+}
@@ -0,0 +1,310 @@
+import time
+import struct
+import asyncio
+import threading
+from collections import OrderedDict
+
+TYPE_SOA = 6
+TYPE_OPT = 41
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+
+class DNSError(Exception):
+    pass
+
+
+# ====== Wire format ======
+def _skip_name(data, off):
+    while True:
+        if off >= len(data):
+            raise DNSError("truncated name")
+        n = data[off]
+        if n & 0xC0 == 0xC0:
+            return off + 2
+        if n == 0:
+            return off + 1
+        off += 1 + n
+
+
+def _read_name(data, off):
+    labels = []
+    jumps = 0
+    while True:
+        if off >= len(data):
+            raise DNSError("truncated name")
+        n = data[off]
+        if n & 0xC0 == 0xC0:
+            jumps += 1
+            if jumps > 16:
+                raise DNSError("compression loop")
+            off = ((n & 0x3F) << 8) | data[off + 1]
+            continue
+        if n == 0:
+            return ".".join(labels)
+        labels.append(data[off + 1:off + 1 + n].decode("latin-1"))
+        off += 1 + n
+
+
+def parse_query(data):
+    if len(data) < 12:
+        raise DNSError("short packet")
+    qid, flags, qd, an, ns, ar = struct.unpack("!HHHHHH", data[:12])
+    if qd != 1:
+        raise DNSError("exactly one question is supported")
+    end = _skip_name(data, 12)
+    qtype, qclass = struct.unpack("!HH", data[end:end + 4])
+    qname = _read_name(data, 12).lower()
+    # EDNS0 advertises a larger UDP payload size in the OPT record's class field
+    udp_size = 512
+    off = end + 4
+    try:
+        for _ in range(an + ns + ar):
+            off = _skip_name(data, off)
+            rtype, rclass, _, rdlen = struct.unpack("!HHIH", data[off:off + 10])
+            if rtype == TYPE_OPT:
+                udp_size = max(512, rclass)
+            off += 10 + rdlen
+    except (DNSError, struct.error):
+        pass
+    return qid, (qname, qtype, qclass), end + 4, udp_size
+
+
+# returns (ttl_offsets, original_ttls, cache_ttl) or None if the answer must not be cached
+def scan_response(data, negative_ttl):
+    qid, flags, qd, an, ns, ar = struct.unpack("!HHHHHH", data[:12])
+    rcode = flags & 0xF
+    if flags & 0x0200 or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return None
+    off = 12
+    for _ in range(qd):
+        off = _skip_name(data, off) + 4
+    offsets, ttls = [], []
+    answer_ttl, soa_ttl = None, None
+    for i in range(an + ns + ar):
+        off = _skip_name(data, off)
+        rtype, _, ttl, rdlen = struct.unpack("!HHIH", data[off:off + 10])
+        if rtype != TYPE_OPT:
+            offsets.append(off + 4); ttls.append(ttl)
+            if i < an:
+                answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+            elif i < an + ns and rtype == TYPE_SOA:
+                minimum = struct.unpack("!I", data[off + 10 + rdlen - 4:off + 10 + rdlen])[0]
+                soa_ttl = min(ttl, minimum)
+        off += 10 + rdlen
+    if rcode == RCODE_NOERROR and an:
+        return offsets, ttls, answer_ttl
+    return offsets, ttls, soa_ttl if soa_ttl is not None else negative_ttl
+
+
+def truncated(data, question_end):
+    qid, flags = struct.unpack("!HH", data[:4])
+    return struct.pack("!HHHHHH", qid, flags | 0x0200, 1, 0, 0, 0) + data[12:question_end]
+
+
+def servfail(query, question_end):
+    qid, flags = struct.unpack("!HH", query[:4])
+    flags = (flags & 0x0100) | 0x8080 | RCODE_SERVFAIL
+    return struct.pack("!HHHHHH", qid, flags, 1, 0, 0, 0) + query[12:question_end]
+
+
+class _Entry:
+    __slots__ = ("data", "offsets", "ttls", "ttl", "stored", "hits")
+
+    def __init__(self, data, offsets, ttls, ttl):
+        self.data = data; self.offsets = offsets; self.ttls = ttls; self.ttl = ttl
+        self.stored = time.monotonic()
+        self.hits = 0
+
+    def remaining(self, now):
+        return self.ttl - (now - self.stored)
+
+    def render(self, qid, now):
+        age = int(now - self.stored)
+        out = bytearray(self.data)
+        out[0:2] = struct.pack("!H", qid)
+        for off, ttl in zip(self.offsets, self.ttls):
+            out[off:off + 4] = struct.pack("!I", max(0, ttl - age))
+        return bytes(out)
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future):
+        self.future = future
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+# ====== Resolver ======
+class DNSCache:
+    def __init__(self, upstream, max_entries=10000, negative_ttl=60, max_ttl=3600,
+                 timeout=5.0, prefetch=True, prefetch_hits=3, prefetch_ratio=0.1):
+        self.upstream = upstream
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.timeout = timeout
+        self.prefetch = prefetch
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_ratio = prefetch_ratio
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "prefetches": 0, "errors": 0}
+
+    async def resolve(self, query):
+        qid, key, question_end, udp_size = parse_query(query)
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None and entry.remaining(now) > 0:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            entry.hits += 1
+            if (self.prefetch and entry.hits >= self.prefetch_hits and key not in self.inflight
+                    and entry.remaining(now) < entry.ttl * self.prefetch_ratio):
+                self.stats["prefetches"] += 1
+                self._start_fetch(key, query)
+            return entry.render(qid, now), question_end, udp_size
+        if key in self.inflight:
+            self.stats["coalesced"] += 1
+            future = self.inflight[key]
+        else:
+            self.stats["misses"] += 1
+            future = self._start_fetch(key, query)
+        try:
+            data = await asyncio.shield(future)
+        except Exception:
+            self.stats["errors"] += 1
+            return servfail(query, question_end), question_end, udp_size
+        return struct.pack("!H", qid) + data[2:], question_end, udp_size
+
+    # concurrent identical questions wait on the same upstream query
+    def _start_fetch(self, key, query):
+        task = self.inflight[key] = asyncio.ensure_future(self._fetch(key, query))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _fetch(self, key, query):
+        try:
+            data = await self._ask(query)
+            try:
+                scanned = scan_response(data, self.negative_ttl)
+            except (DNSError, struct.error):
+                scanned = None
+            if scanned and scanned[2] > 0:
+                offsets, ttls, ttl = scanned
+                self.entries[key] = _Entry(data, offsets, ttls, min(ttl, self.max_ttl))
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return data
+        finally:
+            del self.inflight[key]
+
+    async def _ask(self, query):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            future = loop.create_future()
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UpstreamProtocol(future), remote_addr=self.upstream)
+            try:
+                transport.sendto(query)
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                if attempt:
+                    raise
+            finally:
+                transport.close()
+
+
+# ====== Listeners ======
+class _UDPServer(asyncio.DatagramProtocol):
+    def __init__(self, cache):
+        self.cache = cache
+        # the loop keeps only weak references to tasks; a pending reply must not be collected
+        self.tasks = set()
+    def connection_made(self, transport):
+        self.transport = transport
+    def datagram_received(self, data, addr):
+        task = asyncio.ensure_future(self._answer(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    async def _answer(self, data, addr):
+        try:
+            response, question_end, udp_size = await self.cache.resolve(data)
+        except (DNSError, struct.error):
+            return
+        if len(response) > udp_size:
+            response = truncated(response, question_end)
+        self.transport.sendto(response, addr)
+
+
+class DNSProxy:
+    def __init__(self, port, upstream_port, host="127.0.0.1", upstream_host="127.0.0.1", **cache_options):
+        self.host = host; self.port = port
+        self.cache = DNSCache((upstream_host, upstream_port), **cache_options)
+        self.loop = None; self.thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        if self.thread: return
+        self.loop = asyncio.new_event_loop()
+        self._ready.clear(); self._error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._ready.wait()
+        if self._error:
+            self.thread.join(); self.thread = None
+            raise self._error
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._listen())
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            self.loop.close()
+            return
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.udp.close(); self.tcp.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def _listen(self):
+        self.udp, _ = await self.loop.create_datagram_endpoint(
+            lambda: _UDPServer(self.cache), local_addr=(self.host, self.port))
+        self.port = self.udp.get_extra_info("sockname")[1]
+        self.tcp = await asyncio.start_server(self._tcp_client, self.host, self.port)
+
+    async def _tcp_client(self, reader, writer):
+        try:
+            while True:
+                (n,) = struct.unpack("!H", await reader.readexactly(2))
+                query = await reader.readexactly(n)
+                try:
+                    response, _, _ = await self.cache.resolve(query)
+                except (DNSError, struct.error):
+                    break
+                writer.write(struct.pack("!H", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def stop(self):
+        if not self.thread: return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(); self.thread = None
@@ -0,0 +1,416 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from http_stream import get_header
+
+# RFC 7234 4.2.2: status codes a cache may store without explicit freshness
+HEURISTIC_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+HEURISTIC_MAX = 24 * 3600
+PASS_TTL = 60
+# how long a miss waits for another request's fill of the same URL before fetching on its own
+FILL_WAIT = 1.0
+REPLACED_ON_304 = {"content-length", "transfer-encoding", "content-encoding", "content-range"}
+
+
+def cache_control(headers):
+    directives = {}
+    for k, v in headers:
+        if k.lower() != "cache-control":
+            continue
+        for part in v.split(","):
+            name, _, value = part.strip().partition("=")
+            if name:
+                directives[name.lower()] = value.strip().strip('"')
+    return directives
+
+
+def http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(status, headers):
+    cc = cache_control(headers)
+    if "no-cache" in cc:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if name in cc and _seconds(cc[name]) is not None:
+            return _seconds(cc[name])
+    date = http_date(get_header(headers, "Date"))
+    expires = get_header(headers, "Expires")
+    if expires is not None:
+        expires = http_date(expires)
+        return max(0, int(expires - (date or time.time()))) if expires else 0
+    last_modified = http_date(get_header(headers, "Last-Modified"))
+    if status in HEURISTIC_STATUSES and last_modified and date:
+        return min(HEURISTIC_MAX, max(0, int((date - last_modified) / 10)))
+    return 0
+
+
+def storable(method, status, req_headers, resp_headers):
+    if method != "GET" or status not in HEURISTIC_STATUSES:
+        return False
+    req_cc, resp_cc = cache_control(req_headers), cache_control(resp_headers)
+    if "no-store" in req_cc or "no-store" in resp_cc or "private" in resp_cc:
+        return False
+    if get_header(req_headers, "Authorization") and not ("public" in resp_cc or "s-maxage" in resp_cc):
+        return False
+    if get_header(resp_headers, "Set-Cookie") is not None:
+        return False
+    vary = get_header(resp_headers, "Vary", "")
+    if "*" in vary:
+        return False
+    if get_header(resp_headers, "Content-Range") is not None:
+        return False
+    explicit = any(d in resp_cc for d in ("max-age", "s-maxage", "public")) or get_header(resp_headers, "Expires")
+    return bool(explicit or get_header(resp_headers, "Last-Modified") or get_header(resp_headers, "ETag"))
+
+
+# ====== Entries ======
+class CacheEntry:
+    def __init__(self, key, meta, path):
+        self.key = key
+        self.meta = meta
+        self.path = path
+
+    @property
+    def headers(self): return [tuple(h) for h in self.meta["headers"]]
+    @property
+    def size(self): return self.meta["size"]
+
+    def age(self, now=None):
+        now = now or time.time()
+        return int(self.meta["initial_age"] + now - self.meta["response_time"])
+
+    def fresh(self, req_headers):
+        cc = cache_control(req_headers)
+        if "no-cache" in cc or (get_header(req_headers, "Pragma", "").lower() == "no-cache" and not cc):
+            return False
+        age = self.age()
+        lifetime = self.meta["lifetime"]
+        if "max-age" in cc and _seconds(cc["max-age"]) is not None:
+            lifetime = min(lifetime, _seconds(cc["max-age"]))
+        if "min-fresh" in cc and _seconds(cc["min-fresh"]) is not None:
+            age += _seconds(cc["min-fresh"])
+        return age < lifetime
+
+    def matches_vary(self, req_headers):
+        for name, value in self.meta["vary"].items():
+            if get_header(req_headers, name) != value:
+                return False
+        return True
+
+    def validators(self):
+        out = []
+        etag = get_header(self.headers, "ETag")
+        last_modified = get_header(self.headers, "Last-Modified")
+        if etag: out.append(("If-None-Match", etag))
+        if last_modified: out.append(("If-Modified-Since", last_modified))
+        return out
+
+    # the client's own conditional request, answered from the entry
+    def not_modified_for(self, req_headers):
+        inm = get_header(req_headers, "If-None-Match")
+        etag = get_header(self.headers, "ETag")
+        if inm is not None:
+            tags = [t.strip().lstrip("W/") for t in inm.split(",")]
+            return "*" in tags or (etag is not None and etag.lstrip("W/") in tags)
+        ims = http_date(get_header(req_headers, "If-Modified-Since"))
+        last_modified = http_date(get_header(self.headers, "Last-Modified"))
+        return bool(ims and last_modified and last_modified <= ims)
+
+
+class _Fill:
+    def __init__(self, cache, key, url, vary, status, reason, headers, request_time):
+        self.cache = cache; self.key = key; self.url = url; self.vary = vary
+        self.status = status; self.reason = reason; self.headers = headers
+        self.request_time = request_time
+        self.size = 0
+        self.tmp = cache._path(key) + f".tmp{threading.get_ident()}"
+        self.file = open(self.tmp, "wb")
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_object:
+            self.abort()
+            return
+        self.file.write(data)
+
+    def abort(self):
+        self.failed = True
+        if not self.file.closed:
+            self.file.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+    def commit(self):
+        if self.failed:
+            return None
+        self.file.close()
+        now = time.time()
+        date = http_date(get_header(self.headers, "Date"))
+        apparent = max(0, now - date) if date else 0
+        meta = {
+            "url": self.url, "status": self.status, "reason": self.reason,
+            "headers": self.headers, "vary": self.vary, "size": self.size,
+            "response_time": now, "initial_age": max(apparent, _seconds(get_header(self.headers, "Age")) or 0) + (now - self.request_time),
+            "lifetime": freshness_lifetime(self.status, self.headers),
+        }
+        try:
+            return self.cache._install(self.key, meta, self.tmp)
+        except OSError:
+            # the client has its response; only the entry is lost
+            self.abort()
+            return None
+
+
+# ====== Cache ======
+# Disk-backed, size-bounded LRU of GET responses. Bodies are sent with socket.sendfile.
+# A response with Vary is stored per value of the request headers it names: the URL's Vary
+# fields (from its latest stored response) pick the variant's key. Every stored body gets
+# a new file name, since Windows can neither replace nor delete a file another request is
+# still sending; one left behind is removed on the next start.
+class HTTPCache:
+    def __init__(self, directory="http_cache", max_bytes=256 * 1024 * 1024, max_object=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object = min(max_object, max_bytes)
+        self.index = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+        self._fills = {}
+        self._passes = {}
+        # URL key -> the request headers (lowercase, sorted) its stored response varies on
+        self._vary = {}
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "stores": 0,
+                         "evictions": 0, "passes": 0, "coalesced": 0, "bytes_served": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if ".tmp" in name:
+                os.remove(path)
+            elif name.endswith(".meta"):
+                try:
+                    with open(path) as f:
+                        meta = json.load(f)
+                    if os.path.getsize(self._path(meta["body"])) != meta["size"]:
+                        raise ValueError("size mismatch")
+                    entries.append((meta["response_time"], name[:-5], meta))
+                except (OSError, ValueError, KeyError, TypeError):
+                    self._unlink(name[:-5])
+        entries.sort(key=lambda e: e[0])
+        for _, key, meta in entries:
+            self.index[key] = meta
+            self.total += meta["size"]
+            self._vary_on(meta)
+        bodies = {meta["body"] for meta in self.index.values()}
+        for name in os.listdir(self.directory):
+            if "." not in name and name not in bodies:
+                _remove(self._path(name))
+        self._evict()
+
+    # varied: (name, value) pairs of the request headers a response varies on
+    @staticmethod
+    def key(url, varied=()):
+        text = url + "".join(f"\n{name}" + (f": {value}" if value is not None else "") for name, value in varied)
+        return hashlib.sha256(text.encode("utf-8", "surrogateescape")).hexdigest()
+
+    def _variant_key(self, url, req_headers):
+        names = self._vary.get(self.key(url))
+        return self.key(url, [(n, get_header(req_headers, n)) for n in names]) if names else self.key(url)
+
+    def _vary_on(self, meta):
+        url_key = self.key(meta["url"])
+        if meta["vary"]:
+            self._vary[url_key] = sorted(meta["vary"])
+        else:
+            self._vary.pop(url_key, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.index), bytes=self.total)
+
+    def lookup(self, url, req_headers):
+        with self.lock:
+            key = self._variant_key(url, req_headers)
+            meta = self.index.get(key)
+            if meta is None:
+                return None
+            self.index.move_to_end(key)
+        entry = CacheEntry(key, meta, self._path(meta["body"]))
+        return entry if entry.matches_vary(req_headers) else None
+
+    def passing(self, url):
+        expires = self._passes.get(self.key(url))
+        return expires is not None and expires > time.monotonic()
+
+    def mark_pass(self, url):
+        with self.lock:
+            self.counters["passes"] += 1
+            self._passes[self.key(url)] = time.monotonic() + PASS_TTL
+            if len(self._passes) > 10000:
+                now = time.monotonic()
+                self._passes = {k: v for k, v in self._passes.items() if v > now}
+
+    # Concurrent misses for one URL: the first caller fills, the rest wait and then read the
+    # entry. A waiter gives up after `timeout` seconds (fill.held is then False), and the
+    # filler releases early once the response turns out not to be stored.
+    def fill_lock(self, url, timeout=FILL_WAIT):
+        key = self.key(url)
+        with self.lock:
+            shared = self._fills.get(key)
+            if shared is None:
+                shared = self._fills[key] = _SharedFill(key)
+            else:
+                self.counters["coalesced"] += 1
+            shared.users += 1
+        return _FillLock(self, shared, timeout)
+
+    def _release_fill(self, shared):
+        with self.lock:
+            shared.users -= 1
+            if not shared.users:
+                del self._fills[shared.key]
+
+    def begin(self, url, req_headers, status, reason, headers, request_time):
+        vary = {}
+        for field in get_header(headers, "Vary", "").split(","):
+            field = field.strip()
+            if field:
+                vary[field.lower()] = get_header(req_headers, field)
+        key = self.key(url, sorted(vary.items()))
+        return _Fill(self, key, url, vary, status, reason, headers, request_time)
+
+    def refresh(self, entry, resp_headers, request_time):
+        # a 304 updates the stored headers and restarts the freshness clock
+        updated = {k.lower() for k, _ in resp_headers if k.lower() not in REPLACED_ON_304}
+        headers = [h for h in entry.headers if h[0].lower() not in updated]
+        headers += [(k, v) for k, v in resp_headers if k.lower() not in REPLACED_ON_304]
+        now = time.time()
+        meta = dict(entry.meta, headers=headers, response_time=now, initial_age=now - request_time,
+                    lifetime=freshness_lifetime(entry.meta["status"], headers))
+        with self.lock:
+            self.counters["revalidated"] += 1
+            if entry.key in self.index:
+                self.index[entry.key] = meta
+                self._write_meta(entry.key, meta)
+        entry.meta = meta
+
+    def _install(self, key, meta, tmp):
+        meta["body"] = f"{key}-{os.urandom(4).hex()}"
+        path = self._path(meta["body"])
+        os.replace(tmp, path)
+        with self.lock:
+            try:
+                self._write_meta(key, meta)
+            except OSError:
+                _remove(path)
+                raise
+            old = self.index.pop(key, None)
+            if old:
+                self.total -= old["size"]
+                _remove(self._path(old["body"]))
+            self.index[key] = meta
+            self.total += meta["size"]
+            self._vary_on(meta)
+            self.counters["stores"] += 1
+            self._evict()
+        return CacheEntry(key, meta, path)
+
+    def _write_meta(self, key, meta):
+        path = self._path(key) + ".meta"
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def _evict(self):
+        while self.total > self.max_bytes and self.index:
+            key, meta = self.index.popitem(last=False)
+            self.total -= meta["size"]
+            self.counters["evictions"] += 1
+            self._unlink(key, meta)
+        # URLs whose variants are all gone
+        if len(self._vary) > len(self.index):
+            self._vary = {}
+            for meta in self.index.values():
+                self._vary_on(meta)
+
+    # an entry's files; a body still being sent (Windows) stays until the next start
+    def _unlink(self, key, meta=None):
+        _remove(self._path(key) + ".meta")
+        if meta:
+            _remove(self._path(meta["body"]))
+
+    def open_body(self, entry):
+        try:
+            return open(entry.path, "rb")
+        except OSError:
+            return None
+
+    def served(self, nbytes):
+        with self.lock:
+            self.counters["hits"] += 1
+            self.counters["bytes_served"] += nbytes
+
+    def missed(self):
+        with self.lock:
+            self.counters["misses"] += 1
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _SharedFill:
+    def __init__(self, key):
+        self.key = key
+        self.users = 0
+        self.lock = threading.Lock()
+
+
+# one caller's hold on a URL's fill; release() may come before the with block ends
+class _FillLock:
+    def __init__(self, cache, shared, timeout):
+        self.cache = cache; self.shared = shared
+        self.timeout = timeout
+        self.held = False
+    def __enter__(self):
+        self.held = self.shared.lock.acquire(timeout=self.timeout)
+        return self
+    def release(self):
+        if self.held:
+            self.held = False
+            self.shared.lock.release()
+    def __exit__(self, *exc):
+        self.release()
+        self.cache._release_fill(self.shared)
@@ -0,0 +1,170 @@
+MAX_LINE = 64 * 1024
+MAX_HEADERS = 200
+COPY_CHUNK = 64 * 1024
+_HEX = frozenset(b"0123456789abcdefABCDEF")
+
+HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-connection", "proxy-authenticate",
+    "proxy-authorization", "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+
+class HTTPStreamError(Exception):
+    pass
+
+
+# the client's request itself is malformed, answered with 400
+class BadRequest(HTTPStreamError):
+    pass
+
+
+# ====== Heads ======
+def read_head(fp):
+    line = fp.readline(MAX_LINE + 1)
+    if not line:
+        raise HTTPStreamError("connection closed before response")
+    if len(line) > MAX_LINE:
+        raise HTTPStreamError("status line too long")
+    start = line.decode("latin-1").rstrip("\r\n")
+    headers = []
+    while True:
+        line = fp.readline(MAX_LINE + 1)
+        if len(line) > MAX_LINE:
+            raise HTTPStreamError("header line too long")
+        if line in (b"\r\n", b"\n", b""):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPStreamError("too many headers")
+        text = line.decode("latin-1").rstrip("\r\n")
+        if text[:1] in (" ", "\t") and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, value + " " + text.strip())
+            continue
+        name, _, value = text.partition(":")
+        headers.append((name.strip(), value.strip()))
+    return start, headers
+
+
+def parse_status(start):
+    parts = start.split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise HTTPStreamError(f"bad status line: {start!r}")
+    return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ""
+
+
+def get_header(headers, name, default=None):
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return default
+
+
+def connection_tokens(headers):
+    tokens = set()
+    for k, v in headers:
+        if k.lower() in ("connection", "proxy-connection"):
+            tokens.update(t.strip().lower() for t in v.split(",") if t.strip())
+    return tokens
+
+
+def end_to_end(headers):
+    drop = HOP_BY_HOP | connection_tokens(headers)
+    return [(k, v) for k, v in headers if k.lower() not in drop]
+
+
+def format_head(start, headers):
+    return (start + "\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers) + "\r\n").encode("latin-1")
+
+
+# ====== Bodies ======
+def request_framing(headers):
+    te = get_header(headers, "Transfer-Encoding")
+    if te:
+        if te.split(",")[-1].strip().lower() != "chunked":
+            raise HTTPStreamError(f"unsupported Transfer-Encoding: {te}")
+        return "chunked", None
+    length = get_header(headers, "Content-Length")
+    if length is not None:
+        # digits only: int() would also take "-1", "+5" and "1_0"
+        if not length.strip().isdigit():
+            raise BadRequest(f"bad Content-Length: {length!r}")
+        n = int(length)
+        return ("length", n) if n > 0 else ("none", 0)
+    return "none", 0
+
+
+# a chunked request must not reach the origin with a Content-Length too (RFC 7230 3.3.3)
+def without_length(headers):
+    return [(k, v) for k, v in headers if k.lower() != "content-length"]
+
+
+# returns ("none" | "length" | "chunked" | "close", content_length)
+def response_framing(method, status, headers):
+    if method == "HEAD" or 100 <= status < 200 or status in (204, 304):
+        return "none", 0
+    te = get_header(headers, "Transfer-Encoding")
+    if te and te.split(",")[-1].strip().lower() == "chunked":
+        return "chunked", None
+    length = get_header(headers, "Content-Length")
+    if length is not None:
+        if not length.strip().isdigit():
+            raise HTTPStreamError(f"bad Content-Length: {length!r}")
+        return "length", int(length)
+    return "close", None
+
+
+def copy_length(fp, write, n):
+    while n > 0:
+        data = fp.read(min(n, COPY_CHUNK))
+        if not data:
+            raise HTTPStreamError("body shorter than Content-Length")
+        write(data)
+        n -= len(data)
+
+
+def copy_until_close(fp, write):
+    while True:
+        data = fp.read1(COPY_CHUNK) if hasattr(fp, "read1") else fp.read(COPY_CHUNK)
+        if not data:
+            return
+        write(data)
+
+
+# raw=True forwards the chunk framing untouched, raw=False writes only the decoded payload;
+# sink, if given, also receives the decoded payload
+def copy_chunked(fp, write, raw=True, sink=None):
+    while True:
+        line = fp.readline(MAX_LINE + 1)
+        if not line or len(line) > MAX_LINE:
+            raise HTTPStreamError("bad chunk size line")
+        # hex digits only: int(x, 16) would also take "-5", "+5" and "0x5"
+        text = line.split(b";", 1)[0].strip()
+        if not text or not _HEX.issuperset(text):
+            raise HTTPStreamError(f"bad chunk size: {line!r}")
+        size = int(text, 16)
+        if raw:
+            write(line)
+        if size == 0:
+            break
+        while size > 0:
+            data = fp.read(min(size, COPY_CHUNK))
+            if not data:
+                raise HTTPStreamError("truncated chunk")
+            write(data)
+            if sink:
+                sink(data)
+            size -= len(data)
+        crlf = fp.readline(MAX_LINE + 1)
+        if crlf not in (b"\r\n", b"\n"):
+            raise HTTPStreamError("missing chunk terminator")
+        if raw:
+            write(crlf)
+    while True:
+        line = fp.readline(MAX_LINE + 1)
+        if not line:
+            raise HTTPStreamError("truncated trailers")
+        if raw:
+            write(line)
+        if line in (b"\r\n", b"\n"):
+            return
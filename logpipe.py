@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import deque
+
+
+# ====== Log pipeline ======
+# Writers append to a bounded ring (deque.append is atomic and never blocks; when the
+# ring is full the oldest line is dropped). A flusher thread drains it every interval
+# and hands each batch to the file and the sinks in one call, so neither the disk nor
+# the UI sees one operation per line.
+class LogPipeline:
+    def __init__(self, path=None, capacity=100000, interval=0.25, timestamps=True):
+        self.path = path
+        self.interval = interval
+        self.timestamps = timestamps
+        self.ring = deque(maxlen=capacity)
+        self.sinks = []
+        # approximate under contention, it only feeds the "lines dropped" notice
+        self.dropped = 0
+        self._reported = 0
+        self._file = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def write(self, text):
+        ring = self.ring
+        if len(ring) == ring.maxlen:
+            self.dropped += 1
+        ring.append((time.time(), text))
+
+    def add_sink(self, fn):
+        self.sinks.append(fn)
+
+    def remove_sink(self, fn):
+        if fn in self.sinks:
+            self.sinks.remove(fn)
+
+    def start(self):
+        if self._thread: return
+        if self.path:
+            self._file = open(self.path, "a", encoding="utf-8", errors="replace")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if not self._thread: return
+        self._stop.set()
+        self._thread.join(); self._thread = None
+        self.flush()
+        if self._file:
+            self._file.close(); self._file = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def drain(self):
+        batch = []
+        pop = self.ring.popleft
+        try:
+            for _ in range(len(self.ring)):
+                batch.append(pop())
+        except IndexError:
+            pass
+        return batch
+
+    def flush(self):
+        batch = self.drain()
+        if not batch:
+            return
+        if self.timestamps:
+            lines = [f"{time.strftime('%H:%M:%S', time.localtime(ts))} {text}" for ts, text in batch]
+        else:
+            lines = [text for _, text in batch]
+        if self.dropped != self._reported:
+            lines.append(f"[log] {self.dropped - self._reported} lines dropped, the writers outran the flush")
+            self._reported = self.dropped
+        if self._file:
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+        for sink in list(self.sinks):
+            try:
+                sink(lines)
+            except Exception:
+                pass
+
+
+# proxy requests and tor output, shown in the UI log page
+LOG = LogPipeline()
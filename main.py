@@ -1,12 +1,21 @@
-from PySide6.QtWidgets import (
-QApplication
-)
-import qdarkstyle
-from qdarkstyle.dark.palette import DarkPalette
-from qdarkstyle.light.palette import LightPalette
 import sys
-from ui import Window, CONFIG
 if __name__ == "__main__":
+    # proxy workers are spawned processes; a frozen build has to dispatch them here
+    import multiprocessing
+    multiprocessing.freeze_support()
+    if "--headless" in sys.argv:
+        # no Qt at all in headless mode
+        from daemon import main
+        main([a for a in sys.argv[1:] if a != "--headless"])
+        sys.exit(0)
+
+    from PySide6.QtWidgets import (
+    QApplication
+    )
+    import qdarkstyle
+    from qdarkstyle.dark.palette import DarkPalette
+    from qdarkstyle.light.palette import LightPalette
+    from ui import Window, CONFIG
     
     app = QApplication(sys.argv)
     CONFIG.load()
@@ -16,4 +25,4 @@ if __name__ == "__main__":
         app.setStyleSheet(qdarkstyle.load_stylesheet(palette=DarkPalette()))  
     win = Window()
     win.show()
-    app.exec()
\ No newline at end of file
+    app.exec()
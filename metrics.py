@@ -0,0 +1,283 @@
+import time
+import bisect
+import threading
+
+# shards registered before the first sweep for finished threads
+SWEEP_AFTER = 64
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DURATION_BUCKETS = (0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 7200.0)
+
+
+class _Shard:
+    __slots__ = ("thread", "counters", "histograms")
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.histograms = {}
+
+
+# ====== Registry ======
+# Every thread writes only to its own shard, so recording takes no lock; readers sum the
+# shards. Shards of finished threads are folded into one so per-connection threads do
+# not pile up, on every read and whenever the shard count doubles (so also with nobody
+# reading). Labels are tuples of (name, value) pairs, e.g. (("code", "403"),).
+class Metrics:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)
+        self._lock = threading.Lock()
+        self._sweep_at = SWEEP_AFTER
+        self._meta = {}
+        self._collectors = []
+        self.started = time.time()
+
+    def counter(self, name, help):
+        self._meta[name] = ("counter", help, None)
+
+    def gauge(self, name, help):
+        self._meta[name] = ("gauge", help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, tuple(buckets))
+
+    # fn() returns {name: value}, or {name: {labels: value}}, read at scrape time
+    def add_collector(self, fn, types=None):
+        for name, kind in (types or {}).items():
+            self._meta.setdefault(name, (kind, name, None))
+        self._collectors.append(fn)
+
+    def remove_collector(self, fn):
+        if fn in self._collectors:
+            self._collectors.remove(fn)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+                if len(self._shards) >= self._sweep_at:
+                    self._sweep()
+            return shard
+
+    def inc(self, name, value=1, labels=()):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def dec(self, name, value=1, labels=()):
+        self.inc(name, -value, labels)
+
+    def observe(self, name, value, labels=()):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        h = histograms.get(key)
+        if h is None:
+            bounds = self._meta[name][2]
+            h = histograms[key] = [bounds, [0] * (len(bounds) + 1), 0.0]
+        h[1][bisect.bisect_left(h[0], value)] += 1
+        h[2] += value
+
+    # ====== Reading ======
+    def _fold(self, into, shard):
+        for key, value in shard.counters.copy().items():
+            into.counters[key] = into.counters.get(key, 0) + value
+        for key, (bounds, counts, total) in shard.histograms.copy().items():
+            h = into.histograms.get(key)
+            if h is None:
+                h = into.histograms[key] = [bounds, [0] * len(counts), 0.0]
+            h[1] = [a + b for a, b in zip(h[1], counts)]
+            h[2] += total
+
+    # with self._lock held
+    def _sweep(self):
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._fold(self._retired, shard)
+        self._shards = alive
+        self._sweep_at = max(SWEEP_AFTER, 2 * len(alive))
+
+    def _merged(self):
+        merged = _Shard(None)
+        with self._lock:
+            self._sweep()
+            self._fold(merged, self._retired)
+            for shard in self._shards:
+                self._fold(merged, shard)
+        for fn in list(self._collectors):
+            try:
+                values = fn()
+            except Exception:
+                continue
+            for name, value in values.items():
+                for labels, v in (value.items() if isinstance(value, dict) else [((), value)]):
+                    merged.counters[(name, labels)] = v
+        return merged
+
+    # {name: {labels: value}} for counters and gauges,
+    # {name: {labels: {"buckets", "counts", "sum", "count"}}} for histograms
+    def snapshot(self):
+        merged = self._merged()
+        out = {}
+        for (name, labels), value in merged.counters.items():
+            out.setdefault(name, {})[labels] = value
+        for (name, labels), (bounds, counts, total) in merged.histograms.items():
+            out.setdefault(name, {})[labels] = {"buckets": bounds, "counts": counts, "sum": total, "count": sum(counts)}
+        return out
+
+    def value(self, name, labels=None):
+        series = self.snapshot().get(name, {})
+        if labels is not None:
+            return series.get(labels, 0)
+        return sum(v["count"] if isinstance(v, dict) else v for v in series.values())
+
+    # Prometheus text exposition format 0.0.4
+    def render(self):
+        merged = self._merged()
+        lines = []
+        names = sorted({name for name, _ in merged.counters} | {name for name, _ in merged.histograms})
+        for name in names:
+            kind, help, _ = self._meta.get(name, ("untyped", name, None))
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (n, labels), value in sorted(merged.counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+            for (n, labels), (bounds, counts, total) in sorted(merged.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(bounds + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _number(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ====== Proxy metrics ======
+METRICS = Metrics()
+METRICS.counter("torproxy_client_connections_total", "Client connections accepted")
+METRICS.counter("torproxy_requests_total", "Proxy requests by method")
+METRICS.counter("torproxy_errors_total", "Error responses sent to clients by status code")
+METRICS.counter("torproxy_socks_errors_total", "SOCKS failure replies sent to clients by SOCKS5 reply code")
+METRICS.gauge("torproxy_tunnels_active", "CONNECT tunnels currently open")
+METRICS.counter("torproxy_tunnels_total", "CONNECT tunnels opened")
+METRICS.counter("torproxy_relay_bytes_total", "Bytes relayed through tunnels by direction")
+METRICS.histogram("torproxy_tunnel_duration_seconds", "Lifetime of CONNECT tunnels", DURATION_BUCKETS)
+METRICS.histogram("torproxy_tor_connect_seconds", "SOCKS connect latency through tor")
+METRICS.histogram("torproxy_phase_seconds", "Time spent in each phase of a request, while phase timing is on")
+METRICS.counter("torproxy_tor_connect_failures_total", "Failed SOCKS connects through tor by reason")
+METRICS.counter("torproxy_routed_total", "Connections sent around tor by the route table, by route")
+METRICS.counter("torproxy_connect_retries_total", "Connects retried on a fresh circuit")
+METRICS.counter("torproxy_connect_hedges_total", "Slow connects raced by a second one on another circuit")
+METRICS.counter("torproxy_connect_hedge_wins_total", "Hedged connects that finished first")
+METRICS.counter("torproxy_identity_rotations_total", "NEWNYM signals sent to tor by reason")
+METRICS.counter("torproxy_circuit_builds_total", "General purpose circuits built by tor, by cause (rotation: soon after a NEWNYM)")
+METRICS.counter("torproxy_shaping_delay_seconds_total", "Seconds tunnels were held back by bandwidth shaping, by class")
+METRICS.counter("torproxy_shaped_tunnels_total", "Shaped tunnels closed, by the class they ended in")
+METRICS.counter("torproxy_shed_total", "Connections and tunnels refused by admission control by limit")
+METRICS.counter("torproxy_timeouts_total", "Client connections and tunnels closed by a timeout by phase")
+METRICS.gauge("torproxy_connections_active", "Client connections currently served")
+METRICS.gauge("torproxy_admission_waiting", "Tunnels waiting for a free slot")
+METRICS.gauge("torproxy_workers_alive", "Proxy worker processes running")
+METRICS.counter("torproxy_worker_restarts_total", "Proxy worker processes restarted after exiting")
+METRICS.gauge("torproxy_upstream_idle_connections", "Idle pooled upstream connections")
+METRICS.counter("torproxy_http_cache_events_total", "HTTP cache events (hits, misses, stores, ...)")
+METRICS.gauge("torproxy_http_cache_entries", "Responses stored in the HTTP cache")
+METRICS.gauge("torproxy_http_cache_bytes", "Bytes stored in the HTTP cache")
+
+UP = (("direction", "up"),)
+DOWN = (("direction", "down"),)
+_METHODS = {m: (("method", m),) for m in ("CONNECT", "GET", "POST", "HEAD", "PUT", "PATCH", "DELETE", "OPTIONS", "SOCKS5", "SOCKS4")}
+
+
+# unknown methods share one label so clients cannot create series at will
+def method_labels(command):
+    return _METHODS.get(command, (("method", "other"),))
+
+
+# ====== Endpoint ======
+# Every module records into METRICS; http.server and json are only needed once the endpoint
+# is started, so the handler class is built then.
+def _handler_class():
+    import json
+    from urllib.parse import urlsplit, parse_qsl
+    from http.server import BaseHTTPRequestHandler
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            metrics = self.server.metrics
+            if self.path == "/metrics":
+                body = metrics.render().encode()
+                ctype = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                snap = {name: {",".join(f"{k}={v}" for k, v in labels): value for labels, value in series.items()}
+                        for name, series in metrics.snapshot().items()}
+                body = json.dumps(snap).encode()
+                ctype = "application/json"
+            elif self.path.startswith("/debug/"):
+                # profiling triggers; a capture holds this request until it is written
+                from profiling import PROFILER
+                url = urlsplit(self.path)
+                status, result = PROFILER.handle(url.path, dict(parse_qsl(url.query, keep_blank_values=True)))
+                body = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _MetricsHandler
+
+
+class MetricsServer:
+    def __init__(self, port, host="127.0.0.1", metrics=METRICS):
+        self.host = host; self.port = port
+        self.metrics = metrics
+        self.server = None; self.thread = None
+
+    def start(self):
+        if self.server: return
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((self.host, self.port), _handler_class())
+        self.server.daemon_threads = True
+        self.server.metrics = self.metrics
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.server: return
+        self.server.shutdown(); self.server.server_close(); self.thread.join()
+        self.server = None; self.thread = None
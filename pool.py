@@ -0,0 +1,118 @@
+import time
+import threading
+from relay import readable
+
+
+class UpstreamConn:
+    def __init__(self, key, sock):
+        self.key = key
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        self.idle_since = 0.0
+        self.reused = False
+
+    def alive(self):
+        # an idle HTTP connection has nothing to read; readable means EOF or junk
+        try:
+            return not readable(self.sock)
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self.rfile.close()
+        finally:
+            self.sock.close()
+
+
+# ====== Upstream pool ======
+# Idle connections keyed by (host, port). connect(host, port) opens a new one. Past
+# max_per_host connections in use to one host, more are opened outside the pool and closed
+# after use, rather than making a client wait for one to come back.
+class UpstreamPool:
+    def __init__(self, connect, max_per_host=8, max_idle_per_host=4, idle_timeout=60):
+        self.connect = connect
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._last_sweep = time.monotonic()
+
+    def acquire(self, host, port, fresh=False):
+        key = (host.lower(), port)
+        with self._lock:
+            self._sweep()
+            idle = None if fresh else self._idle.get(key)
+            while idle:
+                conn = idle.pop()
+                if conn.alive():
+                    conn.reused = True
+                    self._active[key] = self._active.get(key, 0) + 1
+                    return conn
+                conn.close()
+            if self._active.get(key, 0) >= self.max_per_host:
+                # over the limit: an unpooled connection (key None), closed on release
+                key = None
+            else:
+                self._active[key] = self._active.get(key, 0) + 1
+        try:
+            return UpstreamConn(key, self.connect(host, port))
+        except BaseException:
+            if key: self._done(key)
+            raise
+
+    def release(self, conn, reusable=True):
+        if conn.key is None:
+            reusable = False
+        else:
+            self._done(conn.key, conn if reusable else None)
+        if not reusable:
+            conn.close()
+
+    def discard(self, conn):
+        self.release(conn, reusable=False)
+
+    def _done(self, key, conn=None):
+        with self._lock:
+            self._active[key] -= 1
+            if not self._active[key]:
+                del self._active[key]
+            if conn is not None:
+                idle = self._idle.setdefault(key, [])
+                if self._closed or len(idle) >= self.max_idle_per_host:
+                    conn.close()
+                else:
+                    conn.idle_since = time.monotonic()
+                    idle.append(conn)
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < 1:
+            return
+        self._last_sweep = now
+        for key in list(self._idle):
+            keep = []
+            for conn in self._idle[key]:
+                if now - conn.idle_since > self.idle_timeout:
+                    conn.close()
+                else:
+                    keep.append(conn)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def idle_count(self):
+        with self._lock:
+            return sum(len(v) for v in self._idle.values())
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
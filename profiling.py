@@ -0,0 +1,301 @@
+# Opt-in profiling of a running proxy, no restart needed. Results go to PROFILER.directory,
+# named by kind, process id and time.
+#   kill -USR1 <pid>          sample every thread's stacks for PROFILE_SECONDS, with tracemalloc
+#                             snapshots before and after (the daemon passes it on to workers)
+#   GET /debug/profile?seconds=10&mode=sample|cprofile    on the metrics port
+#   GET /debug/memory         tracemalloc snapshot, diffed against the previous one; ?stop=1 ends tracing
+#   GET /debug/timing?on=1    per-phase request timings as torproxy_phase_seconds, for new connections
+import os
+import re
+import sys
+import time
+import threading
+import contextlib
+from collections import Counter
+from metrics import METRICS
+# pstats, cProfile, tracemalloc, io and signal are imported when used; they cost ~30ms at startup
+
+PROFILE_SECONDS = 10.0
+MAX_SECONDS = 300.0
+SAMPLE_INTERVAL = 0.005
+TOP = 30
+PHASES = ("accept", "parse", "blocklist", "admission", "handshake", "first_byte", "relay")
+_PHASE_LABELS = {p: (("phase", p),) for p in PHASES}
+# "Thread-12 (process_request_thread)" -> "(process_request_thread)", so handler threads add up
+_THREAD_NUMBER = re.compile(r"^(Thread|Dummy)-\d+ ?")
+
+
+# ====== Request phases ======
+# lap() records the time since the previous lap (or the start) under a phase
+class PhaseClock:
+    __slots__ = ("last",)
+
+    def __init__(self, start=None):
+        self.last = start or time.monotonic()
+
+    def lap(self, phase):
+        now = time.monotonic()
+        METRICS.observe("torproxy_phase_seconds", now - self.last, labels=_PHASE_LABELS[phase])
+        self.last = now
+
+    def restart(self):
+        self.last = time.monotonic()
+
+
+class _NoClock:
+    def lap(self, phase): pass
+    def restart(self): pass
+
+
+_NO_CLOCK = _NoClock()
+
+
+# ====== Profiler ======
+class Profiler:
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self.timing = False
+        self._busy = threading.Lock()  # one capture at a time
+        self._finished = None  # profiles of handler threads, while a cprofile capture runs
+        self._finished_lock = threading.Lock()
+        self._loops = set()
+        self._baseline = None
+
+    # a PhaseClock while timing is on, else one that records nothing
+    def clock(self, start=None):
+        return PhaseClock(start) if self.timing else _NO_CLOCK
+
+    # event loops whose thread a cprofile capture covers (the asyncio engines)
+    def add_loop(self, loop):
+        self._loops.add(loop)
+
+    def remove_loop(self, loop):
+        self._loops.discard(loop)
+
+    # wraps one connection of a threaded engine; a no-op unless a cprofile capture runs
+    def profiled(self):
+        if self._finished is None:
+            return contextlib.nullcontext()
+        return self._profile_thread(self._finished)
+
+    @contextlib.contextmanager
+    def _profile_thread(self, finished):
+        profile = _enabled_profile()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                with self._finished_lock:
+                    finished.append(profile)
+
+    def _path(self, kind, ext):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        path, n = f"{base}.{ext}", 1
+        while os.path.exists(path):
+            n += 1
+            path = f"{base}-{n}.{ext}"
+        return path
+
+    # ====== Stack sampling ======
+    # Wall clock samples of every thread but this one, so threads blocked in poll or recv
+    # show up too. Writes collapsed stacks (flamegraph.pl, speedscope) and a text summary.
+    def sample(self, seconds=PROFILE_SECONDS, interval=SAMPLE_INTERVAL):
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: _THREAD_NUMBER.sub("", t.name) or t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        folded = self._path("stacks", "folded")
+        with open(folded, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        threads, leaf, total = Counter(), Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            threads[frames[0]] += count
+            leaf[frames[-1]] += count
+            for name in set(frames[1:]):
+                total[name] += count
+        summary = self._path("stacks", "txt")
+        with open(summary, "w") as f:
+            f.write(f"{samples} samples over {seconds:g}s, every {interval * 1000:g}ms\n")
+            # threads as a share of the samples, functions as a share of all thread samples
+            everything = sum(threads.values())
+            for title, counter, of in (("threads", threads, samples), ("self", leaf, everything),
+                                       ("inclusive", total, everything)):
+                f.write(f"\n{title}:\n")
+                for name, count in counter.most_common(TOP):
+                    f.write(f"{count:8} {count / max(of, 1):7.1%}  {name}\n")
+        return [folded, summary]
+
+    # ====== cProfile ======
+    # Deterministic profile of request handling: the asyncio loop threads for the whole
+    # window, and threaded-engine connections that start and end within it.
+    # Python 3.12+ allows one active profiler per process: there the first loop or connection
+    # to start one is profiled, and further connections only once it is done.
+    def cprofile(self, seconds=PROFILE_SECONDS):
+        import pstats
+        self._finished = finished = []
+        started = {}
+
+        def start(loop):
+            started[loop] = _enabled_profile()
+        for loop in list(self._loops):
+            loop.call_soon_threadsafe(start, loop)
+        time.sleep(seconds)
+        self._finished = None
+        profiles = []
+        for loop in list(started):
+            profile = started[loop]
+            if profile is None:
+                continue
+            done = threading.Event()
+            try:
+                loop.call_soon_threadsafe(lambda p=profile, d=done: (p.disable(), d.set()))
+            except RuntimeError:
+                continue  # the loop closed meanwhile
+            if done.wait(5):
+                profiles.append(profile)
+        with self._finished_lock:
+            profiles += finished
+        if not profiles:
+            return []
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        dump = self._path("cprofile", "prof")
+        stats.dump_stats(dump)
+        summary = self._path("cprofile", "txt")
+        import io
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(TOP * 2)
+        with open(summary, "w") as f:
+            f.write(f"{len(profiles)} profiled threads/connections over {seconds:g}s\n")
+            f.write(out.getvalue())
+        return [dump, summary]
+
+    # ====== Memory ======
+    # The first call starts tracemalloc; every call writes the top allocators by line, as
+    # growth since the previous call once there is one, and the raw snapshot.
+    def memory(self, frames=10):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._baseline = None
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        current, peak = tracemalloc.get_traced_memory()
+        if self._baseline is None:
+            title, stats = "top allocators since tracing started", snapshot.statistics("lineno")
+        else:
+            title, stats = "growth since the previous snapshot", snapshot.compare_to(self._baseline, "lineno")
+        self._baseline = snapshot
+        summary = self._path("memory", "txt")
+        with open(summary, "w") as f:
+            f.write(f"traced {current >> 10} KiB, peak {peak >> 10} KiB\n\n{title}:\n")
+            for stat in stats[:TOP]:
+                f.write(f"{stat}\n")
+        raw = self._path("memory", "snapshot")
+        snapshot.dump(raw)
+        return [summary, raw]
+
+    def stop_memory(self):
+        import tracemalloc
+        tracemalloc.stop()
+        self._baseline = None
+
+    # ====== Triggers ======
+    # what SIGUSR1 does: a stack sample between two memory snapshots, on a background thread
+    def capture(self, seconds=PROFILE_SECONDS):
+        def run():
+            files = self._exclusive(lambda: self.memory() + self.sample(seconds) + self.memory())
+            if files is None:
+                print("profile: a capture is already running", flush=True)
+            else:
+                print(f"profile: wrote {', '.join(files)}", flush=True)
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+
+    def _exclusive(self, fn):
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            return fn()
+        finally:
+            self._busy.release()
+
+    # GET /debug/... on the metrics endpoint; returns (status, JSON-able body)
+    def handle(self, path, query):
+        if path == "/debug/timing":
+            if "on" in query:
+                self.timing = query["on"] not in ("0", "false", "")
+            return 200, {"timing": self.timing}
+        if path == "/debug/memory":
+            if query.get("stop"):
+                self.stop_memory()
+                return 200, {"tracing": False}
+            files = self._exclusive(self.memory)
+        elif path == "/debug/profile":
+            try:
+                seconds = min(float(query.get("seconds", PROFILE_SECONDS)), MAX_SECONDS)
+            except ValueError:
+                seconds = 0.0
+            if not seconds > 0:  # also nan
+                return 400, {"error": f"seconds must be above 0, at most {MAX_SECONDS:g}"}
+            capture = {"sample": self.sample, "cprofile": self.cprofile}.get(query.get("mode", "sample"))
+            if capture is None:
+                return 400, {"error": "mode is sample or cprofile"}
+            files = self._exclusive(lambda: capture(seconds))
+        else:
+            return 404, {"error": "not found"}
+        if files is None:
+            return 409, {"error": "a capture is already running"}
+        return 200, {"files": files}
+
+
+# a started cProfile.Profile, None when another profiler is active (3.12+ allows only one)
+def _enabled_profile():
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return None
+    return profile
+
+
+PROFILER = Profiler()
+
+
+# SIGUSR1 starts PROFILER.capture(); then(), if given, runs too (to pass the signal on).
+# Main thread only; False where there is no SIGUSR1 (Windows), use the endpoint there.
+def install_signal(then=None):
+    import signal
+    if not hasattr(signal, "SIGUSR1"):
+        return False
+    def handler(signum, frame):
+        PROFILER.capture()
+        if then:
+            then()
+    signal.signal(signal.SIGUSR1, handler)
+    return True
+
+
+def profiling_from_config(config):
+    PROFILER.directory = config["profile_dir"] or "profiles"
+    PROFILER.timing = config["phase_timing"]
+    return PROFILER
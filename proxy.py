@@ -1,17 +1,28 @@
-import os
-import json
-import socks
-import select
-import winreg
-import ctypes
+import time
 import socket
+import threading
 from urllib.parse import urlsplit
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
+from relay import relay
+from admission import Limits, OVERLOADED, shed
+from circuits import ConnectPolicy, RETRYABLE_REPLIES
+from routes import RouteTable, DIRECT, PAC_PATH, refused
+from shaping import Shaper
+from metrics import METRICS, UP, DOWN, method_labels
+from logpipe import LOG
+from profiling import PROFILER
+from blockstore import BlockStore
+from pool import UpstreamPool
+from http_stream import (
+    HTTPStreamError, BadRequest, read_head, parse_status, get_header, connection_tokens, end_to_end,
+    format_head, request_framing, without_length, response_framing, copy_length, copy_chunked, copy_until_close
+)
 
 # ====== Config & Globals ======
 BLOCKED_FILE = 'blocked_hosts.json'
-blocked_hosts = []
+# the rules live in a memory-mapped index and a delta log next to BLOCKED_FILE, see blockstore
+blocked = BlockStore(BLOCKED_FILE)
 
 
 def get_free_port():
@@ -20,39 +31,54 @@ def get_free_port():
         return s.getsockname()[1]
 
 def load_blocked():
-    global blocked_hosts
-    if os.path.exists(BLOCKED_FILE):
-        try:
-            with open(BLOCKED_FILE, 'r') as f:              
-                blocked_hosts = json.load(f)
-        except:
-            print('error in loading blocked hosts')
-            blocked_hosts = []
-    else:
-        blocked_hosts = []
+    global blocked
+    store = BlockStore(BLOCKED_FILE)
+    try:
+        store.load()
+    except (OSError, ValueError) as e:
+        print(f'error in loading blocked hosts: {e}')
+        store = BlockStore(BLOCKED_FILE)
+    blocked = store
+
+# picks up edits and recompiled indexes written by another process
+def refresh_blocked():
+    try:
+        blocked.refresh()
+    except (OSError, ValueError) as e:
+        print(f'error in reloading blocked hosts: {e}')
 
 def add_to_blocked_hosts(host):
-    if host not in blocked_hosts:
-            blocked_hosts.append(host)
-            return True
-    return False
+    return blocked.add(host)
 
 def get_blocked():
-    return blocked_hosts
+    return list(blocked)
+
+def is_blocked(host):
+    return blocked.match(host)
 
 def remove_blocked(host):
-    blocked_hosts.remove(host)
-    
+    blocked.remove(host)
+
+# edits are already on disk in the delta log; this only folds a long log into the index
 def save_blocked():
-    with open(BLOCKED_FILE, 'w') as f:
-        json.dump(blocked_hosts, f, indent=2)
+    blocked.save()
 
-def set_proxy(enable=True, server="127.0.0.1:8080"):
+# pac_url: also point the system at the proxy's PAC file, so bypassed hosts skip the proxy
+def set_proxy(enable=True, server="127.0.0.1:8080", pac_url=None):
     path = r"Software\Microsoft\Windows\CurrentVersion\Internet Settings"
     try:
+        import winreg
+        import ctypes
         key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, path, 0, winreg.KEY_WRITE)
         winreg.SetValueEx(key, "ProxyEnable", 0, winreg.REG_DWORD, 1 if enable else 0)
         winreg.SetValueEx(key, "ProxyServer", 0, winreg.REG_SZ, server if enable else "")
+        if enable and pac_url:
+            winreg.SetValueEx(key, "AutoConfigURL", 0, winreg.REG_SZ, pac_url)
+        else:
+            try:
+                winreg.DeleteValue(key, "AutoConfigURL")
+            except OSError:
+                pass
         winreg.CloseKey(key)
         ctypes.windll.Wininet.InternetSetOptionW(0, 37, 0, 0)
         ctypes.windll.Wininet.InternetSetOptionW(0, 39, 0, 0)
@@ -61,89 +87,601 @@ def set_proxy(enable=True, server="127.0.0.1:8080"):
         print(f"[!] set_proxy error: {e}")
         return False
 
+class _StaticLease:
+    def __init__(self, port): self.socks_port = port
+    def connected(self, seconds): pass
+    def failed(self, instance_fault): pass
+    def release(self): pass
+
+# tor is either a SOCKS port number or a tor.TorRunner / tor.TorPool
+def tor_lease(tor):
+    if isinstance(tor, int):
+        return _StaticLease(tor)
+    return tor.acquire()
+
+_TorSocket = None
+
+# PySocks pulls in logging, so it is only imported once the first stream is opened
+def _tor_socket_class():
+    global _TorSocket
+    if _TorSocket is None:
+        import socks
+        class TorSocket(socks.socksocket):
+            on_close = None
+            def close(self):
+                callback, self.on_close = self.on_close, None
+                if callback: callback()
+                super().close()
+        _TorSocket = TorSocket
+    return _TorSocket
+
+# tor_unreachable: nothing listens on the SOCKS port, socks: tor refused the stream
+# (unreachable host, exit policy, failed circuit), timeout: no answer in time
+def connect_failure_reason(e):
+    import socks
+    if isinstance(e, (socket.timeout, TimeoutError)) or isinstance(getattr(e, "socket_err", None), socket.timeout):
+        return "timeout"
+    if isinstance(e, socks.ProxyConnectionError):
+        return "tor_unreachable"
+    if isinstance(e, socks.ProxyError):
+        return "socks"
+    return "other"
+
+# connect_timeout bounds the SOCKS handshake and circuit build, timeout applies afterwards;
+# a username puts the stream on its own circuit (IsolateSOCKSAuth)
+def open_tor_socket(tor, host, port, connect_timeout=None, timeout=None, username=None):
+    import socks
+    lease = tor_lease(tor)
+    remote = _tor_socket_class()()
+    remote.set_proxy(socks.SOCKS5, "127.0.0.1", lease.socks_port, rdns=True,
+                     username=username, password=username and "x")
+    started = time.monotonic()
+    try:
+        remote.settimeout(connect_timeout)
+        remote.connect((host, port))
+        remote.settimeout(timeout)
+    except BaseException as e:
+        reason = connect_failure_reason(e)
+        METRICS.inc("torproxy_tor_connect_failures_total", labels=(("reason", reason),))
+        # unreachable or stalled, not a destination tor reported it could not reach
+        lease.failed(reason in ("timeout", "tor_unreachable"))
+        lease.release()
+        remote.close()
+        raise
+    elapsed = time.monotonic() - started
+    METRICS.observe("torproxy_tor_connect_seconds", elapsed)
+    lease.connected(elapsed)
+    remote.on_close = lease.release
+    return remote
+
+# the SOCKS5 reply code tor answered with, None for other failures
+def socks_reply(e):
+    import socks
+    # socksocket.connect wraps negotiation errors in a GeneralProxyError
+    e = getattr(e, "socket_err", None) or e
+    if isinstance(e, socks.SOCKS5Error):
+        try:
+            return int(e.msg.split(":", 1)[0], 16)
+        except ValueError:
+            pass
+    return None
+
+def retryable(e):
+    return socks_reply(e) in RETRYABLE_REPLIES or connect_failure_reason(e) == "timeout"
+
+# ====== Retries and hedging ======
+# open_tor_socket under a circuits.ConnectPolicy. The first try uses tor's usual circuit
+# (or the destination's, see ConnectPolicy.circuit), every retry and hedge gets a fresh one.
+def connect_tor(tor, host, port, policy, connect_timeout=None, timeout=None):
+    def attempt(username):
+        started = time.monotonic()
+        sock = open_tor_socket(tor, host, port, connect_timeout, timeout, username)
+        policy.record(time.monotonic() - started)
+        return sock
+    for n in range(policy.retries + 1):
+        try:
+            return _race(attempt, policy.circuit(host) if n == 0 else policy.isolation(), policy)
+        except Exception as e:
+            if n == policy.retries or not retryable(e):
+                raise
+            METRICS.inc("torproxy_connect_retries_total")
+
+# runs attempt(username); if it has not finished after the hedge delay, races a second
+# attempt on another circuit and returns whichever connects first, closing the other
+def _race(attempt, username, policy):
+    delay = policy.hedge_delay()
+    if delay is None:
+        return attempt(username)
+    import queue
+    results = queue.Queue()
+    lock = threading.Lock()
+    won = []
+    def run(username, hedge):
+        try:
+            sock = attempt(username)
+        except Exception as e:
+            results.put((None, e))
+            return
+        with lock:
+            if won:
+                sock.close()
+                return
+            won.append(sock)
+        if hedge:
+            METRICS.inc("torproxy_connect_hedge_wins_total")
+        results.put((sock, None))
+    threading.Thread(target=run, args=(username, False), daemon=True).start()
+    try:
+        sock, error = results.get(timeout=delay)
+    except queue.Empty:
+        METRICS.inc("torproxy_connect_hedges_total")
+        threading.Thread(target=run, args=(policy.isolation(), True), daemon=True).start()
+        sock, error = results.get()
+        if sock is None:
+            sock, error = results.get()
+    if sock is None:
+        raise error
+    return sock
+
+# ====== Split tunneling ======
+# a destination matched by the route table, opened directly or through another proxy
+def open_route_socket(route, host, port, connect_timeout=None, timeout=None):
+    if route.scheme == DIRECT:
+        sock = socket.create_connection((host.strip("[]"), port), connect_timeout)
+    else:
+        import socks
+        sock = socks.socksocket()
+        kind = {"socks5": socks.SOCKS5, "socks4": socks.SOCKS4, "http": socks.HTTP}[route.scheme]
+        sock.set_proxy(kind, route.host, route.port, rdns=True)
+        sock.settimeout(connect_timeout)
+        try:
+            sock.connect((host, port))
+        except BaseException:
+            sock.close()
+            raise
+    sock.settimeout(timeout)
+    METRICS.inc("torproxy_routed_total", labels=(("route", route.scheme),))
+    return sock
+
+def upstream_reusable(version, framing, resp_headers):
+    tokens = connection_tokens(resp_headers)
+    if version == "HTTP/1.1":
+        reusable = "close" not in tokens
+    else:
+        reusable = "keep-alive" in tokens
+    return reusable and framing != "close"
+
 # ====== Proxy Handler ======
 class ProxyHandler(BaseHTTPRequestHandler):
     app_window = None
+    protocol_version = "HTTP/1.1"
+    timeout = 120
+    def setup(self):
+        super().setup()
+        self.requests = 0
+        METRICS.inc("torproxy_client_connections_total")
+        accepted = self.server.accepted.pop(self.request, None)
+        self.phases = PROFILER.clock(accepted)
+        if accepted: self.phases.lap("accept")
+
+    def handle(self):
+        with PROFILER.profiled():
+            super().handle()
+
+    # send_response/send_error log through here; the line goes to the ring, never to a UI or disk directly
+    def log_message(self, format, *args):
+        LOG.write(f"{self.client_address[0]} {format % args}")
+
+    def send_error(self, code, message=None, explain=None):
+        METRICS.inc("torproxy_errors_total", labels=(("code", code),))
+        super().send_error(code, message, explain)
+
+    # the handshake timeout covers reading a request head, the idle timeout everything after it
+    def handle_one_request(self):
+        self.connection.settimeout(self.server.limits.handshake_timeout or self.timeout)
+        super().handle_one_request()
+
+    def log_error(self, format, *args):
+        # a keep-alive connection timing out between requests is not a slow handshake
+        if format.startswith("Request timed out") and not self.requests:
+            METRICS.inc("torproxy_timeouts_total", labels=(("phase", "handshake"),))
+        self.log_message(format, *args)
+
+    def parse_request(self):
+        ok = super().parse_request()
+        if ok:
+            METRICS.inc("torproxy_requests_total", labels=method_labels(self.command))
+            # later requests on a keep-alive connection would time the wait between them
+            if self.requests: self.phases.restart()
+            else: self.phases.lap("parse")
+            self.requests += 1
+            self.connection.settimeout(self.server.limits.idle_timeout or self.timeout)
+        return ok
+
+    # takes a tunnel slot for this client and host, or answers 503
+    def _admit(self, host):
+        reason = self.server.limits.admit(self.client_address[0], host)
+        if reason:
+            self.send_error(503, f"Over capacity ({reason})")
+            self.close_connection = True
+            return False
+        return True
+
     def do_CONNECT(self):
         host, port = self.path.split(":")
         port = int(port)
                 
-        for i in blocked_hosts:
-            if i.startswith("*"):
-                if host.endswith(i[1:]):
-                    self.send_error(403, "Forbidden: Blocked")
-                    return
-    
-        if host in blocked_hosts or any([host.endswith(i) for i in blocked_hosts]):
+        if is_blocked(host):
             self.send_error(403, "Forbidden: Blocked")
             return
+        if self.server.route_refused(self.client_address[0], host, port):
+            self.send_error(403, "Forbidden: Local destination")
+            return
+        self.phases.lap("blocklist")
+        if not self._admit(host):
+            return
+        self.phases.lap("admission")
+        limits = self.server.limits
         try:
-            remote = socks.socksocket()
-            remote.set_proxy(socks.SOCKS5, "127.0.0.1", self.server.tor_socks_port, rdns=True)
-            remote.connect((host, port))
+            remote = self.server.open_upstream(host, port)
+            self.phases.lap("handshake")
             self.send_response(200, "Connection Established")
             self.end_headers()
-            self._tunnel(self.connection, remote)
-            # log_request(self.command, self.path, app_window=self.app_window)
+            self._tunnel(self.connection, remote, port)
         except Exception as e:
             self.send_error(502, f"CONNECT error: {e}")
+        finally:
+            limits.release(self.client_address[0], host)
 
     def do_GET(self): self._handle_http()
     def do_POST(self): self._handle_http()
+    def do_HEAD(self): self._handle_http()
+    def do_PUT(self): self._handle_http()
+    def do_PATCH(self): self._handle_http()
+    def do_DELETE(self): self._handle_http()
+    def do_OPTIONS(self): self._handle_http()
+
+    def handle_expect_100(self):
+        # the origin answers Expect: 100-continue, see _exchange
+        return True
 
     def _handle_http(self):
         parsed = urlsplit(self.path)
         host = parsed.hostname
         port = parsed.port or 80
+        if not host and parsed.path == PAC_PATH and self.command in ("GET", "HEAD"):
+            self._send_pac()
+            return
+        if not host:
+            self.send_error(400, "Absolute URI required")
+            return
         
-        for i in blocked_hosts:
-            if i.startswith("*") and "." in i:
-                if host.endswith(i.split(".")[-1]):
-                    
-                    self.send_error(403, "Forbidden: Blocked")
-                    return
-            elif host in i:
-                self.send_error(403, "Forbidden: Blocked")
-                return
-                 
-                           
+        if is_blocked(host):
+            self.send_error(403, "Forbidden: Blocked")
+            return
+        if self.server.route_refused(self.client_address[0], host, port):
+            self.send_error(403, "Forbidden: Local destination")
+            return
+        self.phases.lap("blocklist")
+        if not self._admit(host):
+            return
+        self.phases.lap("admission")
         try:
-            remote = socks.socksocket()
-            remote.set_proxy(socks.SOCKS5, "127.0.0.1", self.server.tor_socks_port, rdns=True)
-            remote.connect((host, port))
-            self.headers["Connection"] = "close"
-            req_line = f"{self.command} {parsed.path or '/'}{'?' + parsed.query if parsed.query else ''} HTTP/1.1\r\n"
-            hdrs = ''.join(f"{k}: {v}\r\n" for k, v in self.headers.items())
-            full = req_line + hdrs + "\r\n"
-            body = b''
-            if self.command == 'POST' and 'Content-Length' in self.headers:
-                body = self.rfile.read(int(self.headers['Content-Length']))
-            remote.sendall(full.encode() + body)
-            self._tunnel(remote, self.connection)
-            # log_request(self.command, self.path, len(full.encode() + body), self.app_window)
-        except Exception as e:
-            self.send_error(502, f"HTTP error: {e}")
+            self._proxy_http(parsed, host, port)
+        finally:
+            self.server.limits.release(self.client_address[0], host)
 
-    def _tunnel(self, src, dst):
-        socks_list = [src, dst]
+    # browsers fetch the PAC file from the proxy itself, at the address they reach it by
+    def _send_pac(self):
+        address = self.headers.get("Host") or f"127.0.0.1:{self.server.server_address[1]}"
+        body = self.server.routes.pac(address).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ns-proxy-autoconfig")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _proxy_http(self, parsed, host, port):
+        raw = [(k, " ".join(v.split())) for k, v in self.headers.raw_items()]
         try:
-            while True:
-                r, _, _ = select.select(socks_list, [], [])
-                for s in r:
-                    data = s.recv(4096)
-                    if not data:
+            framing = request_framing(raw)
+        except BadRequest as e:
+            self.send_error(400, str(e))
+            return
+        except HTTPStreamError as e:
+            self.send_error(501, str(e))
+            return
+        headers = end_to_end(raw)
+        if get_header(headers, "Host") is None:
+            headers.insert(0, ("Host", parsed.netloc))
+        req_line = f"{self.command} {parsed.path or '/'}{'?' + parsed.query if parsed.query else ''} HTTP/1.1"
+
+        cache = self.server.http_cache
+        if (cache and self.command in ("GET", "HEAD") and framing[0] == "none"
+                and get_header(headers, "Range") is None and not cache.passing(self.path)):
+            if self._serve_fresh(cache, headers):
+                return
+            if self.command == "GET":
+                with cache.fill_lock(self.path) as fill:
+                    # the URL may have turned out uncacheable while this request waited
+                    if fill.held and not cache.passing(self.path):
+                        self._handle_cached(cache, fill, host, port, req_line, headers)
                         return
-                    (dst if s is src else src).sendall(data)
-        except:
-            pass
+        if framing[0] == "chunked":
+            headers = without_length(headers)
+            headers.append(("Transfer-Encoding", "chunked"))
+        result = self._exchange(host, port, format_head(req_line, headers), framing)
+        if result:
+            self._finish(*result)
+
+    def _send_body(self, conn, framing):
+        kind, length = framing
+        if kind == "length":
+            copy_length(self.rfile, conn.sock.sendall, length)
+        elif kind == "chunked":
+            copy_chunked(self.rfile, conn.sock.sendall)
+
+    # Sends the request upstream, streaming the client's body if it has one, and reads the
+    # final response head. On failure the error has already been sent to the client.
+    def _exchange(self, host, port, head, framing=("none", 0)):
+        pool = self.server.upstream_pool
+        has_body = framing[0] != "none"
+        expect = has_body and "100-continue" in (self.headers.get("Expect") or "").lower()
+        while True:
+            try:
+                # a streamed body cannot be replayed, so it never goes over a possibly stale stream
+                conn = pool.acquire(host, port, fresh=has_body)
+            except Exception as e:
+                self.send_error(502, f"HTTP error: {e}")
+                return None
+            self.phases.lap("handshake")
+            try:
+                conn.sock.sendall(head)
+                if has_body and not expect:
+                    self._send_body(conn, framing)
+                start, resp_headers = read_head(conn.rfile)
+                version, status, reason = parse_status(start)
+                while 100 <= status < 200:
+                    # interim responses carry no body; pass them on and wait for the real one
+                    self.wfile.write(format_head(start, end_to_end(resp_headers)))
+                    if expect and status == 100:
+                        expect = False
+                        self._send_body(conn, framing)
+                    start, resp_headers = read_head(conn.rfile)
+                    version, status, reason = parse_status(start)
+                if expect:
+                    # refused before the body was sent; the client may still send it, so drop the connection
+                    self.close_connection = True
+                self.phases.lap("first_byte")
+            except (OSError, HTTPStreamError) as e:
+                pool.discard(conn)
+                if conn.reused:
+                    # the idle stream was closed under us, try again on a fresh one
+                    continue
+                self.send_error(502, f"HTTP error: {e}")
+                return None
+            return conn, version, status, reason, resp_headers
+
+    def _finish(self, conn, version, status, reason, resp_headers, sink=None):
+        pool = self.server.upstream_pool
+        try:
+            reusable = self._send_response(conn, version, status, reason, resp_headers, sink)
+            self.phases.lap("relay")
+        except (OSError, HTTPStreamError):
+            pool.discard(conn)
+            self.close_connection = True
+            return False
+        pool.release(conn, reusable)
+        return True
+
+    def _serve_fresh(self, cache, headers):
+        entry = cache.lookup(self.path, headers)
+        body = cache.open_body(entry) if entry else None
+        if not body:
+            return False
+        with body:
+            if not entry.fresh(headers):
+                return False
+            self._send_cached(cache, entry, body, headers)
+        return True
+
+    # fill: the held fill lock, released as soon as other requests need not wait any longer
+    def _handle_cached(self, cache, fill, host, port, req_line, headers):
+        from http_cache import storable
+        entry = cache.lookup(self.path, headers)
+        body = cache.open_body(entry) if entry else None
+        if body and entry.fresh(headers):
+            fill.release()
+            with body:
+                self._send_cached(cache, entry, body, headers)
+            return
+        upstream_headers = [h for h in headers if h[0].lower() not in ("if-none-match", "if-modified-since")]
+        if body:
+            upstream_headers += entry.validators()
+        else:
+            cache.missed()
+        request_time = time.time()
+        result = self._exchange(host, port, format_head(req_line, upstream_headers))
+        if not result:
+            if body: body.close()
+            return
+        conn, version, status, reason, resp_headers = result
+        if body and status == 304:
+            self.server.upstream_pool.release(conn, upstream_reusable(version, "none", resp_headers))
+            cache.refresh(entry, resp_headers, request_time)
+            fill.release()
+            with body:
+                self._send_cached(cache, entry, body, headers)
+            return
+        if body: body.close()
+        length = get_header(resp_headers, "Content-Length", "")
+        if (not storable("GET", status, headers, resp_headers)
+                or length.isdigit() and int(length) > cache.max_object):
+            cache.mark_pass(self.path)
+            fill.release()
+            self._finish(*result)
+            return
+        stored = [h for h in end_to_end(resp_headers) if h[0].lower() != "content-length"]
+        writer = cache.begin(self.path, headers, status, reason, stored, request_time)
+
+        def sink(data):
+            writer.write(data)
+            # grew past max_object: nothing will be stored for the waiters to read
+            if writer.failed and fill.held:
+                cache.mark_pass(self.path)
+                fill.release()
+        if self._finish(*result, sink=sink):
+            writer.commit()
+        else:
+            writer.abort()
+
+    def _send_cached(self, cache, entry, body, req_headers):
+        if entry.not_modified_for(req_headers):
+            keep = ("etag", "cache-control", "expires", "date", "last-modified", "vary", "content-location")
+            headers = [h for h in entry.headers if h[0].lower() in keep]
+            status, reason, size = 304, "Not Modified", 0
+        else:
+            headers = list(entry.headers) + [("Content-Length", str(entry.size))]
+            status, reason, size = entry.meta["status"], entry.meta["reason"], entry.size
+        headers.append(("Age", str(entry.age())))
+        if self.close_connection:
+            headers.append(("Connection", "close"))
+        elif self.request_version != "HTTP/1.1":
+            headers.append(("Connection", "keep-alive"))
+        self.log_request(status)
+        self.wfile.write(format_head(f"HTTP/1.1 {status} {reason}", headers))
+        if size and self.command != "HEAD":
+            self.connection.sendfile(body)
+        cache.served(size)
+
+    def _send_response(self, conn, version, status, reason, resp_headers, sink=None):
+        framing, length = response_framing(self.command, status, resp_headers)
+        reusable = upstream_reusable(version, framing, resp_headers)
+
+        client_http10 = self.request_version != "HTTP/1.1"
+        dechunk = framing == "chunked" and client_http10
+        headers = end_to_end(resp_headers)
+        if framing == "chunked" and not dechunk:
+            headers.append(("Transfer-Encoding", "chunked"))
+        if framing == "close" or dechunk:
+            self.close_connection = True
+        if self.close_connection:
+            headers.append(("Connection", "close"))
+        elif client_http10:
+            headers.append(("Connection", "keep-alive"))
+
+        self.log_request(status)
+        self.wfile.write(format_head(f"HTTP/1.1 {status} {reason}", headers))
+        write = self.wfile.write
+        if sink:
+            def write(data, client_write=write):
+                client_write(data); sink(data)
+        if framing == "length":
+            copy_length(conn.rfile, write, length)
+        elif framing == "chunked":
+            copy_chunked(conn.rfile, self.wfile.write, raw=not dechunk, sink=sink)
+        elif framing == "close":
+            copy_until_close(conn.rfile, write)
+        return reusable
+
+    def _tunnel(self, src, dst, port):
+        # accounted once per tunnel, nothing is added to the per-chunk relay loop
+        METRICS.inc("torproxy_tunnels_total"); METRICS.inc("torproxy_tunnels_active")
+        started = time.monotonic()
+        try:
+            up, down = relay(src, dst, idle_timeout=self.server.limits.idle_timeout, on_idle=_idle_timeout,
+                             shaped=self.server.shaper.open(self.client_address[0], port),
+                             on_first_byte=lambda: self.phases.lap("first_byte"))
+            self.phases.lap("relay")
         finally:
-            src.close(); dst.close()
+            METRICS.dec("torproxy_tunnels_active")
+            METRICS.observe("torproxy_tunnel_duration_seconds", time.monotonic() - started)
+        METRICS.inc("torproxy_relay_bytes_total", up, UP)
+        METRICS.inc("torproxy_relay_bytes_total", down, DOWN)
+        self.close_connection = True
+
+def _idle_timeout():
+    METRICS.inc("torproxy_timeouts_total", labels=(("phase", "idle"),))
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
-    def __init__(self, addr, handler, tor_socks_port):
-        super().__init__(addr, handler)
+    # the default of 5 drops SYNs as soon as a browser opens a burst of connections
+    request_queue_size = 1024
+    # sock: an already bound and listening socket to serve instead of binding addr
+    # routes: a routes.RouteTable of destinations that bypass tor
+    # shaper: a shaping.Shaper for the bandwidth of tunnels
+    def __init__(self, addr, handler, tor_socks_port, http_cache=None, limits=None, sock=None, connect_policy=None,
+                 routes=None, shaper=None):
+        super().__init__(addr, handler, bind_and_activate=sock is None)
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
         self.tor_socks_port = tor_socks_port
+        self.http_cache = http_cache
+        self.limits = limits or Limits()
+        self.connect_policy = connect_policy or ConnectPolicy()
+        self.routes = routes or RouteTable()
+        self.shaper = shaper or Shaper()
+        # request socket -> when it was accepted, while phase timing is on
+        self.accepted = {}
+        self.upstream_pool = UpstreamPool(lambda host, port: self.open_upstream(host, port, self.limits.idle_timeout))
+        METRICS.add_collector(self._collect)
 
-# ====== Logging ======
-# def log_request(cmd, path, size=0, app_window=None): app_window.append_log(f"[{cmd}] {path} ({size} bytes)\n")
+    # a direct route to the gateway itself, asked for by a client elsewhere; see routes.refused
+    def route_refused(self, client, host, port):
+        return refused(self.routes.lookup(host, port), client, host, port, (self.server_address[1],))
+
+    def open_upstream(self, host, port, timeout=None):
+        route = self.routes.lookup(host, port)
+        if route:
+            return open_route_socket(route, host, port, self.limits.connect_timeout, timeout)
+        return connect_tor(self.tor_socks_port, host, port, self.connect_policy, self.limits.connect_timeout, timeout)
+
+    # over max_connections the client gets a 503 from the accept loop, no thread is started
+    def process_request(self, request, client_address):
+        if not self.limits.open_connection():
+            _refuse(request)
+            return
+        if PROFILER.timing:
+            self.accepted[request] = time.monotonic()
+        try:
+            super().process_request(request, client_address)
+        except RuntimeError:
+            # can't start new thread
+            self.accepted.pop(request, None)
+            self.limits.close_connection()
+            shed("threads")
+            _refuse(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            if self.accepted: self.accepted.pop(request, None)
+            self.limits.close_connection()
+
+    def _collect(self):
+        out = {"torproxy_upstream_idle_connections": self.upstream_pool.idle_count()}
+        out.update(self.limits.collect())
+        if self.http_cache:
+            stats = self.http_cache.stats()
+            out["torproxy_http_cache_entries"] = stats.pop("entries")
+            out["torproxy_http_cache_bytes"] = stats.pop("bytes")
+            out["torproxy_http_cache_events_total"] = {(("event", k),): v for k, v in stats.items()}
+        return out
+
+    def server_close(self):
+        super().server_close()
+        METRICS.remove_collector(self._collect)
+        self.upstream_pool.close()
+
+def _refuse(sock):
+    try:
+        sock.setblocking(False)
+        sock.send(OVERLOADED)
+    except OSError:
+        pass
+    sock.close()
@@ -0,0 +1,213 @@
+import os
+import sys
+import errno
+import select
+import socket
+import struct
+import time
+
+MIN_BUFFER = 16 * 1024
+MAX_BUFFER = 256 * 1024
+HAS_SPLICE = sys.platform.startswith("linux") and hasattr(os, "splice")
+
+
+def set_nodelay(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+# poll has no FD_SETSIZE limit; select() fails once descriptors pass 1024
+def _writable(sock, timeout):
+    if hasattr(select, "poll"):
+        p = select.poll()
+        p.register(sock, select.POLLOUT)
+        return bool(p.poll(None if timeout is None else timeout * 1000))
+    return bool(select.select([], [sock], [], timeout)[1])
+
+
+def readable(sock, timeout=0):
+    if hasattr(select, "poll"):
+        p = select.poll()
+        p.register(sock, select.POLLIN)
+        return bool(p.poll(None if timeout is None else timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+# close with RST: whatever a stalled peer has not read is dropped instead of lingering in the kernel
+def reset(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    except OSError:
+        pass
+    sock.close()
+
+
+def _shutdown(sock, how):
+    try:
+        sock.shutdown(how)
+    except OSError:
+        pass
+
+
+# ====== One direction of a tunnel ======
+class _Flow:
+    def __init__(self, src, dst, use_splice, timeout=None, max_size=MAX_BUFFER):
+        self.src = src; self.dst = dst
+        self.timeout = timeout
+        self.max_size = max_size
+        self.size = min(MIN_BUFFER, max_size)
+        self.bytes = 0
+        self.open = True
+        self.buf = None; self.view = None
+        self.pipe = None
+        if use_splice:
+            try:
+                self.pipe = os.pipe()
+                try:
+                    import fcntl
+                    fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, MAX_BUFFER)
+                except (ImportError, AttributeError, OSError):
+                    pass
+            except OSError:
+                self.pipe = None
+
+    def _adapt(self, n):
+        if n >= self.size and self.size < self.max_size:
+            self.size = min(self.size * 2, self.max_size)
+        elif n < self.size // 8 and self.size > MIN_BUFFER:
+            self.size //= 2
+
+    def pump(self):
+        if self.pipe:
+            try:
+                return self._splice()
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # socket type does not support splice, e.g. a wrapped socket
+                self.close_pipe()
+        return self._copy()
+
+    def _splice(self):
+        try:
+            n = os.splice(self.src.fileno(), self.pipe[1], self.size,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return True
+        if not n:
+            return False
+        left = n
+        while left:
+            try:
+                left -= os.splice(self.pipe[0], self.dst.fileno(), left, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                # a socket with a timeout is non-blocking underneath
+                if not _writable(self.dst, self.timeout):
+                    raise socket.timeout("peer stopped reading")
+        self.bytes += n
+        self._adapt(n)
+        return True
+
+    def _copy(self):
+        if self.buf is None or len(self.buf) < self.size:
+            self.buf = bytearray(self.size)
+            self.view = memoryview(self.buf)
+        try:
+            n = self.src.recv_into(self.view, self.size)
+        except BlockingIOError:
+            return True
+        if not n:
+            return False
+        self.dst.sendall(self.view[:n])
+        self.bytes += n
+        self._adapt(n)
+        return True
+
+    def close_pipe(self):
+        if self.pipe:
+            os.close(self.pipe[0]); os.close(self.pipe[1])
+            self.pipe = None
+
+
+# puts paused directions whose time is up back into the poll set; returns the poll timeout
+def _resume(paused, poller, timeout):
+    now = time.monotonic()
+    for fd, until in list(paused.items()):
+        if until <= now:
+            del paused[fd]
+            if poller: poller.register(fd, select.POLLIN)
+    if not paused:
+        return timeout
+    wait = min(paused.values()) - now
+    return wait if timeout is None else min(wait, timeout)
+
+
+# ====== Relay ======
+# Copies a<->b until both directions hit EOF, propagating half-closes with shutdown().
+# With idle_timeout the tunnel is closed once nothing moved either way for that long,
+# or a peer stopped reading for that long; on_idle() is called when that happens.
+# Returns the byte counts (a->b, b->a); both sockets are closed on return.
+# shaped: a shaping.Tunnel (a is the client); after each read the direction that read
+# sits out of the poll set for as long as its buckets say.
+# on_first_byte() is called once, when the first data from b has been passed on.
+def relay(a, b, nodelay=True, use_splice=None, idle_timeout=None, on_idle=None, shaped=None, on_first_byte=None):
+    if use_splice is None:
+        use_splice = HAS_SPLICE
+    flows = {}
+    paused = {}  # fd -> when its direction may read again
+    try:
+        for s in (a, b):
+            s.settimeout(idle_timeout)
+            if nodelay:
+                set_nodelay(s)
+        max_size = shaped.shaper.quantum if shaped else MAX_BUFFER
+        flows[a] = _Flow(a, b, use_splice, idle_timeout, max_size)
+        flows[b] = _Flow(b, a, use_splice, idle_timeout, max_size)
+        fds = {s.fileno(): flows[s] for s in (a, b)}
+        directions = {a.fileno(): 0, b.fileno(): 1}
+        poller = select.poll() if hasattr(select, "poll") else None
+        if poller:
+            for fd in fds:
+                poller.register(fd, select.POLLIN)
+        while any(f.open for f in fds.values()):
+            timeout = _resume(paused, poller, idle_timeout) if paused else idle_timeout
+            if poller:
+                ready = [fd for fd, _ in poller.poll(None if timeout is None else timeout * 1000)]
+            else:
+                ready = select.select([fd for fd, f in fds.items() if f.open and fd not in paused], [], [], timeout)[0]
+            if not ready:
+                # waking up for a paused direction is not idleness
+                if paused:
+                    continue
+                if on_idle: on_idle()
+                reset(a); reset(b)
+                break
+            for fd in ready:
+                flow = fds[fd]
+                before = flow.bytes
+                if not flow.pump():
+                    flow.open = False
+                    if poller: poller.unregister(fd)
+                    _shutdown(flow.dst, socket.SHUT_WR)
+                    continue
+                if on_first_byte and flow.dst is a and flow.bytes:
+                    on_first_byte()
+                    on_first_byte = None
+                if shaped and flow.bytes > before:
+                    delay = shaped.take(directions[fd], flow.bytes - before)
+                    if delay > 0:
+                        paused[fd] = time.monotonic() + delay
+                        if poller: poller.unregister(fd)
+    except socket.timeout:
+        if on_idle: on_idle()
+        reset(a); reset(b)
+    except OSError:
+        pass
+    finally:
+        for flow in flows.values():
+            flow.close_pipe()
+        if shaped: shaped.close()
+        a.close(); b.close()
+    return (flows[a].bytes if a in flows else 0), (flows[b].bytes if b in flows else 0)
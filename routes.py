@@ -0,0 +1,173 @@
+import json
+import socket
+import ipaddress
+from urllib.parse import urlsplit
+from blocklist import DomainMatcher, parse_rule, SELF_AND_SUBS
+
+PAC_PATH = "/proxy.pac"
+DIRECT = "direct"
+# inet_pton is several times cheaper than ipaddress.ip_address on the lookup path
+_FAMILIES = ((socket.AF_INET, 4, 32), (socket.AF_INET6, 6, 128))
+
+
+# ====== Route ======
+# Where a matched destination goes instead of tor: "direct", or another proxy given as
+# socks5://host:port, socks4://host:port or http://host:port (CONNECT)
+class Route:
+    schemes = ("socks5", "socks4", "http")
+
+    def __init__(self, spec=DIRECT):
+        self.spec = spec
+        self.scheme, self.host, self.port = DIRECT, None, None
+        if spec != DIRECT:
+            url = urlsplit(spec)
+            if url.scheme not in self.schemes or not url.hostname or not url.port:
+                raise ValueError(f"bad route: {spec}")
+            self.scheme, self.host, self.port = url.scheme, url.hostname, url.port
+
+    def pac(self):
+        if self.scheme == DIRECT:
+            return "DIRECT"
+        kind = {"socks5": "SOCKS5", "socks4": "SOCKS", "http": "PROXY"}[self.scheme]
+        return f"{kind} {self.host}:{self.port}"
+
+
+# ====== Route table ======
+# Rules are "<destination> [route]", the route defaulting to direct:
+#   "corp.example"  "*.lan"        domains, same syntax as the blocklist
+#   "10.0.0.0/8"    "192.168.1.5"  networks and addresses, for IP literal destinations
+#   ":5432"                        a port, whatever the host
+#   "intranet.example socks5://10.0.0.1:1080"
+# A host rule beats a port rule, the most specific domain or network wins. Lookups are a
+# trie walk, a few dict probes (one per distinct prefix length) and one for the port.
+class RouteTable:
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.domains = DomainMatcher()
+        self.networks = {4: {}, 6: {}}  # version -> {prefix length: {network >> host bits: route}}
+        self.ports = {}
+        routes = {}
+        for rule in self.rules:
+            target, _, spec = rule.strip().partition(" ")
+            spec = spec.strip() or DIRECT
+            route = routes.get(spec) or routes.setdefault(spec, Route(spec))
+            self._add(target, route)
+        self.lengths = {v: sorted(nets, reverse=True) for v, nets in self.networks.items()}
+
+    def _add(self, target, route):
+        if _is_port(target):
+            self.ports[int(target[1:])] = route
+            return
+        try:
+            net = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            self.domains.add(target, route)
+            return
+        shift = net.max_prefixlen - net.prefixlen
+        self.networks[net.version].setdefault(net.prefixlen, {})[int(net.network_address) >> shift] = route
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    # the Route for host:port, None for tor
+    def lookup(self, host, port=None):
+        if not self.rules:
+            return None
+        route = self._lookup_ip(host) if host[-1:].isdigit() or ":" in host or host.startswith("[") else None
+        if route is None:
+            route = self.domains.lookup(host)
+        if route is None:
+            route = self.ports.get(port)
+        return route
+
+    def _lookup_ip(self, host):
+        host = host.strip("[]")
+        for family, version, bits in _FAMILIES:
+            try:
+                value = int.from_bytes(socket.inet_pton(family, host), "big")
+            except OSError:
+                continue
+            nets = self.networks[version]
+            for length in self.lengths[version]:
+                route = nets[length].get(value >> (bits - length))
+                if route:
+                    return route
+            return None
+        return None
+
+    # ====== PAC ======
+    # The same rules as a proxy auto-config script, so browsers skip this proxy for bypassed
+    # hosts. IPv6 networks are left to the proxy, PAC's isInNet() only knows IPv4.
+    def pac(self, proxy_address):
+        domains, networks, ports = {}, [], {}
+        for rule in self.rules:
+            target, _, spec = rule.strip().partition(" ")
+            result = Route(spec.strip() or DIRECT).pac()
+            if _is_port(target):
+                ports[target[1:]] = result
+                continue
+            try:
+                net = ipaddress.ip_network(target, strict=False)
+            except ValueError:
+                labels, kind = parse_rule(target)
+                if labels is not None:
+                    domains[".".join(labels)] = [kind, result]
+                continue
+            if net.version == 4:
+                networks.append([str(net.network_address), str(net.netmask), net.prefixlen, result])
+        networks.sort(key=lambda n: -n[2])
+        return _PAC_TEMPLATE % {"domains": json.dumps(domains), "networks": json.dumps(networks),
+                                "ports": json.dumps(ports), "self": SELF_AND_SUBS, "proxy": json.dumps(f"PROXY {proxy_address}")}
+
+
+def _is_port(target):
+    return target[:1] == ":" and target[1:].isdigit()
+
+
+# ====== Gateway guard ======
+# The proxy listens on every interface, so a direct route to the gateway itself would hand LAN
+# clients its loopback-only services (tor's ControlPort) or loop back into the proxy. Only
+# clients on the gateway may take one. Names are judged as written, not resolved.
+def is_local(host):
+    host = host.strip("[]").rstrip(".").lower()
+    if host == "localhost" or host.endswith(".localhost"):
+        return True
+    try:
+        ip = ipaddress.ip_address(host.partition("%")[0])
+    except ValueError:
+        return False
+    ip = getattr(ip, "ipv4_mapped", None) or ip
+    # connecting to 0.0.0.0 or :: reaches the local host too
+    return ip.is_loopback or ip.is_unspecified
+
+
+def refused(route, client, host, port, own_ports=()):
+    return (route is not None and route.scheme == DIRECT and not is_local(client)
+            and (is_local(host) or port in own_ports))
+
+
+def routes_from_config(config):
+    return RouteTable(config["routes"])
+
+
+_PAC_TEMPLATE = """var domains = %(domains)s;
+var networks = %(networks)s;
+var ports = %(ports)s;
+function FindProxyForURL(url, host) {
+  host = host.toLowerCase();
+  if (/^\\d+\\.\\d+\\.\\d+\\.\\d+$/.test(host)) {
+    for (var i = 0; i < networks.length; i++)
+      if (isInNet(host, networks[i][0], networks[i][1])) return networks[i][3];
+  } else {
+    var labels = host.split("."), found = null;
+    for (var i = labels.length; i >= 0; i--) {
+      var rule = domains[labels.slice(i).join(".")];
+      if (rule && (rule[0] & %(self)d ? i < labels.length : i > 0)) found = rule[1];
+    }
+    if (found) return found;
+  }
+  var m = /^[a-z]+:\\/\\/[^\\/]*:(\\d+)/.exec(url);
+  var port = m ? m[1] : (url.substring(0, 6) == "https:" ? "443" : "80");
+  return ports[port] || %(proxy)s;
+}
+"""
@@ -0,0 +1,172 @@
+import time
+import threading
+from metrics import METRICS
+from defaults import DEFAULT_INTERACTIVE_PORTS
+
+# tunnel directions: client -> upstream, upstream -> client
+UPLOAD, DOWNLOAD = 0, 1
+INTERACTIVE, BULK = "interactive", "bulk"
+# a tunnel counts as interactive (keystrokes, chat, short requests) until it has moved
+# BULK_AFTER bytes in reads averaging SMALL_READ or more
+BULK_AFTER = 64 * 1024
+SMALL_READ = 2048
+# one read is at most this many seconds of the cap, so nothing books far ahead of the others
+QUANTUM = 0.05
+MIN_QUANTUM = 4096
+MAX_QUANTUM = 256 * 1024
+# tor is capped a little above the proxy (cells carry overhead), so its queues stay short
+# and the waiting happens here, where interactive tunnels go first
+TOR_HEADROOM = 1.1
+
+
+# rate and burst in bytes per second / bytes. take() charges bytes that were already sent,
+# the bucket may go into debt, and returns how long the tunnel should wait before reading more
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self, n, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# ====== Weighted fair queuing ======
+# One direction of the global cap. Each class has a clock for when the bytes it booked are
+# through, and is served at its weight's share of the rate among the classes with bytes
+# still booked: bulk gets the whole link while interactive tunnels only trickle, and gives
+# way when they get busy.
+class _Link:
+    def __init__(self, rate, weights):
+        self.rate = rate
+        self.weights = weights
+        self.clock = dict.fromkeys(weights, 0.0)
+
+    def take(self, cls, n, now):
+        busy = sum(w for c, w in self.weights.items() if c == cls or self.clock[c] > now)
+        self.clock[cls] = max(now, self.clock[cls]) + n * busy / (self.rate * self.weights[cls])
+        return self.clock[cls] - now
+
+
+# ====== Shaper ======
+# Shared by every listener of a Runner, like admission.Limits. Rates are bytes per second
+# for each direction, 0 for no cap:
+#   up, down     the whole proxy, shared between interactive and bulk tunnels by weight
+#   per_client   each client address
+#   per_tunnel   each CONNECT / SOCKS tunnel
+# A tunnel to one of interactive_ports is always interactive; others are classified by the
+# size of their reads as they go. Unshaped, the relay loops run exactly as before.
+class Shaper:
+    def __init__(self, up=0, down=0, per_client=0, per_tunnel=0, interactive_ports=DEFAULT_INTERACTIVE_PORTS,
+                 interactive_weight=4):
+        self.up = up
+        self.down = down
+        self.per_client = per_client
+        self.per_tunnel = per_tunnel
+        self.interactive_ports = frozenset(interactive_ports)
+        self.interactive_weight = interactive_weight
+        weights = {INTERACTIVE: interactive_weight, BULK: 1}
+        self.links = (_Link(up, weights) if up else None, _Link(down, weights) if down else None)
+        self.clients = {}  # address -> [tunnels, (upload bucket, download bucket)]
+        self._lock = threading.Lock()
+        rates = [r for r in (up, down, per_client, per_tunnel) if r]
+        # largest read a shaped tunnel makes
+        self.quantum = min(MAX_QUANTUM, max(MIN_QUANTUM, int(min(rates) * QUANTUM))) if rates else None
+
+    def __bool__(self):
+        return self.quantum is not None
+
+    # constructor arguments, to rebuild the same shaper in a worker process
+    def settings(self):
+        return {"up": self.up, "down": self.down, "per_client": self.per_client, "per_tunnel": self.per_tunnel,
+                "interactive_ports": sorted(self.interactive_ports), "interactive_weight": self.interactive_weight}
+
+    # None when nothing is capped, the relay then skips shaping entirely
+    def open(self, client, port):
+        if not self:
+            return None
+        return Tunnel(self, client, port)
+
+    def _join(self, client):
+        if not self.per_client:
+            return None
+        with self._lock:
+            entry = self.clients.get(client)
+            if entry is None:
+                entry = self.clients[client] = [0, (TokenBucket(self.per_client), TokenBucket(self.per_client))]
+            entry[0] += 1
+            return entry[1]
+
+    def _leave(self, client):
+        if not self.per_client:
+            return
+        with self._lock:
+            entry = self.clients[client]
+            entry[0] -= 1
+            if not entry[0]:
+                del self.clients[client]
+
+    def _take(self, tunnel, direction, n):
+        now = time.monotonic()
+        delay = 0.0
+        with self._lock:
+            link = self.links[direction]
+            if link:
+                delay = link.take(tunnel.cls, n, now)
+            if tunnel.buckets:
+                delay = max(delay, tunnel.buckets[direction].take(n, now))
+            if tunnel.client_buckets:
+                wait = tunnel.client_buckets[direction].take(n, now)
+                # an interactive tunnel pays into its client's bucket but does not queue behind
+                # the debt bulk tunnels ran up, only behind its own bytes
+                if tunnel.cls == INTERACTIVE:
+                    wait = min(wait, n / self.per_client)
+                delay = max(delay, wait)
+        if delay > 0:
+            METRICS.inc("torproxy_shaping_delay_seconds_total", delay, labels=(("class", tunnel.cls),))
+        return delay
+
+    # bytes per second for tor's BandwidthRate, 0 when there is no global cap
+    def tor_rate(self):
+        return int(max(self.up, self.down) * TOR_HEADROOM)
+
+
+class Tunnel:
+    def __init__(self, shaper, client, port):
+        self.shaper = shaper
+        self.client = client
+        self.pinned = port in shaper.interactive_ports
+        self.cls = INTERACTIVE
+        self.bytes = 0
+        self.average = 0.0
+        rate = shaper.per_tunnel
+        self.buckets = (TokenBucket(rate), TokenBucket(rate)) if rate else None
+        self.client_buckets = shaper._join(client)
+
+    # charges n bytes just relayed in direction; returns seconds to wait before the next read
+    def take(self, direction, n):
+        self.bytes += n
+        self.average += (n - self.average) / 8
+        if not self.pinned:
+            self.cls = BULK if self.bytes > BULK_AFTER and self.average >= SMALL_READ else INTERACTIVE
+        return self.shaper._take(self, direction, n)
+
+    def close(self):
+        self.shaper._leave(self.client)
+        METRICS.inc("torproxy_shaped_tunnels_total", labels=(("class", self.cls),))
+
+
+# the config keys shaper_from_config reads
+SHAPING_KEYS = ("bandwidth_up", "bandwidth_down", "bandwidth_per_client", "bandwidth_per_tunnel", "interactive_ports",
+                "interactive_weight")
+
+
+# rates in the config are KiB/s
+def shaper_from_config(config):
+    kib = lambda v: int(v * 1024)
+    return Shaper(kib(config["bandwidth_up"]), kib(config["bandwidth_down"]), kib(config["bandwidth_per_client"]),
+                  kib(config["bandwidth_per_tunnel"]), config["interactive_ports"], config["interactive_weight"])
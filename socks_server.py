@@ -0,0 +1,151 @@
+import errno
+import socket
+import struct
+import asyncio
+from proxy import is_blocked
+from aio_proxy import AsyncProxyHandler, AsyncProxyServer, SocksError, admit, handshake_timeout
+from metrics import METRICS, method_labels
+from logpipe import LOG
+
+# SOCKS5 reply codes (RFC 1928); SOCKS4 only knows granted (0x5A) and rejected (0x5B)
+GENERAL_FAILURE = 1
+NOT_ALLOWED = 2
+NETWORK_UNREACHABLE = 3
+HOST_UNREACHABLE = 4
+CONNECTION_REFUSED = 5
+TTL_EXPIRED = 6
+COMMAND_NOT_SUPPORTED = 7
+ADDRESS_NOT_SUPPORTED = 8
+
+
+# the reply for a connect that failed: tor's own code, or the nearest one for a local error
+def reply_code(e):
+    if isinstance(e, SocksError):
+        return e.code
+    if isinstance(e, (asyncio.TimeoutError, socket.timeout)):
+        return TTL_EXPIRED
+    if isinstance(e, ConnectionRefusedError):
+        return CONNECTION_REFUSED
+    if isinstance(e, socket.gaierror) or isinstance(e, OSError) and e.errno == errno.EHOSTUNREACH:
+        return HOST_UNREACHABLE
+    if isinstance(e, OSError) and e.errno == errno.ENETUNREACH:
+        return NETWORK_UNREACHABLE
+    return GENERAL_FAILURE
+
+
+# ====== SOCKS5 / SOCKS4a inbound ======
+# For clients that speak SOCKS: a few fixed-size reads instead of HTTP parsing, the same
+# blocklist as the HTTP proxy, and hostnames are passed to tor unresolved (remote DNS).
+# Only CONNECT without authentication is offered.
+class SocksHandler(AsyncProxyHandler):
+    async def handle(self):
+        self.status = "-"
+        self.target = None
+        try:
+            request = await asyncio.wait_for(self._negotiate(), self.server.limits.handshake_timeout)
+            self.phases.lap("parse")
+            if request:
+                await self._connect(*request)
+        except asyncio.TimeoutError:
+            handshake_timeout()
+            self.writer.close()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            self.writer.close()
+        finally:
+            if self.target:
+                LOG.write(f'{self.client} "SOCKS{self.socks_version} {self.target}" {self.status}')
+
+    # returns (command, host, port), or None when the client was already answered
+    async def _negotiate(self):
+        (self.socks_version,) = await self.reader.readexactly(1)
+        if self.socks_version == 5:
+            return await self._socks5()
+        if self.socks_version == 4:
+            return await self._socks4()
+        self.writer.close()
+
+    async def _socks5(self):
+        read = self.reader.readexactly
+        (n,) = await read(1)
+        if 0 not in await read(n):
+            self.writer.write(b"\x05\xff")
+            self.writer.close()
+            return None
+        self.writer.write(b"\x05\x00")
+        _, cmd, _, atyp = await read(4)
+        if atyp == 1:
+            host = socket.inet_ntop(socket.AF_INET, await read(4))
+        elif atyp == 3:
+            (n,) = await read(1)
+            host = (await read(n)).decode("latin-1")
+        elif atyp == 4:
+            host = socket.inet_ntop(socket.AF_INET6, await read(16))
+        else:
+            await self._fail(ADDRESS_NOT_SUPPORTED)
+            return None
+        (port,) = struct.unpack("!H", await read(2))
+        return cmd, host, port
+
+    async def _socks4(self):
+        cmd, port, ip = struct.unpack("!BH4s", await self.reader.readexactly(7))
+        await self.reader.readuntil(b"\0")  # user id
+        # SOCKS4a: 0.0.0.x with x != 0 means a hostname follows
+        if ip[:3] == b"\0\0\0" and ip[3]:
+            host = (await self.reader.readuntil(b"\0"))[:-1].decode("latin-1")
+        else:
+            host = socket.inet_ntoa(ip)
+        return cmd, host, port
+
+    async def _connect(self, cmd, host, port):
+        self.target = f"{host}:{port}"
+        METRICS.inc("torproxy_requests_total", labels=method_labels(f"SOCKS{self.socks_version}"))
+        if cmd != 1:
+            await self._fail(COMMAND_NOT_SUPPORTED)
+            return
+        if is_blocked(host) or self.server.route_refused(self.client, host, port):
+            await self._fail(NOT_ALLOWED)
+            return
+        self.phases.lap("blocklist")
+        limits = self.server.limits
+        if await admit(limits, self.client, host):
+            await self._fail(GENERAL_FAILURE)
+            return
+        self.phases.lap("admission")
+        try:
+            try:
+                r_reader, r_writer, lease = await self.server.open_upstream(host, port)
+            except Exception as e:
+                await self._fail(reply_code(e))
+                return
+            self.phases.lap("handshake")
+            if self.socks_version == 5:
+                self.status = 0
+                reply = b"\x05\x00\x00\x01" + b"\0" * 6
+            else:
+                self.status = 0x5a
+                reply = b"\x00\x5a" + b"\0" * 6
+            await self._relay(reply, r_reader, r_writer, lease, port)
+        finally:
+            limits.release(self.client, host)
+
+    async def _fail(self, code):
+        METRICS.inc("torproxy_socks_errors_total", labels=(("code", code),))
+        if self.socks_version == 5:
+            self.status = code
+            self.writer.write(b"\x05" + bytes([code]) + b"\x00\x01" + b"\0" * 6)
+        else:
+            self.status = 0x5b
+            self.writer.write(b"\x00\x5b" + b"\0" * 6)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class SocksServer(AsyncProxyServer):
+    handler_class = SocksHandler
+
+    # an HTTP 503 means nothing to a SOCKS client
+    def refuse(self, writer):
+        writer.close()
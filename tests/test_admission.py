@@ -0,0 +1,36 @@
+import asyncio
+import threading
+from admission import Limits
+from aio_proxy import admit
+
+
+def test_limits():
+    limits = Limits(max_tunnels=3, per_client=2, per_host=2)
+    assert limits.try_admit("a", "x") is None and limits.try_admit("a", "y") is None
+    assert limits.try_admit("a", "z") == "per_client"
+    assert limits.try_admit("b", "x") is None
+    assert limits.try_admit("b", "x") == "max_tunnels"
+    limits.release("a", "y")
+    assert limits.try_admit("c", "x") == "per_host"
+    assert limits.try_admit("c", "y") is None
+    assert (limits.tunnels, limits.clients, limits.hosts) == (3, {"a": 1, "b": 1, "c": 1}, {"x": 2, "y": 1})
+
+
+def test_threaded_admit_waits_for_a_release():
+    limits = Limits(max_tunnels=1, wait=5)
+    limits.try_admit("a", "x")
+    threading.Timer(0.1, limits.release, ("a", "x")).start()
+    assert limits.admit("b", "x") is None and limits.waiting == 0
+
+
+def test_event_loop_admit_counts_its_waiters():
+    limits = Limits(max_tunnels=1, wait=0.3)
+    limits.try_admit("a", "x")
+    seen = []
+    async def main():
+        waiters = [asyncio.ensure_future(admit(limits, "b", "x")) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        seen.append(limits.waiting)
+        return await asyncio.gather(*waiters)
+    assert asyncio.run(main()) == ["max_tunnels"] * 3
+    assert seen == [3] and limits.waiting == 0
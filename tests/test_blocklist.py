@@ -0,0 +1,47 @@
+import pytest
+from blocklist import DomainMatcher, parse_rule, normalize_host, SELF_AND_SUBS, SUBS_ONLY
+
+
+@pytest.mark.parametrize("rule, parsed", [
+    ("example.com", (("example", "com"), SELF_AND_SUBS)),
+    (" Example.COM. ", (("example", "com"), SELF_AND_SUBS)),
+    ("*example.com", (("example", "com"), SELF_AND_SUBS)),
+    ("*.example.com", (("example", "com"), SUBS_ONLY)),
+    ("*", ((), SUBS_ONLY)),
+    ("", (None, 0)),
+])
+def test_parse_rule(rule, parsed):
+    assert parse_rule(rule) == parsed
+
+
+def test_normalize_host():
+    assert normalize_host(" WWW.Example.com. ") == "www.example.com"
+
+
+@pytest.mark.parametrize("rules, host, matched", [
+    (["example.com"], "example.com", True),
+    (["example.com"], "a.b.example.com", True),
+    (["example.com"], "notexample.com", False),
+    (["example.com"], "com", False),
+    (["*.example.com"], "example.com", False),
+    (["*.example.com"], "a.example.com", True),
+    (["*.example.com", "example.com"], "example.com", True),
+    (["*"], "anything.at.all", True),
+    (["*"], "", False),
+    ([], "example.com", False),
+])
+def test_match(rules, host, matched):
+    matcher = DomainMatcher(rules)
+    assert matcher.match(host) is matched
+    assert (host in matcher) is matched
+
+
+def test_lookup_returns_the_most_specific_value():
+    matcher = DomainMatcher()
+    matcher.add("example.com", "outer")
+    matcher.add("*.inner.example.com", "inner")
+    assert matcher.lookup("www.example.com") == "outer"
+    assert matcher.lookup("inner.example.com") == "outer"
+    assert matcher.lookup("a.inner.example.com") == "inner"
+    assert matcher.lookup("example.org") is None
+    assert len(matcher) == 2
@@ -0,0 +1,137 @@
+import os
+import pytest
+from blockstore import BlockStore, Index, parse_line, write_index
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "blocked_hosts.json")
+
+
+def indexes(path):
+    return sorted(name for name in os.listdir(os.path.dirname(path)) if name.endswith(".idx"))
+
+
+# ====== Importers ======
+@pytest.mark.parametrize("line, rules", [
+    ("0.0.0.0 ads.example.com tracker.example.com # comment", ["ads.example.com", "tracker.example.com"]),
+    ("::1 ads.example.com", ["ads.example.com"]),
+    ("127.0.0.1 localhost", []),
+    ("||ads.example.com^$third-party", ["ads.example.com"]),
+    ("||ads.example.com^|", ["ads.example.com"]),
+    ("||ads.example.com/path^", []),
+    ("@@||ok.example.com^", []),
+    ("example.com##.banner", []),
+    ("! comment", []),
+    ("plain.example.com", ["plain.example.com"]),
+    ("nodot", []),
+])
+def test_parse_line(line, rules):
+    assert parse_line(line) == rules
+
+
+# ====== Index ======
+def test_index(tmp_path):
+    path = str(tmp_path / "x.idx")
+    assert write_index(path, ["b.example", "a.example", "*.a.example", "a.example", "*"]) == 4
+    index = Index(path)
+    assert len(index) == 4 and index.count == 3
+    assert list(index) == ["*", "a.example", "*.a.example", "b.example"]
+    assert "a.example" in index and "*.a.example" in index and "*.b.example" not in index
+    assert index.kind("c.example") == 0
+
+
+# ====== Store ======
+def test_legacy_json_is_imported_once(path):
+    with open(path, "w") as f:
+        f.write('["ads.example.com", "*.cdn.example"]')
+    store = BlockStore(path).load()
+    assert store.match("x.ads.example.com") and store.match("a.cdn.example") and not store.match("cdn.example")
+    assert indexes(path) == ["blocked_hosts.idx"]
+    BlockStore(path).load()
+    assert indexes(path) == ["blocked_hosts.idx"]
+
+
+def test_add_remove_and_delta_replay(path):
+    store = BlockStore(path).load()
+    store.import_lists([])
+    assert store.add("ads.example.com") and not store.add("ADS.example.com.")
+    assert store.add("*.cdn.example")
+    assert store.remove("*.cdn.example") and not store.remove("*.cdn.example")
+    assert store.match("x.ads.example.com") and not store.match("a.cdn.example")
+    # a reader replays the delta log
+    reader = BlockStore(path).load()
+    assert list(reader) == ["ads.example.com"]
+    assert reader.match("ads.example.com")
+    store.add("more.example")
+    reader.refresh()
+    assert reader.match("a.more.example") and len(reader) == 2
+
+
+def test_removing_an_indexed_rule(path):
+    store = BlockStore(path).load()
+    store.import_lists([_list(path, "ads.example.com\nother.example\n")])
+    assert store.remove("ads.example.com")
+    assert not store.match("ads.example.com") and store.match("other.example")
+    assert list(store) == ["other.example"] and store.pending() == 1
+    reader = BlockStore(path).load()
+    assert not reader.match("ads.example.com") and len(reader) == 1
+
+
+def test_compact_writes_a_new_generation(path):
+    store = BlockStore(path).load()
+    store.import_lists([_list(path, "a.example\n")])
+    reader = BlockStore(path).load()
+    store.add("b.example")
+    store.compact()
+    assert store.pending() == 0 and not os.path.exists(store.delta_path)
+    # the reader still maps generation 0, which Windows would keep until it lets go
+    assert indexes(path)[-1] == "blocked_hosts.1.idx"
+    reader.refresh()
+    assert reader.index.path == store.index.path
+    assert sorted(reader) == ["a.example", "b.example"]
+    store.compact()
+    reader.refresh()
+    assert store.index_path.endswith("blocked_hosts.2.idx")
+    assert sorted(reader) == ["a.example", "b.example"]
+
+
+def test_replace_import_drops_added_rules(path):
+    store = BlockStore(path).load()
+    store.add("old.example")
+    assert store.match("old.example")
+    store.import_lists([_list(path, "new.example\n")], replace=True)
+    assert list(store) == ["new.example"]
+    assert not store.match("old.example") and store.match("new.example")
+
+
+def test_reader_forgets_a_rule_removed_and_compacted(path):
+    store = BlockStore(path).load()
+    store.import_lists([_list(path, "keep.example\n")])
+    reader = BlockStore(path).load()
+    store.add("x.example")
+    reader.refresh()
+    assert reader.match("x.example")
+    store.remove("x.example")
+    store.compact()
+    reader.refresh()
+    assert list(reader) == ["keep.example"]
+    assert not reader.match("x.example") and reader.match("keep.example")
+
+
+def test_outdated(path):
+    store = BlockStore(path).load()
+    source = _list(path, "a.example\n")
+    assert store.outdated([source])
+    store.import_lists([source])
+    assert not store.outdated([source])
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert store.outdated([source])
+
+
+def _list(path, text):
+    source = os.path.join(os.path.dirname(path), "list.txt")
+    with open(source, "w") as f:
+        f.write(text)
+    return source
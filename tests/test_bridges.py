@@ -0,0 +1,117 @@
+import time
+import socket
+import pytest
+from bridges import BridgeProber, probe_target, transport, bridge_lines
+
+FP = "0123456789ABCDEF0123456789ABCDEF01234567"
+
+
+@pytest.mark.parametrize("line, target", [
+    (f"192.0.2.1:443 {FP}", ("192.0.2.1", 443, None)),
+    (f"[2001:db8::1]:9001 {FP}", ("2001:db8::1", 9001, None)),
+    (f"obfs4 198.51.100.7:1234 {FP} cert=abc iat-mode=0", ("198.51.100.7", 1234, None)),
+    (f"meek_lite 192.0.2.2:80 {FP} url=https://meek.example.net/ front=cdn.example.com", ("cdn.example.com", 443, "cdn.example.com")),
+    (f"snowflake 192.0.2.3:80 {FP} url=https://broker.example/ fronts=a.example.com,b.example.com ice=stun:x:3478",
+     ("a.example.com", 443, "a.example.com")),
+    (f"webtunnel [2001:db8::2]:443 {FP} url=https://wt.example.org/secret/path ver=0.0.1", ("wt.example.org", 443, "wt.example.org")),
+])
+def test_probe_target(line, target):
+    assert probe_target(line) == target
+
+
+def test_transport_and_bridge_lines():
+    text = f"Bridge obfs4 198.51.100.7:1234 {FP} cert=abc\n# comment\n\n192.0.2.1:443 {FP}\n"
+    lines = bridge_lines(text)
+    assert [transport(line) for line in lines] == ["obfs4", "vanilla"]
+
+
+# ====== Stand-ins ======
+@pytest.fixture
+def listeners():
+    socks = []
+
+    def listen():
+        s = socket.create_server(("127.0.0.1", 0))
+        socks.append(s)
+        return s.getsockname()[1]
+    yield listen
+    for s in socks:
+        s.close()
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class CountingProber(BridgeProber):
+    def __init__(self, *args, **kwargs):
+        self.probed = []
+        super().__init__(*args, catalog=[], timeout=2.0, **kwargs)
+
+    async def _probe_all(self, lines):
+        self.probed.extend(lines)
+        return await super()._probe_all(lines)
+
+
+def age(prober, line, seconds):
+    prober.results[line]["time"] -= seconds
+
+
+# ====== Probing ======
+def test_probe_reachable_and_unreachable(listeners):
+    up, down = f"127.0.0.1:{listeners()} {FP}", f"127.0.0.1:{closed_port()} {FP}"
+    result = CountingProber().probe([up, down])
+    assert isinstance(result[up], float) and result[up] >= 0
+    assert result[down] is None
+
+
+def test_results_are_reused_until_their_ttl(listeners, tmp_path):
+    up, down = f"127.0.0.1:{listeners()} {FP}", f"127.0.0.1:{closed_port()} {FP}"
+    prober = CountingProber(cache_file=str(tmp_path / "probes.json"), ttl=100, failure_ttl=10)
+    prober.probe([up, down])
+    prober.probed.clear()
+    prober.probe([up, down])
+    assert prober.probed == []
+    # a failure expires after failure_ttl, a success only after ttl
+    age(prober, up, 11)
+    age(prober, down, 11)
+    prober.probe([up, down])
+    assert prober.probed == [down]
+    prober.probed.clear()
+    age(prober, up, 100)
+    prober.probe([up, down])
+    assert prober.probed == [up]
+    prober.probed.clear()
+    prober.probe([up], force=True)
+    assert prober.probed == [up]
+
+
+def test_cache_survives_a_restart(listeners, tmp_path):
+    up = f"127.0.0.1:{listeners()} {FP}"
+    cache = str(tmp_path / "probes.json")
+    first = CountingProber(cache_file=cache).probe([up])
+    again = CountingProber(cache_file=cache)
+    assert again.probe([up]) == first
+    assert again.probed == []
+
+
+# ====== Selection ======
+def test_fastest_per_transport_skips_unreachable(listeners):
+    vanilla = [f"127.0.0.1:{listeners()} {FP}", f"127.0.0.1:{listeners()} {FP}"]
+    obfs4 = [f"obfs4 127.0.0.1:{listeners()} {FP} cert=abc iat-mode=0" for _ in range(2)]
+    dead = [f"obfs4 127.0.0.1:{closed_port()} {FP} cert=abc iat-mode=0"]
+    chosen = CountingProber(per_transport=1).fastest(vanilla + obfs4 + dead)
+    assert sorted(transport(line) for line in chosen) == ["obfs4", "vanilla"]
+    assert not set(chosen) & set(dead)
+
+
+def test_fastest_ranks_by_latency():
+    prober = CountingProber(per_transport=2)
+    lines = {f"192.0.2.{i}:443 {FP}": latency for i, latency in enumerate((0.3, 0.1, None, 0.2))}
+    lines[f"obfs4 192.0.2.9:443 {FP} cert=abc"] = 0.5
+    prober.results = {line: {"latency": latency, "time": time.time()} for line, latency in lines.items()}
+    chosen = prober.fastest(lines)
+    assert chosen == [f"192.0.2.1:443 {FP}", f"192.0.2.3:443 {FP}", f"obfs4 192.0.2.9:443 {FP} cert=abc"]
+    assert prober.probed == []
@@ -0,0 +1,122 @@
+import json
+import os
+import time
+import pytest
+from config_store import ConfigStore, atomic_write
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ConfigStore(str(tmp_path / "config.json"), defaults={"port": 8080, "tor": True}, delay=0.05, max_delay=0.3)
+
+
+def saved(store):
+    with open(store.path) as f:
+        return json.load(f)
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+# ====== Values ======
+def test_get_falls_back_to_defaults(store):
+    assert store.get("port") == 8080
+    assert store.get("unknown") is None
+    assert store.get("unknown", 5) == 5
+
+
+@pytest.mark.parametrize("value", [False, 0, "", None, []])
+def test_get_keeps_falsy_stored_values(store, value):
+    store.set("tor", value)
+    assert store.get("tor") == value and type(store.get("tor")) is type(value)
+
+
+def test_update_returns_only_changes(store):
+    assert store.update({"port": 9050, "tor": True}) == {"port": 9050, "tor": True}
+    assert store.update({"port": 9050, "tor": False}) == {"tor": False}
+    assert store.set("tor", False) == {}
+
+
+def test_subscribers_see_their_keys(store):
+    everything, ports = [], []
+    store.subscribe(everything.append)
+    callback = store.subscribe(ports.append, keys=["port"])
+    store.update({"port": 1, "tor": False})
+    store.set("tor", True)
+    store.set("tor", True)
+    assert everything == [{"port": 1, "tor": False}, {"tor": True}]
+    assert ports == [{"port": 1}]
+    store.unsubscribe(callback)
+    store.set("port", 2)
+    assert ports == [{"port": 1}]
+
+
+# ====== Saving ======
+def test_burst_of_edits_is_written_once(store):
+    for port in range(20):
+        store.set("port", port)
+    assert store.writes == 0 and not os.path.exists(store.path)
+    wait_for(lambda: store.writes)
+    time.sleep(0.1)
+    assert store.writes == 1
+    assert saved(store) == {"port": 19}
+
+
+def test_max_delay_bounds_a_long_burst(store):
+    start = time.monotonic()
+    while not store.writes:
+        assert time.monotonic() - start < 3.0
+        store.set("port", int((time.monotonic() - start) * 1000))
+        time.sleep(0.01)
+    # edits every 10ms never leave a 50ms gap, max_delay forces the write
+    assert time.monotonic() - start < 1.0
+
+
+def test_flush(store):
+    assert store.flush() is False
+    store.set("tor", False)
+    assert store.flush() is True
+    assert saved(store) == {"tor": False}
+    assert store.flush() is False
+    time.sleep(0.1)
+    assert store.writes == 1
+
+
+def test_failed_write_stays_dirty(tmp_path, capsys):
+    store = ConfigStore(str(tmp_path / "missing" / "config.json"), delay=10)
+    store.set("tor", False)
+    assert store.flush() is False
+    assert "cannot write" in capsys.readouterr().out
+    os.mkdir(tmp_path / "missing")
+    assert store.flush() is True
+    assert saved(store) == {"tor": False}
+
+
+# ====== Loading ======
+def test_load_round_trip(store):
+    store.update({"port": 1, "tor": False})
+    store.flush()
+    again = ConfigStore(store.path, defaults=store.defaults)
+    assert again.load() == {"port": 1, "tor": False}
+    assert again.get("tor") is False
+
+
+@pytest.mark.parametrize("text", [None, "{not json", "[1, 2]"])
+def test_load_bad_or_missing_file(store, text, capsys):
+    if text is not None:
+        with open(store.path, "w") as f:
+            f.write(text)
+    assert store.load() == {}
+    assert store.get("port") == 8080
+
+
+def test_atomic_write_replaces_and_leaves_no_temp_files(tmp_path):
+    path = tmp_path / "config.json"
+    atomic_write(str(path), "one")
+    atomic_write(str(path), "two")
+    assert path.read_text() == "two"
+    assert os.listdir(tmp_path) == ["config.json"]
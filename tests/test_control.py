@@ -0,0 +1,84 @@
+import pytest
+from control import RotationPolicy
+from tor import TorRunner
+from logpipe import LOG
+
+
+class FakeController:
+    def __init__(self, conf):
+        self.conf = conf
+        self.alive = True
+        self.signals = []
+        self.set = []
+
+    def is_alive(self): return self.alive
+    def close(self): self.alive = False
+    def add_event_listener(self, listener, *events): pass
+    def get_conf(self, name, default=None): return self.conf.get(name, [default])[0]
+    def get_conf_map(self, names, multiple=True): return {k: self.conf.get(k, []) for k in names}
+    def signal(self, signal): self.signals.append(signal)
+
+    def get_info(self, name, default=None):
+        return {"net/listeners/socks": '"127.0.0.1:9150"', "net/listeners/dns": '"127.0.0.1:5353"',
+                "status/bootstrap-phase": "NOTICE BOOTSTRAP PROGRESS=100 TAG=done"}.get(name, default)
+
+    def set_options(self, options):
+        self.set.append([k for k, _ in options])
+        self.conf.update({k: [v.strip('"') for v in values or []] for k, values in options})
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = TorRunner(0, 0, 0, data_dir=str(tmp_path))
+    runner.opened = []
+    def controller(port):
+        conn = FakeController({"DataDirectory": [str(tmp_path)]})
+        runner.opened.append((port, conn))
+        return conn
+    runner._controller = controller
+    (tmp_path / "control_port").write_text("PORT=127.0.0.1:9151\n")
+    yield runner
+    runner.control.close()
+
+
+def test_one_connection_for_attach_and_reconfigure(runner):
+    assert runner.attach()
+    assert (runner.socks_port, runner.dns_port, runner.contorl_port, runner.progress) == (9150, 5353, 9151, 100)
+    assert runner.reconfigure()
+    assert runner.reconfigure() == []
+    runner.bandwidth_rate = 1 << 20
+    assert runner.reconfigure() == ["BandwidthRate", "BandwidthBurst"]
+    assert any(text.startswith("tor reconfigured BandwidthRate, BandwidthBurst") for _, text in LOG.ring)
+    assert [port for port, _ in runner.opened] == [9151]
+
+
+def test_reconnects_after_the_connection_dies(runner):
+    assert runner.attach()
+    runner.opened[0][1].close()
+    runner.reconfigure()
+    assert len(runner.opened) == 2 and runner.control.controller is runner.opened[1][1]
+
+
+def test_tor_of_another_data_dir_is_left_alone(runner, tmp_path):
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "control_port").write_text("PORT=127.0.0.1:9151\n")
+    runner.data_dir = str(other)
+    assert not runner.attach()
+    assert not runner.attached and runner.control.controller is None
+    assert not runner.opened[0][1].alive
+
+
+def test_stop_halts_an_attached_tor_over_the_session(runner):
+    assert runner.attach()
+    runner.stop()
+    conn = runner.opened[0][1]
+    assert len(runner.opened) == 1 and [str(s) for s in conn.signals] == ["HALT"]
+    assert not conn.alive
+
+
+def test_rotation_policy():
+    assert RotationPolicy("interval", 60).due(61) and not RotationPolicy("interval", 60).due(59)
+    assert not RotationPolicy("manual", 60).due(1e9) and not RotationPolicy("destination", 60).due(1e9)
+    with pytest.raises(ValueError):
+        RotationPolicy("sometimes")
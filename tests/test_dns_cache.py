@@ -0,0 +1,178 @@
+import socket
+import struct
+import asyncio
+import pytest
+from dns_cache import DNSCache, DNSError, DNSProxy, parse_query, scan_response, truncated, servfail
+
+TYPE_A = 1
+TYPE_SOA = 6
+
+
+def name(text):
+    return b"".join(bytes([len(label)]) + label.encode() for label in text.split(".")) + b"\0"
+
+
+def query(host, qid=0x1234, qtype=TYPE_A, edns=None):
+    out = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 1 if edns else 0) + name(host) + struct.pack("!HH", qtype, 1)
+    if edns:
+        out += b"\0" + struct.pack("!HHIH", 41, edns, 0, 0)
+    return out
+
+
+def a_record(ttl, address="192.0.2.1"):
+    # the name is a pointer to the question at offset 12
+    return b"\xc0\x0c" + struct.pack("!HHIH", TYPE_A, 1, ttl, 4) + socket.inet_aton(address)
+
+
+def soa_record(ttl, minimum):
+    rdata = name("ns.example") + name("admin.example") + struct.pack("!IIIII", 1, 2, 3, 4, minimum)
+    return b"\xc0\x0c" + struct.pack("!HHIH", TYPE_SOA, 1, ttl, len(rdata)) + rdata
+
+
+def response(request, answers=(), authority=(), rcode=0, flags=0x8180):
+    qid = struct.unpack("!H", request[:2])[0]
+    question = request[12:12 + len(request) - 12]
+    head = struct.pack("!HHHHHH", qid, flags | rcode, 1, len(answers), len(authority), 0)
+    return head + question + b"".join(answers) + b"".join(authority)
+
+
+# ====== Wire format ======
+def test_parse_query():
+    qid, key, end, udp_size = parse_query(query("WWW.Example.com"))
+    assert qid == 0x1234 and key == ("www.example.com", TYPE_A, 1) and udp_size == 512
+    assert end == 12 + len(name("www.example.com")) + 4
+
+
+def test_parse_query_reads_the_edns_payload_size():
+    assert parse_query(query("example.com", edns=4096))[3] == 4096
+    assert parse_query(query("example.com", edns=100))[3] == 512
+
+
+@pytest.mark.parametrize("data", [b"\0" * 11, struct.pack("!HHHHHH", 1, 0, 2, 0, 0, 0) + name("a.b") + b"\0\1\0\1",
+                                  struct.pack("!HHHHHH", 1, 0, 1, 0, 0, 0) + b"\x07exa"])
+def test_parse_query_rejects(data):
+    with pytest.raises(DNSError):
+        parse_query(data)
+
+
+def test_scan_positive_answer_uses_the_smallest_ttl():
+    data = response(query("example.com"), [a_record(300), a_record(60, "192.0.2.2")])
+    offsets, ttls, ttl = scan_response(data, 30)
+    assert ttls == [300, 60] and ttl == 60
+    assert [struct.unpack("!I", data[o:o + 4])[0] for o in offsets] == ttls
+
+
+def test_scan_negative_answer_uses_the_soa_minimum():
+    data = response(query("nope.example"), authority=[soa_record(900, 120)], rcode=3)
+    assert scan_response(data, 30)[2] == 120
+    assert scan_response(response(query("nope.example"), rcode=3), 30)[2] == 30
+
+
+@pytest.mark.parametrize("flags, rcode", [(0x8180 | 0x0200, 0), (0x8180, 2), (0x8180, 5)])
+def test_scan_refuses_truncated_and_failed_answers(flags, rcode):
+    assert scan_response(response(query("example.com"), [a_record(60)], rcode=rcode, flags=flags), 30) is None
+
+
+def test_truncated_and_servfail_keep_the_question():
+    q = query("example.com")
+    end = parse_query(q)[2]
+    tc = truncated(response(q, [a_record(60)]), end)
+    assert struct.unpack("!HHHHHH", tc[:12])[1] & 0x0200 and tc[12:] == q[12:end]
+    fail = servfail(q, end)
+    assert struct.unpack("!H", fail[2:4])[0] & 0xF == 2 and fail[12:] == q[12:end]
+
+
+# ====== Cache ======
+def cache_with(upstream, **options):
+    cache = DNSCache(None, **options)
+    cache.asked = []
+    async def ask(data):
+        cache.asked.append(data)
+        return upstream(data)
+    cache._ask = ask
+    return cache
+
+
+def ttls_of(data):
+    return scan_response(data, 0)[1]
+
+
+def test_hits_are_served_with_aged_ttls():
+    cache = cache_with(lambda q: response(q, [a_record(100)]), prefetch=False)
+    async def main():
+        first = (await cache.resolve(query("example.com", qid=1)))[0]
+        cache.entries[("example.com", TYPE_A, 1)].stored -= 30
+        second = (await cache.resolve(query("example.com", qid=2)))[0]
+        return first, second
+    first, second = asyncio.run(main())
+    assert first[:2] == b"\0\1" and second[:2] == b"\0\2"
+    assert ttls_of(first) == [100] and ttls_of(second) == [70]
+    assert len(cache.asked) == 1 and cache.stats["hits"] == 1
+
+
+def test_expired_entries_are_fetched_again():
+    cache = cache_with(lambda q: response(q, [a_record(100)]), prefetch=False)
+    async def main():
+        await cache.resolve(query("example.com"))
+        cache.entries[("example.com", TYPE_A, 1)].stored -= 100
+        await cache.resolve(query("example.com"))
+    asyncio.run(main())
+    assert len(cache.asked) == 2 and cache.stats["misses"] == 2
+
+
+def test_negative_answers_expire_after_the_negative_ttl():
+    cache = cache_with(lambda q: response(q, rcode=3), negative_ttl=5, prefetch=False)
+    async def main():
+        await cache.resolve(query("nope.example"))
+        entry = cache.entries[("nope.example", TYPE_A, 1)]
+        assert entry.ttl == 5
+        await cache.resolve(query("nope.example"))
+        entry.stored -= 5
+        await cache.resolve(query("nope.example"))
+    asyncio.run(main())
+    assert len(cache.asked) == 2
+
+
+def test_ttls_are_capped_and_failures_not_cached():
+    cache = cache_with(lambda q: response(q, [a_record(86400)]), max_ttl=600)
+    asyncio.run(cache.resolve(query("example.com")))
+    assert cache.entries[("example.com", TYPE_A, 1)].ttl == 600
+    failing = cache_with(lambda q: response(q, rcode=2))
+    async def main():
+        await failing.resolve(query("example.com"))
+        await failing.resolve(query("example.com"))
+    asyncio.run(main())
+    assert len(failing.asked) == 2 and not failing.entries
+
+
+def test_concurrent_questions_share_one_upstream_query():
+    cache = cache_with(lambda q: response(q, [a_record(60)]))
+    async def main():
+        return await asyncio.gather(*(cache.resolve(query("example.com", qid=i)) for i in range(5)))
+    answers = asyncio.run(main())
+    assert [struct.unpack("!H", a[:2])[0] for a, _, _ in answers] == list(range(5))
+    assert len(cache.asked) == 1 and cache.stats["coalesced"] == 4
+
+
+# ====== Listener ======
+def test_udp_proxy_answers_through_an_upstream():
+    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    upstream.bind(("127.0.0.1", 0))
+    upstream.settimeout(5)
+    proxy = DNSProxy(0, upstream.getsockname()[1])
+    proxy.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    try:
+        for qid in (7, 8):
+            client.sendto(query("example.com", qid=qid), ("127.0.0.1", proxy.port))
+            if qid == 7:
+                data, addr = upstream.recvfrom(512)
+                upstream.sendto(response(data, [a_record(60)]), addr)
+            answer, _ = client.recvfrom(512)
+            assert answer[:2] == struct.pack("!H", qid) and ttls_of(answer)[0] <= 60
+        assert proxy.cache.stats["hits"] == 1
+    finally:
+        client.close()
+        proxy.stop()
+        upstream.close()
@@ -0,0 +1,113 @@
+import os
+import time
+import pytest
+from email.utils import formatdate
+from http_cache import HTTPCache, storable, freshness_lifetime, cache_control
+
+URL = "http://example.com/a"
+CACHEABLE = [("Cache-Control", "max-age=60")]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HTTPCache(str(tmp_path / "cache"), max_bytes=1 << 20, max_object=1 << 16)
+
+
+def store(cache, body, req=(), headers=CACHEABLE, url=URL):
+    fill = cache.begin(url, list(req), 200, "OK", list(headers), time.time())
+    fill.write(body)
+    return fill.commit()
+
+
+def read(entry):
+    with open(entry.path, "rb") as f:
+        return f.read()
+
+
+# ====== Rules ======
+def test_cache_control():
+    assert cache_control([("Cache-Control", 'max-age=5, No-Store'), ("X", "1"), ("cache-control", 'private="a"')]) \
+        == {"max-age": "5", "no-store": "", "private": "a"}
+
+
+@pytest.mark.parametrize("req, resp, ok", [
+    ([], CACHEABLE, True),
+    ([], [("ETag", '"x"')], True),
+    ([], [], False),
+    ([("Cache-Control", "no-store")], CACHEABLE, False),
+    ([], CACHEABLE + [("Set-Cookie", "a=b")], False),
+    ([], CACHEABLE + [("Vary", "*")], False),
+    ([("Authorization", "Basic eA==")], CACHEABLE, False),
+    ([("Authorization", "Basic eA==")], [("Cache-Control", "public, max-age=5")], True),
+])
+def test_storable(req, resp, ok):
+    assert storable("GET", 200, req, resp) is ok
+
+
+def test_freshness_lifetime():
+    now = time.time()
+    assert freshness_lifetime(200, [("Cache-Control", "max-age=60, s-maxage=10")]) == 10
+    assert freshness_lifetime(200, [("Cache-Control", "no-cache, max-age=60")]) == 0
+    assert 95 <= freshness_lifetime(200, [("Expires", formatdate(now + 100, usegmt=True))]) <= 100
+    heuristic = [("Date", formatdate(now, usegmt=True)), ("Last-Modified", formatdate(now - 1000, usegmt=True))]
+    assert freshness_lifetime(200, heuristic) == 100
+
+
+# ====== Store ======
+def test_store_and_lookup(cache):
+    entry = store(cache, b"hello")
+    found = cache.lookup(URL, [])
+    assert found.key == entry.key and read(found) == b"hello" and found.fresh([])
+    assert not found.fresh([("Cache-Control", "no-cache")])
+    assert cache.lookup("http://example.com/b", []) is None
+
+
+def test_vary_variants_are_kept_apart(cache):
+    vary = CACHEABLE + [("Vary", "Accept-Encoding")]
+    store(cache, b"gzip", [("Accept-Encoding", "gzip")], vary)
+    store(cache, b"plain", [], vary)
+    store(cache, b"br", [("accept-encoding", "br")], vary)
+    assert read(cache.lookup(URL, [("Accept-Encoding", "gzip")])) == b"gzip"
+    assert read(cache.lookup(URL, [])) == b"plain"
+    assert read(cache.lookup(URL, [("Accept-Encoding", "br")])) == b"br"
+    assert cache.lookup(URL, [("Accept-Encoding", "deflate")]) is None
+    assert cache.stats()["entries"] == 3
+    # and so after a restart
+    again = HTTPCache(cache.directory)
+    assert read(again.lookup(URL, [("Accept-Encoding", "gzip")])) == b"gzip"
+
+
+def test_replacing_a_body_being_sent(cache):
+    old = store(cache, b"one")
+    with open(old.path, "rb") as sending:
+        new = store(cache, b"two")
+        assert new.path != old.path
+        assert sending.read() == b"one"
+    assert read(cache.lookup(URL, [])) == b"two"
+    assert cache.stats()["entries"] == 1
+
+
+def test_failed_install_drops_the_entry(cache, monkeypatch):
+    def fail(key, meta):
+        raise PermissionError("in use")
+    monkeypatch.setattr(cache, "_write_meta", fail)
+    assert store(cache, b"x") is None
+    assert cache.lookup(URL, []) is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_too_large_is_not_stored(cache):
+    assert store(cache, b"x" * (cache.max_object + 1)) is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_eviction_and_restart_cleanup(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache"), max_bytes=10)
+    for i in range(4):
+        store(cache, b"1234", url=f"http://example.com/{i}")
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 2
+    leftover = os.path.join(cache.directory, "0" * 64 + "-dead")
+    open(leftover, "wb").close()
+    again = HTTPCache(cache.directory, max_bytes=10)
+    assert again.stats()["entries"] == 2 and not os.path.exists(leftover)
+    assert read(again.lookup("http://example.com/3", [])) == b"1234"
@@ -0,0 +1,95 @@
+import io
+import pytest
+from http_stream import (HTTPStreamError, BadRequest, read_head, end_to_end, request_framing, without_length,
+                         response_framing, copy_length, copy_chunked)
+
+
+# ====== Requests ======
+@pytest.mark.parametrize("headers, framing", [
+    ([], ("none", 0)),
+    ([("Content-Length", "0")], ("none", 0)),
+    ([("Content-Length", "12")], ("length", 12)),
+    ([("Transfer-Encoding", "chunked")], ("chunked", None)),
+    ([("Transfer-Encoding", "gzip, chunked")], ("chunked", None)),
+    # Transfer-Encoding wins over Content-Length (RFC 7230 3.3.3)
+    ([("Content-Length", "4"), ("Transfer-Encoding", "chunked")], ("chunked", None)),
+])
+def test_request_framing(headers, framing):
+    assert request_framing(headers) == framing
+
+
+@pytest.mark.parametrize("length", ["-1", "abc", "+5", "1_0", ""])
+def test_request_framing_rejects_bad_length(length):
+    with pytest.raises(BadRequest):
+        request_framing([("Content-Length", length)])
+
+
+def test_request_framing_rejects_unknown_transfer_coding():
+    with pytest.raises(HTTPStreamError) as e:
+        request_framing([("Transfer-Encoding", "gzip")])
+    assert not isinstance(e.value, BadRequest)
+
+
+def test_without_length():
+    headers = [("Host", "a"), ("content-length", "4"), ("Content-Length", "4"), ("X", "1")]
+    assert without_length(headers) == [("Host", "a"), ("X", "1")]
+
+
+def test_end_to_end_drops_hop_by_hop_and_connection_tokens():
+    headers = [("Connection", "keep-alive, X-Hop"), ("X-Hop", "1"), ("Transfer-Encoding", "chunked"),
+               ("Proxy-Connection", "close"), ("Accept", "*/*")]
+    assert end_to_end(headers) == [("Accept", "*/*")]
+
+
+def test_read_head_folds_continuation_lines():
+    start, headers = read_head(io.BytesIO(b"HTTP/1.1 200 OK\r\nX-A: one\r\n  two\r\nX-B: 3\r\n\r\nbody"))
+    assert start == "HTTP/1.1 200 OK"
+    assert headers == [("X-A", "one two"), ("X-B", "3")]
+
+
+# ====== Responses ======
+@pytest.mark.parametrize("method, status, headers, framing", [
+    ("HEAD", 200, [("Content-Length", "10")], ("none", 0)),
+    ("GET", 204, [], ("none", 0)),
+    ("GET", 304, [("Content-Length", "10")], ("none", 0)),
+    ("GET", 101, [], ("none", 0)),
+    ("GET", 200, [("Transfer-Encoding", "chunked"), ("Content-Length", "10")], ("chunked", None)),
+    ("GET", 200, [("Content-Length", "10")], ("length", 10)),
+    ("GET", 200, [], ("close", None)),
+])
+def test_response_framing(method, status, headers, framing):
+    assert response_framing(method, status, headers) == framing
+
+
+@pytest.mark.parametrize("length", ["-1", "ten"])
+def test_response_framing_rejects_bad_length(length):
+    with pytest.raises(HTTPStreamError):
+        response_framing("GET", 200, [("Content-Length", length)])
+
+
+# ====== Bodies ======
+def test_copy_length():
+    out = bytearray()
+    copy_length(io.BytesIO(b"abcdefgh"), out.extend, 5)
+    assert out == b"abcde"
+    with pytest.raises(HTTPStreamError):
+        copy_length(io.BytesIO(b"abc"), out.extend, 5)
+
+
+CHUNKED = b"4;ext=1\r\nWiki\r\n5\r\npedia\r\nB\r\n in\r\nchunks\r\n0\r\nX-Trailer: 1\r\n\r\nNEXT"
+
+
+def test_copy_chunked_raw_and_decoded():
+    raw, decoded, sink = bytearray(), bytearray(), bytearray()
+    fp = io.BytesIO(CHUNKED)
+    copy_chunked(fp, raw.extend)
+    assert raw == CHUNKED[:-4] and fp.read() == b"NEXT"
+    copy_chunked(io.BytesIO(CHUNKED), decoded.extend, raw=False, sink=sink.extend)
+    assert decoded == sink == b"Wikipedia in\r\nchunks"
+
+
+@pytest.mark.parametrize("body", [b"-5\r\nabcde\r\n0\r\n\r\n", b"0x5\r\nabcde\r\n0\r\n\r\n", b"+5\r\nabcde\r\n0\r\n\r\n",
+                                  b"\r\n", b"5\r\nabc", b"3\r\nabcXX0\r\n\r\n", b"0\r\n"])
+def test_copy_chunked_rejects_malformed(body):
+    with pytest.raises(HTTPStreamError):
+        copy_chunked(io.BytesIO(body), bytearray().extend)
@@ -0,0 +1,72 @@
+import os
+import socket
+import pytest
+from pool import UpstreamPool, UpstreamConn
+
+
+class Pairs:
+    def __init__(self):
+        self.peers = []
+
+    def connect(self, host, port):
+        ours, theirs = socket.socketpair()
+        self.peers.append(theirs)
+        return ours
+
+    def close(self):
+        for sock in self.peers:
+            sock.close()
+
+
+@pytest.fixture
+def pairs():
+    pairs = Pairs()
+    yield pairs
+    pairs.close()
+
+
+def test_idle_connections_are_reused(pairs):
+    pool = UpstreamPool(pairs.connect)
+    conn = pool.acquire("Example.com", 80)
+    pool.release(conn)
+    again = pool.acquire("example.com", 80)
+    assert again is conn and again.reused
+    assert pool.acquire("example.com", 80, fresh=True) is not conn
+    pool.close()
+
+
+def test_dead_idle_connections_are_dropped(pairs):
+    pool = UpstreamPool(pairs.connect)
+    conn = pool.acquire("example.com", 80)
+    pool.release(conn)
+    pairs.peers[0].close()
+    assert pool.acquire("example.com", 80) is not conn
+    assert len(pairs.peers) == 2
+    pool.close()
+
+
+def test_over_the_limit_connections_are_unpooled(pairs):
+    pool = UpstreamPool(pairs.connect, max_per_host=2)
+    held = [pool.acquire("example.com", 80) for _ in range(3)]
+    assert [c.key for c in held] == [("example.com", 80), ("example.com", 80), None]
+    for conn in held:
+        pool.release(conn)
+    assert pool.idle_count() == 2
+    assert held[2].sock.fileno() == -1
+    pool.close()
+
+
+def test_alive_past_fd_setsize(pairs):
+    sock = pairs.connect(None, None)
+    try:
+        high = os.dup2(sock.fileno(), 1500)
+    except OSError:
+        pytest.skip("descriptor limit below 1500")
+    conn = UpstreamConn(None, socket.socket(fileno=high))
+    try:
+        assert conn.alive()
+        pairs.peers[-1].sendall(b"junk")
+        assert not conn.alive()
+    finally:
+        conn.close()
+        sock.close()
@@ -0,0 +1,140 @@
+import json
+import re
+import shutil
+import subprocess
+import pytest
+from routes import Route, RouteTable, routes_from_config, is_local, refused, DIRECT
+
+
+# ====== Route ======
+@pytest.mark.parametrize("spec, pac", [
+    (DIRECT, "DIRECT"),
+    ("socks5://10.0.0.1:1080", "SOCKS5 10.0.0.1:1080"),
+    ("socks4://gw:1080", "SOCKS gw:1080"),
+    ("http://proxy.corp:3128", "PROXY proxy.corp:3128"),
+])
+def test_route_pac(spec, pac):
+    assert Route(spec).pac() == pac
+
+
+@pytest.mark.parametrize("spec", ["ftp://h:21", "socks5://h", "socks5://:1080", "nonsense"])
+def test_route_rejects_bad_spec(spec):
+    with pytest.raises(ValueError):
+        Route(spec)
+
+
+# ====== Lookups ======
+def lookup(table, host, port=80):
+    route = table.lookup(host, port)
+    return route and route.spec
+
+
+def test_empty_table_routes_everything_to_tor():
+    table = RouteTable()
+    assert not table
+    assert lookup(table, "localhost") is None
+
+
+def test_domains():
+    table = RouteTable(["corp.example", "*.lan", "intranet.corp.example socks5://10.0.0.1:1080"])
+    assert lookup(table, "corp.example") == DIRECT
+    assert lookup(table, "wiki.corp.example") == DIRECT
+    assert lookup(table, "intranet.corp.example") == "socks5://10.0.0.1:1080"
+    assert lookup(table, "a.intranet.corp.example") == "socks5://10.0.0.1:1080"
+    assert lookup(table, "printer.lan") == DIRECT
+    assert lookup(table, "lan") is None
+    assert lookup(table, "example.org") is None
+
+
+def test_networks_most_specific_wins():
+    table = RouteTable(["10.0.0.0/8", "10.1.0.0/16 http://gw:3128", "10.1.2.3 socks4://gw:1080", "fc00::/7"])
+    assert lookup(table, "10.9.9.9") == DIRECT
+    assert lookup(table, "10.1.9.9") == "http://gw:3128"
+    assert lookup(table, "10.1.2.3") == "socks4://gw:1080"
+    assert lookup(table, "11.0.0.1") is None
+    assert lookup(table, "fd12::1") == DIRECT
+    assert lookup(table, "[fd12::1]") == DIRECT
+    assert lookup(table, "2001:db8::1") is None
+
+
+def test_host_rule_beats_port_rule():
+    table = RouteTable([":5432", "db.example socks5://gw:1080"])
+    assert lookup(table, "anything.example", 5432) == DIRECT
+    assert lookup(table, "anything.example", 443) is None
+    assert lookup(table, "db.example", 5432) == "socks5://gw:1080"
+
+
+def test_routes_share_one_object_per_spec():
+    table = RouteTable(["a.example socks5://gw:1080", "b.example socks5://gw:1080"])
+    assert table.lookup("a.example") is table.lookup("b.example")
+
+
+def test_nothing_is_routed_by_default():
+    from defaults import DEFAULTS
+    table = routes_from_config(DEFAULTS)
+    assert not table and lookup(table, "127.0.0.1") is None
+
+
+# ====== Gateway guard ======
+@pytest.mark.parametrize("host", ["localhost", "a.localhost", "LOCALHOST.", "127.0.0.1", "127.8.9.1", "::1", "[::1]",
+                                  "::ffff:127.0.0.1", "0.0.0.0", "::"])
+def test_is_local(host):
+    assert is_local(host)
+
+
+@pytest.mark.parametrize("host", ["192.168.1.1", "10.0.0.1", "fe80::1", "example.com", "localhost.example"])
+def test_is_not_local(host):
+    assert not is_local(host)
+
+
+def test_direct_to_the_gateway_is_for_local_clients():
+    table = RouteTable(["127.0.0.0/8", "localhost", "192.168.0.0/16", "gw.example socks5://10.0.0.1:1080", ":9051"])
+    for host in ("127.0.0.1", "localhost"):
+        assert refused(table.lookup(host, 9051), "192.168.1.20", host, 9051)
+        assert not refused(table.lookup(host, 9051), "127.0.0.1", host, 9051)
+        assert not refused(table.lookup(host, 9051), "::1", host, 9051)
+    # the proxy's own port, on whatever address reaches it
+    assert refused(table.lookup("192.168.1.5", 8080), "192.168.1.20", "192.168.1.5", 8080, (8080,))
+    assert not refused(table.lookup("192.168.1.5", 80), "192.168.1.20", "192.168.1.5", 80, (8080,))
+    # tor and other proxies decide for themselves
+    assert not refused(table.lookup("example.com", 80), "192.168.1.20", "example.com", 80)
+    assert not refused(table.lookup("gw.example", 8080), "192.168.1.20", "gw.example", 8080, (8080,))
+
+
+# ====== PAC ======
+def pac_vars(script):
+    return {name: json.loads(value) for name, value in re.findall(r"^var (\w+) = (.*);$", script, re.M)}
+
+
+def test_pac_tables():
+    table = RouteTable(["corp.example", "*.lan http://gw:3128", "10.0.0.0/8", "10.1.0.0/16 socks5://gw:1080",
+                        "fc00::/7", ":5432"])
+    script = table.pac("127.0.0.1:8080")
+    assert "function FindProxyForURL(url, host)" in script
+    assert '"PROXY 127.0.0.1:8080"' in script
+    found = pac_vars(script)
+    assert found["domains"] == {"corp.example": [1, "DIRECT"], "lan": [2, "PROXY gw:3128"]}
+    # most specific first, IPv6 left to the proxy
+    assert found["networks"] == [["10.1.0.0", "255.255.0.0", 16, "SOCKS5 gw:1080"], ["10.0.0.0", "255.0.0.0", 8, "DIRECT"]]
+    assert found["ports"] == {"5432": "DIRECT"}
+
+
+# the script itself, with a minimal isInNet(), where node is around
+ISINNET = """function isInNet(host, pattern, mask) {
+  function n(a) { return a.split(".").reduce(function (v, x) { return v * 256 + +x; }, 0); }
+  var m = n(mask); return (n(host) & m) >>> 0 === (n(pattern) & m) >>> 0;
+}
+"""
+
+
+@pytest.mark.skipif(not shutil.which("node"), reason="needs node")
+def test_pac_script_agrees_with_lookups():
+    rules = ["corp.example", "*.lan http://gw:3128", "10.0.0.0/8", "10.1.0.0/16 socks5://gw:1080", ":5432"]
+    cases = [("http://corp.example/", "corp.example", "DIRECT"), ("http://a.corp.example/", "a.corp.example", "DIRECT"),
+             ("http://printer.lan/", "printer.lan", "PROXY gw:3128"), ("http://lan/", "lan", "PROXY 127.0.0.1:8080"),
+             ("http://10.9.0.1/", "10.9.0.1", "DIRECT"), ("http://10.1.0.1/", "10.1.0.1", "SOCKS5 gw:1080"),
+             ("http://db.example:5432/", "db.example", "DIRECT"), ("https://example.com/", "example.com", "PROXY 127.0.0.1:8080")]
+    calls = "".join(f"console.log(FindProxyForURL({json.dumps(url)}, {json.dumps(host)}));\n" for url, host, _ in cases)
+    script = ISINNET + RouteTable(rules).pac("127.0.0.1:8080") + calls
+    out = subprocess.run(["node", "-e", script], capture_output=True, text=True, timeout=30, check=True).stdout
+    assert out.splitlines() == [result for _, _, result in cases]
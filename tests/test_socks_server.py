@@ -0,0 +1,48 @@
+import errno
+import socket
+import struct
+import asyncio
+import threading
+import pytest
+from aio_proxy import SocksError
+from routes import RouteTable
+from socks_server import SocksServer, reply_code
+
+
+@pytest.mark.parametrize("error, code", [
+    (SocksError("host unreachable", 4), 4),
+    (asyncio.TimeoutError(), 6),
+    (socket.timeout(), 6),
+    (ConnectionRefusedError(), 5),
+    (OSError(errno.EHOSTUNREACH, "no route to host"), 4),
+    (OSError(errno.ENETUNREACH, "network is unreachable"), 3),
+    (socket.gaierror(socket.EAI_NONAME, "unknown name"), 4),
+    (ConnectionResetError(), 1),
+    (ValueError(), 1),
+])
+def test_reply_code(error, code):
+    assert reply_code(error) == code
+
+
+@pytest.fixture
+def server():
+    server = SocksServer(("127.0.0.1", 0), 1, routes=RouteTable(["127.0.0.0/8"]))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_refused_connect_is_reported(server):
+    with socket.create_connection(server.server_address, timeout=5) as s:
+        s.sendall(b"\x05\x01\x00")
+        assert s.recv(2) == b"\x05\x00"
+        s.sendall(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") + struct.pack("!H", closed_port()))
+        assert s.recv(10)[:2] == b"\x05\x05"
@@ -0,0 +1,79 @@
+import socket
+import threading
+import pytest
+from proxy import open_tor_socket
+
+
+class Lease:
+    def __init__(self, port):
+        self.socks_port = port
+        self.faults = []
+        self.released = False
+    def connected(self, seconds): pass
+    def failed(self, instance_fault): self.faults.append(instance_fault)
+    def release(self): self.released = True
+
+
+class Tor:
+    def __init__(self, port):
+        self.lease = Lease(port)
+    def acquire(self):
+        return self.lease
+
+
+class SocksServer:
+    # reply: bytes sent after the greeting and the request, None to stall
+    def __init__(self):
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.reply = None
+
+
+@pytest.fixture
+def socks_server():
+    server = SocksServer()
+    clients = []
+    def serve():
+        while True:
+            try:
+                conn, _ = server.sock.accept()
+            except OSError:
+                return
+            clients.append(conn)
+            conn.recv(16)
+            conn.sendall(b"\x05\x00")
+            conn.recv(512)
+            if server.reply:
+                conn.sendall(server.reply)
+    threading.Thread(target=serve, daemon=True).start()
+    yield server
+    server.sock.close()
+    for conn in clients:
+        conn.close()
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def failure(tor):
+    with pytest.raises(Exception):
+        open_tor_socket(tor, "example.com", 80, connect_timeout=0.3)
+    assert tor.lease.released
+    return tor.lease.faults
+
+
+def test_stalled_circuit_counts_against_the_instance(socks_server):
+    assert failure(Tor(socks_server.port)) == [True]
+
+
+def test_unreachable_tor_counts_against_the_instance():
+    assert failure(Tor(closed_port())) == [True]
+
+
+def test_unreachable_destination_does_not(socks_server):
+    # host unreachable, as tor answers when the exit cannot connect
+    socks_server.reply = b"\x05\x04\x00\x01" + b"\0" * 6
+    assert failure(Tor(socks_server.port)) == [False]
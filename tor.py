@@ -1,9 +1,13 @@
 import threading
 import subprocess
 import sys
-import platform
 import os
-from proxy import  ProxyHandler, ThreadedHTTPServer
+import time
+import json
+from proxy import  ProxyHandler, ThreadedHTTPServer, get_free_port, _StaticLease
+from bridges import bridge_lines, transport
+from logpipe import LogPipeline, LOG
+from control import ControlSession
 def resource_path(relative_path):
     if getattr(sys, "_MEIPASS", False):
         base = sys._MEIPASS
@@ -13,76 +17,520 @@ def resource_path(relative_path):
 
 tor_path = resource_path("tor_bundle/tor/tor.exe")
 lyrebird_path = resource_path("tor_bundle/tor/pluggable_transports/lyrebird.exe")
+
+def binary(name, bundled):
+    # the bundle only ships Windows binaries; elsewhere use the system packages
+    if os.name == "nt":
+        return bundled
+    import shutil
+    return shutil.which(name) or bundled
 geoip_path = resource_path("tor_bundle/data/geoip")
 geoip6_path = resource_path("tor_bundle/data/geoip6")
+# tor's own default for BandwidthRate and BandwidthBurst
+DEFAULT_BANDWIDTH = 1 << 30
 
 class TorRunner:
-    def __init__(self, socks_port, contorl_port, dns_port):
-        self.proc = None; self.thread = None; self.log_file = "tor_log.txt"
+    def __init__(self, socks_port, contorl_port, dns_port, data_dir=None):
+        self.proc = None; self.thread = None
+        self.data_dir = data_dir
+        self.torrc_file = os.path.join(data_dir, "torrc") if data_dir else "temp_torrc.txt"
+        self.log_file = os.path.join(data_dir, "tor_log.txt") if data_dir else "tor_log.txt"
+        self.app_window = None
+        self.on_progress = None
+        self.progress = 0
         self.socks_port = socks_port
         self.bridge = False
         self.bridges = ""   
         self.contorl_port = contorl_port
         self.dns_port = dns_port
+        # leave tor running when the app exits so the next start can reattach to it
+        self.keep_alive = False
+        self.attached = False
+        self.start_kind = None
+        self.started_at = None
+        self.bootstrap_seconds = None
+        self.last_reconfigure_ms = None
+        self.reconfigure_error = None
+        self._reconfigure_timer = None
+        self._reconfigure_lock = threading.RLock()
+
+        # set to a bridges.BridgeProber to use the fastest reachable bridges instead of all of them
+        self.bridge_prober = None
+        # BandwidthRate in bytes per second, 0 for tor's default; see shaping.Shaper.tor_rate
+        self.bandwidth_rate = 0
+        # persistent control connection, applies the rotation policy
+        self.control = ControlSession(self)
 
-        self.bridge_types = ["obfs4", "webtunnel", "meek", "snowflake", "scramblesuit", "fte"]
+        # transports lyrebird speaks
+        self.bridge_types = ["obfs4", "webtunnel", "meek_lite", "snowflake", "scramblesuit", "obfs3", "obfs2"]
         
+    def running(self):
+        if self.attached or (self.thread is not None and self.thread.is_alive()):
+            return True
+        return self.proc is not None and self.proc.poll() is None
+
+    def acquire(self):
+        return _StaticLease(self.socks_port)
+
+    @property
+    def rotation(self): return self.control.rotation
+    @rotation.setter
+    def rotation(self, value): self.control.rotation = value
+
+    def new_identity(self, reason="manual"):
+        return self.control.new_identity(reason)
+
     def start(self):
-        if self.proc: return
+        if self.running(): return
+        self.started_at = time.monotonic()
+        self.bootstrap_seconds = None
+        self.control.start()
+        if self.data_dir and self.attach(): return
+        # a consensus cached from an earlier run skips most of the bootstrap
+        self.start_kind = "warm" if self.data_dir and os.path.exists(
+            os.path.join(self.data_dir, "cached-microdesc-consensus")) else "cold"
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
-    def _run(self):
-        
-        torrc_content = f"SocksPort {self.socks_port}\nLog notice stdout\nControlPort {self.contorl_port}\n"
+    # options that can be changed on a running tor; the rest of the torrc is fixed at launch
+    def live_options(self):
+        # tor's burst defaults to 1 GB, which would let it ignore the rate for a long while
+        rate = str(self.bandwidth_rate or DEFAULT_BANDWIDTH)
+        options = {"SocksPort": [str(self.socks_port)], "ControlPort": [str(self.contorl_port)],
+                   "DNSPort": [str(self.dns_port)], "UseBridges": ["0"], "ClientTransportPlugin": [], "Bridge": [],
+                   "BandwidthRate": [rate], "BandwidthBurst": [rate]}
+        lines = bridge_lines(self.bridges) if self.bridge else []
+        if self.bridge and self.bridge_prober:
+            # fall back to every line when nothing answered, tor may still get through
+            lines = self.bridge_prober.fastest(lines) or lines
+        lines = [line for line in lines if transport(line) in self.bridge_types or transport(line) == "vanilla"]
+        if lines:
+            transports = []
+            for line in lines:
+                if transport(line) in self.bridge_types and transport(line) not in transports:
+                    transports.append(transport(line))
+            options["UseBridges"] = ["1"]
+            if transports:
+                options["ClientTransportPlugin"] = ['%s exec '%(",".join(transports))+ binary("lyrebird", lyrebird_path)]
+            options["Bridge"] = lines
+        return options
+
+    def _write_torrc(self):
+        torrc_content = "Log notice stdout\n"
         torrc_content += 'GeoIPFile ' + geoip_path + '\n'
         torrc_content += 'GeoIPv6File ' + geoip6_path + '\n'        
-        torrc_content += 'DNSPort ' + str(self.dns_port) + '\n'
         torrc_content += 'AutomapHostsOnResolve 1'+ '\n'
-        
-        if self.bridge and self.bridges:
-            bridge_type = ""
-            for i in self.bridge_types:
-                if i in self.bridges:
-                    bridge_type = i
-                    break
-            if bridge_type:
-                torrc_content += 'UseBridges 1\n'
-                torrc_content += 'ClientTransportPlugin %s exec '%(bridge_type)+ lyrebird_path +'\n'
-                torrc_content += self.bridges.replace(bridge_type, "Bridge %s"%(bridge_type))
-                
-        with open("temp_torrc.txt", "w") as f: f.write(torrc_content)
-        
+        # the proxy answers LAN clients; the control port only answers whoever can read the cookie
+        torrc_content += 'CookieAuthentication 1\n'
+        if self.data_dir:
+            os.makedirs(self.data_dir, exist_ok=True)
+            torrc_content += 'DataDirectory ' + os.path.abspath(self.data_dir) + '\n'
+            torrc_content += 'ControlPortWriteToFile ' + os.path.abspath(self._control_port_file()) + '\n'
+        for key, values in self.live_options().items():
+            for value in values:
+                torrc_content += f"{key} {value}\n"
+        with open(self.torrc_file, "w") as f: f.write(torrc_content)
+
+    def _run(self):
+        self._write_torrc()
         
         if self.proc: self.proc.terminate(); self.proc.wait(); self.proc=None
+        self.progress = 0
         
-        flags = subprocess.CREATE_NO_WINDOW if platform.system()=="Windows" else 0
-        self.proc = subprocess.Popen([tor_path, "-f", "temp_torrc.txt"],
-                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=flags)
+        flags = subprocess.CREATE_NO_WINDOW if os.name=="nt" else 0
+        self.proc = subprocess.Popen([binary("tor", tor_path), "-f", self.torrc_file],
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=flags,
+                                     start_new_session=self.keep_alive and os.name != "nt")
         
-        with open(self.log_file, 'w') as f:
+        if os.path.exists(self.log_file): os.remove(self.log_file)
+        # tor stamps its own lines
+        log = LogPipeline(self.log_file, capacity=10000, timestamps=False)
+        log.start()
+        try:
             for line in iter(self.proc.stdout.readline, b''):
-                f.write(line.decode()); f.flush()
-                if "Bootstrapped" in line.decode():
-                    lst =  line.decode().split(" ")
-                    self.app_window.data.value = lst[lst.index("Bootstrapped") + 1]
+                text = line.decode(errors="replace").rstrip()
+                log.write(text); LOG.write("[tor] " + text)
+                if "Bootstrapped" in text:
+                    lst =  text.split(" ")
+                    self._set_progress(lst[lst.index("Bootstrapped") + 1])
+        finally:
+            log.close()
+        self.progress = 0
+
+    def _set_progress(self, value):
+        try:
+            self.progress = int(value.rstrip("%"))
+        except ValueError:
+            pass
+        if self.progress >= 100 and self.bootstrap_seconds is None and self.started_at is not None:
+            self._record_bootstrap()
+        if self.app_window: self.app_window.data.value = value
+        if self.on_progress: self.on_progress(self)
+
+    def _record_bootstrap(self):
+        self.bootstrap_seconds = time.monotonic() - self.started_at
+        LOG.write(f"tor bootstrapped in {self.bootstrap_seconds:.1f}s ({self.start_kind} start)")
+        if not self.data_dir: return
+        try:
+            with open(os.path.join(self.data_dir, "bootstrap_times.jsonl"), "a") as f:
+                f.write(json.dumps({"time": time.time(), "start": self.start_kind,
+                                    "seconds": round(self.bootstrap_seconds, 3), "bridges": bool(self.bridge and self.bridges)}) + "\n")
+        except OSError:
+            pass
+
+    def ready(self):
+        return self.running() and self.progress >= 100
+
+    def _control_port_file(self):
+        return os.path.join(self.data_dir, "control_port")
+
+    # ====== Reattach ======
+    # tor writes its control address to the DataDirectory; a tor left running by an earlier
+    # session (keep_alive) is picked up from there instead of starting a second process.
+    # Every command goes over self.control's one connection; this only opens it.
+    def _controller(self, port):
+        from stem.control import Controller
+        controller = Controller.from_port(address="127.0.0.1", port=port)
+        controller.authenticate()
+        return controller
+
+    def attach(self):
+        try:
+            with open(self._control_port_file()) as f:
+                port = int(f.read().strip().rpartition(":")[2])
+        except (OSError, ValueError):
+            return False
+        socks = None
+        try:
+            controller = self.control.connect(port)
+            data_dir = controller and controller.get_conf("DataDirectory", "")
+            if data_dir and os.path.abspath(data_dir) == os.path.abspath(self.data_dir):
+                socks = _listener_port(controller.get_info("net/listeners/socks", ""))
+                dns = _listener_port(controller.get_info("net/listeners/dns", ""))
+                phase = controller.get_info("status/bootstrap-phase", "")
+        except Exception:
+            socks = None
+        if not socks:
+            self.control.disconnect()
+            return False
+        self.socks_port, self.contorl_port = socks, port
+        if dns: self.dns_port = dns
+        self.attached = True
+        self.start_kind = "attached"
+        self._set_progress(_bootstrap_progress(phase))
+        if self.progress < 100:
+            self.thread = threading.Thread(target=self._watch_bootstrap, daemon=True)
+            self.thread.start()
+        return True
+
+    def _watch_bootstrap(self):
+        while self.attached and self.progress < 100:
+            time.sleep(0.5)
+            controller = self.control.connect()
+            try:
+                self._set_progress(_bootstrap_progress(controller.get_info("status/bootstrap-phase", "")))
+            except Exception:
+                self.attached = False
+                self.progress = 0
+
+    # ====== Live reconfiguration ======
+    # diffs live_options() against what tor reports and sends only the changed keys in one
+    # SETCONF, so circuits and open streams survive; returns the keys that changed
+    def reconfigure(self):
+        with self._reconfigure_lock:
+            if not self.running():
+                return []
+            started = time.monotonic()
+            desired = self.live_options()
+            try:
+                controller = self.control.connect()
+                if controller is None:
+                    raise ConnectionError("control port not reachable")
+                current = controller.get_conf_map(list(desired), multiple=True)
+                changed = [k for k, v in desired.items() if [x.strip() for x in current.get(k, [])] != v]
+                if changed:
+                    # stem sends each value as a quoted string, which tor unescapes
+                    controller.set_options([(k, [_quote(v) for v in desired[k]] or None) for k in changed])
+            except Exception as e:
+                self.reconfigure_error = e
+                LOG.write(f"tor reconfiguration failed: {e}")
+                return []
+            self.reconfigure_error = None
+            self._write_torrc()
+            self.last_reconfigure_ms = (time.monotonic() - started) * 1000
+            if changed:
+                LOG.write(f"tor reconfigured {', '.join(changed)} in {self.last_reconfigure_ms:.1f}ms")
+            return changed
+
+    # collapses bursts of edits (e.g. typing into the bridges box) into one reconfigure
+    def schedule_reconfigure(self, delay=0.75):
+        with self._reconfigure_lock:
+            if self._reconfigure_timer: self._reconfigure_timer.cancel()
+            self._reconfigure_timer = threading.Timer(delay, self.reconfigure)
+            self._reconfigure_timer.daemon = True
+            self._reconfigure_timer.start()
+
+    # drop our handle on tor without stopping it
+    def detach(self):
+        self.control.close()
+        if self.proc and self.proc.stdout: self.proc.stdout.close()
+        self.proc = None; self.thread = None
+        self.attached = False
 
     def stop(self):
+        if self._reconfigure_timer: self._reconfigure_timer.cancel()
+        if self.attached:
+            try:
+                from stem import Signal as TorSignal
+                self.control.connect().signal(TorSignal.HALT)
+            except Exception:
+                pass
+            self.attached = False
+        self.control.close()
         if self.proc: self.proc.terminate(); self.proc.wait(); self.proc=None
         if self.thread: self.thread.join(); self.thread=None
-        if os.path.exists("temp_torrc.txt"): os.remove("temp_torrc.txt")
+        self.progress = 0
+        if os.path.exists(self.torrc_file): os.remove(self.torrc_file)
+
+
+def _quote(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _listener_port(value):
+    # net/listeners/* is a space separated list of quoted "addr:port" entries
+    for item in value.split():
+        try:
+            return int(item.strip('"').rpartition(":")[2])
+        except ValueError:
+            pass
+    return None
+
+
+def _bootstrap_progress(phase):
+    for field in phase.split():
+        if field.startswith("PROGRESS="):
+            return field[len("PROGRESS="):] + "%"
+    return "0%"
+
+# ====== Tor Pool ======
+class _TorLease:
+    def __init__(self, pool, runner):
+        self.pool = pool; self.runner = runner
+        self.socks_port = runner.socks_port
+        self.released = False
+    def connected(self, seconds): self.pool._connected(self.runner, seconds)
+    def failed(self, instance_fault): self.pool._failed(self.runner, instance_fault)
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._released(self.runner)
+
+class _TorStats:
+    def __init__(self):
+        self.active = 0
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.cooldown = 0.0
+
+# Supervises several tor processes, each with its own ports and DataDirectory, and hands
+# out SOCKS ports by least active streams or by measured connect latency.
+class TorPool:
+    strategies = ("least-active", "latency")
+    max_failures = 3
+    min_cooldown = 15.0
+    max_cooldown = 300.0
+
+    def __init__(self, count, base_dir="tor_data", strategy="least-active"):
+        if strategy not in self.strategies:
+            raise ValueError(f"unknown tor pool strategy: {strategy}")
+        self.strategy = strategy
+        self.runners = [
+            TorRunner(get_free_port(), get_free_port(), get_free_port(), data_dir=os.path.join(base_dir, f"instance{i}"))
+            for i in range(count)
+        ]
+        self.stats = {r: _TorStats() for r in self.runners}
+        self.lock = threading.Lock()
+        self.app_window = None
+        for r in self.runners:
+            r.on_progress = self._progress
+
+    @property
+    def bridge(self): return self.runners[0].bridge
+    @bridge.setter
+    def bridge(self, value):
+        for r in self.runners: r.bridge = value
+
+    @property
+    def bridges(self): return self.runners[0].bridges
+    @bridges.setter
+    def bridges(self, value):
+        for r in self.runners: r.bridges = value
+
+    def _progress(self, runner):
+        if self.app_window:
+            self.app_window.data.value = f"{max(r.progress for r in self.runners)}%"
+
+    @property
+    def keep_alive(self): return self.runners[0].keep_alive
+    @keep_alive.setter
+    def keep_alive(self, value):
+        for r in self.runners: r.keep_alive = value
+
+    # each instance gets an equal share
+    @property
+    def bandwidth_rate(self): return sum(r.bandwidth_rate for r in self.runners)
+    @bandwidth_rate.setter
+    def bandwidth_rate(self, value):
+        for r in self.runners: r.bandwidth_rate = value // len(self.runners)
+
+    @property
+    def rotation(self): return self.runners[0].rotation
+    @rotation.setter
+    def rotation(self, value):
+        for r in self.runners: r.rotation = value
+
+    def new_identity(self, reason="manual"):
+        return all([r.new_identity(reason) for r in self.runners])
+
+    def start(self):
+        for r in self.runners: r.start()
+
+    def stop(self):
+        for r in self.runners: r.stop()
+
+    def detach(self):
+        for r in self.runners: r.detach()
+
+    @property
+    def bridge_prober(self): return self.runners[0].bridge_prober
+    @bridge_prober.setter
+    def bridge_prober(self, value):
+        for r in self.runners: r.bridge_prober = value
+
+    def reconfigure(self):
+        return [r.reconfigure() for r in self.runners]
+
+    def schedule_reconfigure(self, delay=0.75):
+        for r in self.runners: r.schedule_reconfigure(delay)
+
+    def ready(self):
+        return bool(self.healthy())
+
+    def healthy(self):
+        now = time.monotonic()
+        return [r for r in self.runners if r.ready() and self.stats[r].ejected_until <= now]
+
+    def acquire(self):
+        with self.lock:
+            candidates = self.healthy()
+            if not candidates:
+                raise ConnectionError("no tor instance is ready")
+            if self.strategy == "latency":
+                # unmeasured instances go first so every instance gets sampled
+                key = lambda r: (self.stats[r].latency or 0.0) * (self.stats[r].active + 1)
+            else:
+                key = lambda r: self.stats[r].active
+            runner = min(candidates, key=key)
+            self.stats[runner].active += 1
+        return _TorLease(self, runner)
+
+    def _released(self, runner):
+        with self.lock:
+            self.stats[runner].active -= 1
+
+    def _connected(self, runner, seconds):
+        with self.lock:
+            st = self.stats[runner]
+            st.latency = seconds if st.latency is None else 0.8 * st.latency + 0.2 * seconds
+            st.failures = 0
+            st.cooldown = 0.0
+
+    def _failed(self, runner, instance_fault):
+        if not instance_fault:
+            return
+        with self.lock:
+            st = self.stats[runner]
+            st.failures += 1
+            if st.failures >= self.max_failures:
+                st.cooldown = min(self.max_cooldown, max(self.min_cooldown, st.cooldown * 2))
+                st.ejected_until = time.monotonic() + st.cooldown
+                st.failures = 0
 
 # ====== Proxy Controller ======
 class Runner:
-    def __init__(self, port, tor_socks_port, app_window):
+    engines = ("threaded", "asyncio")
+    # socks_port: also accept SOCKS5/SOCKS4a clients on this port (0 picks a free one), None for off
+    # limits: an admission.Limits shared by every listener of this runner
+    # workers: serve the proxy port from that many processes (workers.WorkerPool)
+    # listen_socket: serve this bound socket instead of binding port
+    # connect_policy: a circuits.ConnectPolicy for retrying and hedging tor connects
+    # routes: a routes.RouteTable of destinations that bypass tor
+    # shaper: a shaping.Shaper for the bandwidth of tunnels
+    def __init__(self, port, tor_socks_port, app_window, engine="threaded", http_cache=None, socks_port=None, limits=None,
+                 workers=1, listen_socket=None, connect_policy=None, routes=None, shaper=None):
         self.app_window = app_window
         self.port=port; self.server=None; self.thread=None; self.tor_socks_port = tor_socks_port
+        self.engine = engine
+        self.http_cache = http_cache
+        self.socks_port = socks_port; self.socks_server = None; self.socks_thread = None
+        self.limits = limits
+        self.workers = workers
+        self.listen_socket = listen_socket
+        self.connect_policy = connect_policy
+        self.routes = routes
+        self.shaper = shaper
     def start(self):
         if self.server: return
         ProxyHandler.app_window = self.app_window
-        self.server = ThreadedHTTPServer(("0.0.0.0", self.port), ProxyHandler, self.tor_socks_port)
+        if self.engine not in self.engines:
+            raise ValueError(f"unknown proxy engine: {self.engine}")
+        if self.http_cache and self.engine == "asyncio":
+            # only the threaded engine serves from the cache
+            LOG.write("http cache: not supported by the asyncio engine, serving uncached")
+            self.http_cache = None
+        if self.workers > 1:
+            from workers import WorkerPool
+            self.server = WorkerPool(self.workers, self.engine, ("0.0.0.0", self.port), self.tor_socks_port, self.limits, self.http_cache,
+                                     self.connect_policy, self.routes, self.shaper)
+        elif self.engine == "asyncio":
+            from aio_proxy import AsyncProxyServer
+            self.server = AsyncProxyServer(("0.0.0.0", self.port), self.tor_socks_port, self.limits, self.listen_socket,
+                                           self.connect_policy, self.routes, self.shaper)
+        else:
+            self.server = ThreadedHTTPServer(("0.0.0.0", self.port), ProxyHandler, self.tor_socks_port, self.http_cache, self.limits,
+                                             self.listen_socket, self.connect_policy, self.routes, self.shaper)
         self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
         self.thread.start()
+        if self.socks_port is not None:
+            from socks_server import SocksServer
+            self.socks_server = SocksServer(("0.0.0.0", self.socks_port), self.tor_socks_port, self.server.limits,
+                                            connect_policy=self.server.connect_policy, routes=self.server.routes,
+                                            shaper=self.server.shaper)
+            self.socks_thread = threading.Thread(target=self.socks_server.serve_forever, daemon=True)
+            self.socks_thread.start()
+    # live changes; worker processes get them when they are next restarted
+    def set_limits(self, limits):
+        if self.server:
+            self.server.limits.update(**limits.settings())
+        else:
+            self.limits = limits
+
+    def set_routes(self, routes):
+        self.routes = routes
+        for server in (self.server, self.socks_server):
+            if server: server.routes = routes
+
+    # tunnels already open keep the shaper they started with
+    def set_shaper(self, shaper):
+        self.shaper = shaper
+        for server in (self.server, self.socks_server):
+            if server: server.shaper = shaper
+
     def stop(self):
         if not self.server: return
+        if self.socks_server:
+            self.socks_server.shutdown(); self.socks_server.server_close(); self.socks_thread.join()
+            self.socks_server=None; self.socks_thread=None
         self.server.shutdown(); self.server.server_close(); self.thread.join()
         self.server=None; self.thread=None
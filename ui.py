@@ -15,6 +15,7 @@ from PySide6.QtWidgets import (
     QCheckBox,
     QTextEdit,
     QListWidget,
+    QListView,
     QLineEdit
 )
 
@@ -22,84 +23,70 @@ import qdarkstyle
 from qdarkstyle.dark.palette import DarkPalette
 from qdarkstyle.light.palette import LightPalette
 
-from PySide6.QtCore import Qt, QEasingCurve, QPropertyAnimation, Property, Signal, QObject, QTimer, QRunnable, Slot, QThreadPool
+from PySide6.QtCore import Qt, QEasingCurve, QPropertyAnimation, Property, Signal, QObject, QTimer, QRunnable, Slot, QThreadPool, QAbstractListModel, QModelIndex
 from PySide6.QtGui import QPainter, QColor, QBrush, QAction
 import sys
-from stem import Signal as TorSignal
-from stem.control import Controller
 from proxy import get_free_port, load_blocked, set_proxy, remove_blocked, save_blocked, add_to_blocked_hosts, get_blocked
 
-from tor import TorRunner, Runner
+from tor import TorRunner, TorPool, Runner
+from dns_cache import DNSProxy
+from http_cache import HTTPCache
+from bridges import BridgeProber
+from metrics import METRICS, MetricsServer, UP, DOWN
+from logpipe import LOG
+from admission import limits_from_config, LIMIT_KEYS
+from circuits import policy_from_config
+from control import rotation_from_config
+from routes import PAC_PATH, routes_from_config
+from shaping import SHAPING_KEYS, shaper_from_config
+from defaults import DEFAULTS
+from config_store import ConfigStore
+from profiling import profiling_from_config, install_signal
 import os
-import json
 
 
 class Config:
     file_config = "config.json"
-    default_data = {"bridges": "", "bridge":False, "mode": "dark"}
-    data = {"bridges": "", "bridge":False, "mode": "dark"}
-    
+    # the daemon's settings plus the UI's own; daemon-only keys (workers, blocklists, ...) are unused here
+    default_data = dict(DEFAULTS, mode="dark", system_pac=False)
+
+    # state is kept in memory; saving is debounced and done off the UI thread, see config_store
+    def __init__(self):
+        super().__setattr__("store", ConfigStore(self.file_config, self.default_data))
+
+    @property
+    def data(self):
+        return self.store.data
+
     def __getitem__(self, name):
+        # a stored 0, "" or [] is a setting too, only missing keys fall back to the default
         if name in self.default_data:
-            return self.data.get(name, None) or self.default_data[name]
+            return self.store.get(name)
         return None
     
     def __setitem__(self, name, value):
-        self.data[name] = value
-        self.save()
+        self.store.set(name, value)
         
     def __getattr__(self, name):
-        if name in ["bridges", "bridge", "mode"]:
+        if name in self.default_data:
             return self[name]
         return super().__getattr__(name)
     
     def __setattr__(self, name, value):
-        if name in ["bridges", "bridge", "mode"]:
+        if name in self.default_data:
             self[name] = value
             return
         super().__setattr__(name, value)        
-        
-    @staticmethod
-    def create_if_is_not_exits(fun):
-        def inner_function(*args, **kwargs):
-            
-            dir_ = os.path.dirname(__file__)
-            file_path = os.path.join(dir_, Config.file_config)
-            
-            if not os.path.exists(file_path):
-                open(file_path, "w").close()
-                
-            return fun(*args, **kwargs)
-            
-        return inner_function    
-    
-    def save_config(self, data):
-        with open(self.file_config, "w") as file:
-            file.write(data)
-
-    @create_if_is_not_exits
-    def get_config(self):
-        with open(self.file_config, "r") as file:
-            return file.read()
-    
-    def json_format(self, data):
-        try:
-            return json.loads(data)
-        except json.JSONDecodeError:
-            return self.default_data
 
-    def json_to_text(self, data):
-        return json.dumps(data)
-        
+    # callback(changes) is called with the changed keys and their new values
+    def subscribe(self, callback, keys=None):
+        return self.store.subscribe(callback, keys)
     
     def load(self):
-        data = self.get_config()
-        self.data = self.json_format(data)
-        return self.data
+        return self.store.load()
 
     def save(self):
-        data = self.json_to_text(self.data)
-        self.save_config(data)
+        self.store.flush()
         
 CONFIG = Config()
 
@@ -232,11 +219,38 @@ class ProxyWindow(QWidget):
         self.tor_control_port = get_free_port()
         self.tor_dns_port = get_free_port()
         print(f'port(proxy): {self.proxy_port} - port(socks): {self.tor_socks_port} - port(control): {self.tor_control_port}, - port(dns): {self.tor_dns_port}')
-        self.tor = TorRunner(self.tor_socks_port, self.tor_control_port, self.tor_dns_port)
+        # cached consensus, descriptors and guards live here between runs
+        data_dir = os.path.join("tor_data", CONFIG["tor_profile"])
+        if CONFIG["tor_instances"] > 1:
+            self.tor = TorPool(CONFIG["tor_instances"], base_dir=data_dir, strategy=CONFIG["tor_strategy"])
+        else:
+            self.tor = TorRunner(self.tor_socks_port, self.tor_control_port, self.tor_dns_port, data_dir=data_dir)
         self.tor.bridge = CONFIG["bridge"]
         self.tor.bridges = CONFIG["bridges"]
+        self.tor.keep_alive = CONFIG["keep_tor_warm"]
+        self.tor.rotation = rotation_from_config(CONFIG)
+        if CONFIG["bridge_auto"]:
+            self.tor.bridge_prober = BridgeProber(os.path.join("tor_data", "bridge_probes.json"),
+                                                  per_transport=CONFIG["bridges_per_transport"])
         self.tor.app_window = self
-        self.proxy = Runner(self.proxy_port, self.tor_socks_port,self)
+        http_cache = HTTPCache(max_bytes=CONFIG["http_cache_mb"] << 20) if CONFIG["http_cache_mb"] else None
+        shaper = shaper_from_config(CONFIG)
+        self.tor.bandwidth_rate = shaper.tor_rate()
+        self.proxy = Runner(self.proxy_port, self.tor,self, engine=CONFIG["engine"], http_cache=http_cache, socks_port=CONFIG["socks_listen_port"] or None, limits=limits_from_config(CONFIG),
+                            connect_policy=policy_from_config(CONFIG), routes=routes_from_config(CONFIG), shaper=shaper)
+        self.dns = None
+        if CONFIG["dns_port"]:
+            self.dns = DNSProxy(CONFIG["dns_port"], self._tor_dns_port(), host="0.0.0.0")
+        CONFIG.subscribe(self._tor_config, ("bridge", "bridges", "rotation", "rotation_interval"))
+        CONFIG.subscribe(lambda changes: self.proxy.set_routes(routes_from_config(CONFIG)), ("routes",))
+        CONFIG.subscribe(lambda changes: self.proxy.set_limits(limits_from_config(CONFIG)), LIMIT_KEYS)
+        CONFIG.subscribe(self._shaping_config, SHAPING_KEYS)
+        # SIGUSR1 runs once Python gets the main thread back from Qt, at the latest on the next stats tick
+        profiling_from_config(CONFIG)
+        install_signal()
+        CONFIG.subscribe(lambda changes: profiling_from_config(CONFIG), ("profile_dir", "phase_timing"))
+        self.metrics_server = MetricsServer(CONFIG["metrics_port"]) if CONFIG["metrics_port"] else None
+        if self.metrics_server: self.metrics_server.start()
         self.main_layout = QVBoxLayout(self)
         self.setLayout(self.main_layout)
         self.main_layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
@@ -249,33 +263,60 @@ class ProxyWindow(QWidget):
         self.lbl_percent = QLabel("0%") 
         self.main_layout.addWidget(self.lbl_percent)
         self.data.valueChanged.connect(self.dataValueChanged)
+        self.lbl_stats = QLabel("")
+        self.main_layout.addWidget(self.lbl_stats)
+        self.stats_timer = QTimer()
+        self.stats_timer.setInterval(2000)
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start()
         self.btn_change_identity = QPushButton("change identity")
         self.main_layout.addWidget(self.btn_change_identity)
-        self.btn_change_identity.clicked.connect(self.change_identity)
-        self.timer = QTimer()
-        self.timer.setInterval(30000)
-        self.timer.timeout.connect(self.change_identity_)
-        self.timer.start()
-        
+        self.btn_change_identity.clicked.connect(self.change_identity_)
+        
+    def _tor_config(self, changes):
+        if "bridge" in changes or "bridges" in changes:
+            self.tor.bridge = CONFIG["bridge"]
+            self.tor.bridges = CONFIG["bridges"]
+            # debounced too, a burst of keystrokes is one SETCONF
+            self.tor.schedule_reconfigure()
+        if "rotation" in changes or "rotation_interval" in changes:
+            self.tor.rotation = rotation_from_config(CONFIG)
+
+    def _shaping_config(self, changes):
+        shaper = shaper_from_config(CONFIG)
+        self.proxy.set_shaper(shaper)
+        if self.tor.bandwidth_rate != shaper.tor_rate():
+            self.tor.bandwidth_rate = shaper.tor_rate()
+            self.tor.schedule_reconfigure()
+
+    def update_stats(self):
+        if not self.running:
+            self.lbl_stats.setText("")
+            return
+        snap = METRICS.snapshot()
+        tunnels = sum(snap.get("torproxy_tunnels_active", {}).values())
+        relayed = snap.get("torproxy_relay_bytes_total", {})
+        errors = sum(snap.get("torproxy_errors_total", {}).values())
+        self.lbl_stats.setText(f"tunnels: {tunnels}  ↑ {relayed.get(UP, 0) >> 20} MB  ↓ {relayed.get(DOWN, 0) >> 20} MB  errors: {errors}")
+
+    def _tor_dns_port(self):
+        return self.tor.runners[0].dns_port if isinstance(self.tor, TorPool) else self.tor.dns_port
+
     def change_identity_(self):
         worker = Worker(
             self.change_identity
         )
         self.threadpool.start(worker)
 
+    # scheduled rotation runs in the tor runner's control session, see control.RotationPolicy
     def change_identity(self):
         if self.running:
-            try:
-                print(self.tor_control_port, type(self.tor_control_port))
-                with Controller.from_port(address="127.0.0.1", port=self.tor_control_port) as controller:
-                    controller.authenticate()
-                    controller.signal(TorSignal.NEWNYM)
-            except:
-                pass      
+            self.tor.new_identity()
         
     def dataValueChanged(self, v):
         if v == "100%":
-            set_proxy(True, f"127.0.0.1:{self.proxy_port}")
+            pac_url = f"http://127.0.0.1:{self.proxy_port}{PAC_PATH}" if CONFIG["system_pac"] else None
+            set_proxy(True, f"127.0.0.1:{self.proxy_port}", pac_url)
             self.btn_status.setText("connected")
             self.set_btn_status_style("connected")
             
@@ -306,18 +347,28 @@ class ProxyWindow(QWidget):
         if not self.running:
             try:
                 self.proxy.start(); self.tor.start()
+                if self.dns:
+                    # a reattached tor may listen on other ports than the ones we picked
+                    self.dns.cache.upstream = ("127.0.0.1", self._tor_dns_port())
+                    self.dns.start()
                 self.btn_status.setText("connecting . . .")
                 self.running = True
                 self.set_btn_status_style("connecting")
+                if self.tor.ready():
+                    self.dataValueChanged("100%")
 
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Start failed: {e}")
                 self.proxy.stop(); self.tor.stop()
+                if self.dns: self.dns.stop()
                 self.running = False 
                 return
         else:
             self.lbl_percent.setText("0%")
-            self.proxy.stop(); self.tor.stop(); set_proxy(False)
+            self.proxy.stop(); set_proxy(False)
+            # a warm tor keeps its circuits so the next connect is immediate
+            if not CONFIG["keep_tor_warm"]: self.tor.stop()
+            if self.dns: self.dns.stop()
             self.running = False
             self.btn_status.setText("disconnected")
             self.set_btn_status_style("disconnected")
@@ -410,19 +461,13 @@ class SettingWindow(QWidget):
         
         btn_group_mode.buttonClicked.connect(self.change_mode)
     
+    # tor and the proxy follow CONFIG through their subscriptions, see ProxyWindow._tor_config
     def set_bridges(self):
-        self._parent.proxyWidget.tor.bridges = self.inp_bridges.toPlainText()
         CONFIG.bridges = self.inp_bridges.toPlainText()
          
     def bridge_state_changed(self, state):
-        if state==2:
-            self._parent.proxyWidget.tor.bridge = True
-            self.inp_bridges.setEnabled(True)
-            CONFIG.bridge = True
-        else: 
-            self._parent.proxyWidget.tor.bridge = False
-            self.inp_bridges.setEnabled(False)
-            CONFIG.bridge = False
+        self.inp_bridges.setEnabled(state == 2)
+        CONFIG.bridge = state == 2
             
     def change_mode(self, radiobtn):
         app = QApplication.instance()
@@ -441,6 +486,76 @@ class SettingWindow(QWidget):
     def back_to_proxy(self):
         self._parent.stack.setCurrentIndex(0)
 
+class LogFeed(QObject):
+    # emitted from the log flusher thread, delivered on the UI thread (queued connection)
+    batch = Signal(list)
+
+
+# Holds the lines in a plain list and only tells the view which rows changed; the view
+# asks for the rows it shows, so 100k lines cost no more to display than 100.
+class LogModel(QAbstractListModel):
+    def __init__(self, capacity=100000, parent=None):
+        super().__init__(parent)
+        self.capacity = capacity
+        self.lines = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.lines[index.row()]
+        return None
+
+    def append(self, batch):
+        batch = batch[-self.capacity:]
+        overflow = len(self.lines) + len(batch) - self.capacity
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            del self.lines[:overflow]
+            self.endRemoveRows()
+        self.beginInsertRows(QModelIndex(), len(self.lines), len(self.lines) + len(batch) - 1)
+        self.lines.extend(batch)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.lines = []
+        self.endResetModel()
+
+
+class LogWindow(QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._parent = parent
+        main_layout = QVBoxLayout(self)
+        self.setLayout(main_layout)
+
+        self.model = LogModel(parent=self)
+        self.view = QListView()
+        self.view.setModel(self.model)
+        self.view.setUniformItemSizes(True)
+        self.view.setEditTriggers(QListView.NoEditTriggers)
+        main_layout.addWidget(self.view)
+
+        btn_clear = QPushButton("Clear")
+        btn_clear.clicked.connect(self.model.clear)
+        main_layout.addWidget(btn_clear)
+
+        self.feed = LogFeed()
+        self.feed.batch.connect(self.append)
+        LOG.path = CONFIG["log_file"] or None
+        LOG.add_sink(self.feed.batch.emit)
+        LOG.start()
+
+    def append(self, batch):
+        bar = self.view.verticalScrollBar()
+        follow = bar.value() == bar.maximum()
+        self.model.append(batch)
+        if follow:
+            self.view.scrollToBottom()
+
+
 class BlcokHostsWindow(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent) 
@@ -485,10 +600,12 @@ class BlcokHostsWindow(QWidget):
                 )
                 self.threadpool.start(worker)
     
+    # imported lists can hold millions of rules, far more than a list widget should
+    LIST_LIMIT = 10000
+
     def _update_hosts_list(self):
         self.hosts_list.clear()
-        for host in get_blocked():
-            self.hosts_list.addItem(host)
+        self.hosts_list.addItems(get_blocked()[:self.LIST_LIMIT])
         
     def add_to_list(self):
         host = self.inp_host.text()
@@ -523,6 +640,9 @@ class Window(QMainWindow):
         
         self.block_host_window = BlcokHostsWindow(self)
         self.stack.addWidget(self.block_host_window)
+
+        self.log_window = LogWindow(self)
+        self.stack.addWidget(self.log_window)
         
         self.title_bar = CustomTitleBar(self)
         self.main_layout.addWidget(self.title_bar)
@@ -530,7 +650,17 @@ class Window(QMainWindow):
         self.main_layout.addWidget(self.stack)
     
     def closeEvent(self, event):
-        if self.proxyWidget.running: self.proxyWidget.proxy.stop(); self.proxyWidget.tor.stop(); set_proxy(False)
+        if self.proxyWidget.running:
+            self.proxyWidget.proxy.stop(); set_proxy(False)
+            if self.proxyWidget.dns: self.proxyWidget.dns.stop()
+        if self.proxyWidget.metrics_server: self.proxyWidget.metrics_server.stop()
+        LOG.remove_sink(self.log_window.feed.batch.emit)
+        LOG.close()
+        CONFIG.save()
+        if CONFIG["keep_tor_warm"]:
+            self.proxyWidget.tor.detach()
+        else:
+            self.proxyWidget.tor.stop()
         event.accept()
 
     def _createMenuBar(self):
@@ -555,6 +685,11 @@ class Window(QMainWindow):
         block_action.triggered.connect(self._show_block_host)
         block_action.setShortcut("Ctrl+B")
         moreMenu.addAction(block_action)
+
+        log_action = QAction("Log", self)
+        log_action.triggered.connect(self._show_log)
+        log_action.setShortcut("Ctrl+L")
+        moreMenu.addAction(log_action)
         
         exit_action = QAction("Quit", self)
         exit_action.setShortcut("Ctrl+Q")        
@@ -569,5 +704,8 @@ class Window(QMainWindow):
     
     def _show_block_host(self):
         self.stack.setCurrentIndex(2)
+
+    def _show_log(self):
+        self.stack.setCurrentIndex(3)
         
         
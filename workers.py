@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import socket
+import threading
+import multiprocessing
+import proxy
+from admission import Limits
+from circuits import ConnectPolicy
+from routes import RouteTable
+from shaping import Shaper
+from metrics import METRICS
+from logpipe import LOG
+from profiling import PROFILER, install_signal
+
+# Linux balances connections over every socket bound with SO_REUSEPORT; elsewhere the
+# workers share one listening socket created by the parent
+REUSE_PORT = sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+BACKLOG = 1024
+
+
+# ====== Worker process ======
+def _worker_main(engine, listen, tor_socks_port, limits, policy, routes, shaping, blocked_file, cache, log_path,
+                 profiling):
+    from tor import Runner
+    PROFILER.directory, PROFILER.timing = profiling
+    install_signal()
+    proxy.BLOCKED_FILE = blocked_file
+    proxy.load_blocked()
+    if log_path:
+        LOG.path = log_path
+        LOG.start()
+    if isinstance(listen, tuple):
+        sock = socket.create_server(listen, backlog=BACKLOG, reuse_port=True)
+    else:
+        sock = listen
+    http_cache = None
+    if cache:
+        from http_cache import HTTPCache
+        http_cache = HTTPCache(cache[0], max_bytes=cache[1])
+    runner = Runner(sock.getsockname()[1], tor_socks_port, None, engine=engine, http_cache=http_cache,
+                    limits=Limits(**limits), listen_socket=sock, connect_policy=ConnectPolicy(**policy),
+                    routes=RouteTable(routes), shaper=Shaper(**shaping))
+    runner.start()
+    parent = multiprocessing.parent_process()
+    # the index is mapped, not copied, so every worker shares one copy in the page cache;
+    # edits made by the parent show up in the delta log
+    while parent is None or parent.is_alive():
+        time.sleep(1)
+        proxy.refresh_blocked()
+
+
+# ====== Supervisor ======
+# Same interface as ThreadedHTTPServer: serve_forever() supervises `count` worker processes,
+# each running its own proxy engine on the shared port, and restarts the ones that die.
+# Workers are spawned, not forked, so a parent with threads (Qt, tor readers) is safe.
+# Limits, the HTTP cache and metrics are per worker; the global bandwidth caps are split
+# evenly between the workers.
+class WorkerPool:
+    def __init__(self, count, engine, addr, tor_route, limits=None, http_cache=None, connect_policy=None, routes=None,
+                 shaper=None):
+        self.count = count
+        self.engine = engine
+        self.tor_route = tor_route
+        self.limits = limits or Limits()
+        self.connect_policy = connect_policy or ConnectPolicy()
+        self.routes = routes or RouteTable()
+        self.shaper = shaper or Shaper()
+        self.http_cache = http_cache
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._procs = [None] * count
+        self._stop = threading.Event()
+        self._stopped = threading.Event()
+        if REUSE_PORT:
+            # holds the port without listening, the kernel only hands connections to listeners
+            self.socket = socket.socket(socket.AF_INET6 if ":" in addr[0] else socket.AF_INET)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.socket.bind(addr)
+        else:
+            self.socket = socket.create_server(addr, backlog=BACKLOG)
+        self.server_address = self.socket.getsockname()
+        METRICS.add_collector(self._collect)
+
+    def _tor_port(self, index):
+        tor = self.tor_route
+        if isinstance(tor, int):
+            return tor
+        # a pool gives each worker its own instance
+        runners = getattr(tor, "runners", None)
+        return (runners[index % len(runners)] if runners else tor).socks_port
+
+    def _spawn(self, index):
+        listen = self.server_address[:2] if REUSE_PORT else self.socket
+        cache = None
+        if self.http_cache:
+            cache = (os.path.join(self.http_cache.directory, f"worker{index}"), self.http_cache.max_bytes // self.count)
+        shaping = self.shaper.settings()
+        for direction in ("up", "down"):
+            # a cap below one byte per second per worker must not turn into 0, which is no cap
+            if shaping[direction]:
+                shaping[direction] = max(1, shaping[direction] // self.count)
+        proc = self._context.Process(
+            target=_worker_main, daemon=True,
+            args=(self.engine, listen, self._tor_port(index), self.limits.settings(), self.connect_policy.settings(),
+                  self.routes.rules, shaping, os.path.abspath(proxy.BLOCKED_FILE), cache, LOG.path,
+                  (os.path.abspath(PROFILER.directory), PROFILER.timing)))
+        proc.start()
+        self._procs[index] = proc
+
+    def serve_forever(self):
+        try:
+            for i in range(self.count):
+                self._spawn(i)
+            while not self._stop.wait(1):
+                for i, proc in enumerate(self._procs):
+                    if proc.exitcode is not None:
+                        LOG.write(f"[workers] worker {i} (pid {proc.pid}) exited with {proc.exitcode}, restarting")
+                        self.restarts += 1
+                        self._spawn(i)
+        finally:
+            self._stopped.set()
+
+    def pids(self):
+        return [p.pid for p in self._procs if p is not None]
+
+    def _collect(self):
+        return {"torproxy_workers_alive": sum(1 for p in self._procs if p is not None and p.is_alive()),
+                "torproxy_worker_restarts_total": self.restarts}
+
+    def shutdown(self):
+        self._stop.set()
+        self._stopped.wait()
+
+    def server_close(self):
+        for proc in self._procs:
+            if proc is not None:
+                proc.terminate()
+        for proc in self._procs:
+            if proc is not None:
+                proc.join(5)
+        self.socket.close()
+        METRICS.remove_collector(self._collect)